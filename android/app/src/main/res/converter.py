@@ -1,25 +1,231 @@
-from PIL import Image
+# converter.py
+#
+# Builds the app icon for every platform from one square source image:
+#   android  mipmap-*/ic_launcher.png and the 512px store listing icon
+#   ios      every entry of Runner/Assets.xcassets/AppIcon.appiconset/Contents.json
+#   macos    every file of Runner/Assets.xcassets/AppIcon.appiconset/Contents.json
+#   web      favicon.png and icons/Icon-*.png (maskable ones padded to the safe zone)
+#   windows  runner/resources/app_icon.ico
+#
+# The source is decoded once. Smaller copies are made by repeatedly halving it
+# (box filter), and each icon is then resized with Lanczos from the smallest
+# copy that is still at least twice its size. Icons are rendered in a process
+# pool.
+#
+# Each output's hash (source bytes + render parameters) is recorded in
+# .converter-cache.json next to this script. Outputs whose hash is unchanged
+# and whose file is still in place are skipped, so a rebuild without changes
+# only reads the source.
+#
+# Usage (from anywhere):
+#   python android/app/src/main/res/converter.py --source icon.png
+#   python android/app/src/main/res/converter.py --platform ios --platform macos
+#   python android/app/src/main/res/converter.py --force
+
+import argparse
+import hashlib
+import json
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+RES_DIR = Path(__file__).resolve().parent
+REPO_ROOT = RES_DIR.parents[4]
+DEFAULT_SOURCE = RES_DIR / "icon.png"
+CACHE_FILE = RES_DIR / ".converter-cache.json"
+# Bump when the rendering changes, so every output is rebuilt once.
+TOOL_VERSION = 2
+PLATFORMS = ("android", "ios", "macos", "web", "windows")
+
+ANDROID_MIPMAPS = {"mdpi": 48, "hdpi": 72, "xhdpi": 96, "xxhdpi": 144, "xxxhdpi": 192}
+ANDROID_STORE_LISTING_SIZE = 512
+WEB_ICONS = {"favicon.png": 16, "icons/Icon-192.png": 192, "icons/Icon-512.png": 512}
+WEB_MASKABLE_ICONS = {"icons/Icon-maskable-192.png": 192, "icons/Icon-maskable-512.png": 512}
+# Maskable icons keep their content inside the central 80% safe zone.
+MASKABLE_SAFE_ZONE = 0.8
+WINDOWS_ICO_SIZES = (16, 24, 32, 48, 64, 256)
+
+# Set in each pool worker by _init_worker: [(side, image), ...], largest first.
+_pyramid = None
+
+
+def _asset_catalog_targets(catalog_dir: str, flatten: bool) -> list:
+    """One target per file listed in an Xcode asset catalog's Contents.json."""
+    contents_path = REPO_ROOT / catalog_dir / "Contents.json"
+    if not contents_path.exists():
+        print(f"Skipping {catalog_dir}: no Contents.json.", file=sys.stderr)
+        return []
+    targets = {}
+    for entry in json.loads(contents_path.read_text())["images"]:
+        if not entry.get("filename"):
+            continue
+        points = float(entry["size"].split("x")[0])
+        scale = int(entry.get("scale", "1x").rstrip("x"))
+        targets[entry["filename"]] = {
+            "path": f"{catalog_dir}/{entry['filename']}",
+            "size": round(points * scale),
+            "flatten": flatten,
+        }
+    return list(targets.values())
+
+
+def build_targets(platforms) -> list:
+    """Every icon file to produce, as {"path", "size", ...render options}."""
+    targets = []
+    if "android" in platforms:
+        for density, size in ANDROID_MIPMAPS.items():
+            targets.append({"path": f"android/app/src/main/res/mipmap-{density}/ic_launcher.png", "size": size})
+        # Kept outside res/, where Gradle would reject an unknown resource directory.
+        targets.append({"path": "android/storelisting/ic_launcher.png", "size": ANDROID_STORE_LISTING_SIZE})
+    if "ios" in platforms:
+        # The App Store rejects app icons with an alpha channel.
+        targets += _asset_catalog_targets("ios/Runner/Assets.xcassets/AppIcon.appiconset", flatten=True)
+    if "macos" in platforms:
+        targets += _asset_catalog_targets("macos/Runner/Assets.xcassets/AppIcon.appiconset", flatten=False)
+    if "web" in platforms:
+        for path, size in WEB_ICONS.items():
+            targets.append({"path": f"web/{path}", "size": size})
+        for path, size in WEB_MASKABLE_ICONS.items():
+            targets.append({"path": f"web/{path}", "size": size, "maskable": True})
+    if "windows" in platforms:
+        targets.append({"path": "windows/runner/resources/app_icon.ico", "size": max(WINDOWS_ICO_SIZES),
+                        "ico_sizes": list(WINDOWS_ICO_SIZES)})
+    return targets
+
+
+def target_digest(source_hash: str, target: dict, background: str) -> str:
+    params = {**target, "background": background, "source": source_hash, "version": TOOL_VERSION}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def decode_source(path: Path) -> Image.Image:
+    """Decodes the source as RGBA, padded to a square if it isn't one."""
+    with Image.open(path) as img:
+        img = img.convert("RGBA")
+    if img.width != img.height:
+        side = max(img.size)
+        square = Image.new("RGBA", (side, side), (0, 0, 0, 0))
+        square.paste(img, ((side - img.width) // 2, (side - img.height) // 2))
+        print(f"Source is {img.width}x{img.height}; padded to {side}x{side}.", file=sys.stderr)
+        img = square
+    return img
+
+
+def build_pyramid(img: Image.Image, smallest: int) -> list:
+    """The source and its successive halvings, down to about twice the smallest icon."""
+    levels = [img]
+    while levels[-1].width // 2 >= smallest * 2:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+
+def _init_worker(levels: list) -> None:
+    global _pyramid
+    _pyramid = [(size[0], Image.frombytes(mode, size, data)) for mode, size, data in levels]
+
+
+def _resized(size: int) -> Image.Image:
+    """Lanczos resize from the smallest pyramid level at least twice as large (or the largest)."""
+    level = next((img for side, img in reversed(_pyramid) if side >= size * 2), _pyramid[0][1])
+    if level.width == size:
+        return level.copy()
+    return level.resize((size, size), Image.LANCZOS)
+
+
+def _render(target: dict, background: str) -> Image.Image:
+    size = target["size"]
+    if target.get("maskable"):
+        inner = _resized(round(size * MASKABLE_SAFE_ZONE))
+        img = Image.new("RGBA", (size, size), background)
+        img.alpha_composite(inner, ((size - inner.width) // 2, (size - inner.height) // 2))
+    else:
+        img = _resized(size)
+    if target.get("flatten") or target.get("maskable"):
+        flat = Image.new("RGBA", img.size, background)
+        flat.alpha_composite(img)
+        img = flat.convert("RGB")
+    return img
+
+
+def render_target(target: dict, background: str) -> str:
+    """Renders and writes one output. Runs in a pool worker."""
+    output = REPO_ROOT / target["path"]
+    output.parent.mkdir(parents=True, exist_ok=True)
+    partial = output.with_name(f".{output.name}.partial")
+    if target.get("ico_sizes"):
+        # Every size in the .ico gets its own resize instead of Pillow's
+        # default of shrinking the largest one.
+        images = [_resized(size) for size in target["ico_sizes"]]
+        images[-1].save(partial, format="ICO", sizes=[img.size for img in images], append_images=images[:-1])
+    else:
+        _render(target, background).save(partial, format="PNG", optimize=True)
+    os.replace(partial, output)
+    return target["path"]
+
+
+def _load_cache() -> dict:
+    try:
+        return json.loads(CACHE_FILE.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Generate the app icons for every platform from one image.")
+    parser.add_argument("--source", type=Path, default=DEFAULT_SOURCE,
+                        help="Square source image, ideally 1024px or larger.")
+    parser.add_argument("--platform", action="append", choices=PLATFORMS,
+                        help="Only build this platform (repeatable). Default: all.")
+    parser.add_argument("--background", default="#FFFFFF",
+                        help="Fill for icons without transparency (iOS, maskable web icons).")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--force", action="store_true", help="Rebuild every output.")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if not args.source.exists():
+        print(f"Source image {args.source} not found.", file=sys.stderr)
+        return 1
+    source_hash = hashlib.sha256(args.source.read_bytes()).hexdigest()
+    targets = build_targets(args.platform or PLATFORMS)
+    cache = _load_cache()
+
+    stale = []
+    for target in targets:
+        digest = target_digest(source_hash, target, args.background)
+        if args.force or cache.get(target["path"]) != digest or not (REPO_ROOT / target["path"]).exists():
+            stale.append((target, digest))
+    if not stale:
+        print(f"All {len(targets)} icons are up to date ({time.perf_counter() - started:.2f}s).")
+        return 0
+
+    img = decode_source(args.source)
+    if img.width < max(t["size"] for t, _ in stale):
+        print(f"Warning: the {img.width}px source is smaller than some icons and will be scaled up.",
+              file=sys.stderr)
+    smallest = min(min(t.get("ico_sizes") or [t["size"]]) for t, _ in stale)
+    levels = [(level.mode, level.size, level.tobytes()) for level in build_pyramid(img, smallest)]
+
+    jobs = max(1, min(args.jobs, len(stale)))
+    if jobs == 1:
+        _init_worker(levels)
+        written = [render_target(target, args.background) for target, _ in stale]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(levels,)) as executor:
+            written = list(executor.map(render_target, [t for t, _ in stale], [args.background] * len(stale)))
+
+    cache.update({target["path"]: digest for target, digest in stale})
+    CACHE_FILE.write_text(json.dumps(cache, indent=2, sort_keys=True) + "\n")
+    for path in written:
+        print(f"  {path}")
+    print(f"Built {len(written)} of {len(targets)} icons with {jobs} worker(s) "
+          f"in {time.perf_counter() - started:.2f}s.")
+    return 0
+
 
-def resize_image(input_image, output_image, size):
-    """
-    Resize image to the given size.
-
-    :param input_image: input image path
-    :param output_image: output image path
-    :param size: tuple of width and height
-    """
-    image = Image.open(input_image)
-    resized_image = image.resize(size)
-    resized_image.save(output_image)
-
-# Example usage
-input_image = 'icon.png'  # Replace with your input image file path
-sizes = [(48, 48), (72, 72), (96, 96), (144, 144), (192, 192),(512,512)]  # Sizes for mdpi, hdpi, xhdpi, xxhdpi, xxxhdpi
-paths = ['mipmap-mdpi', 'mipmap-hdpi', 'mipmap-xhdpi', 'mipmap-xxhdpi', 'mipmap-xxxhdpi','storelisting']
-
-for index, size in enumerate(sizes):
-    folder = paths[index]
-    os.makedirs(folder, exist_ok=True)  # Create the folder if it doesn't exist
-    output_image = os.path.join(folder, 'ic_launcher.png')
-    resize_image(input_image, output_image, size)
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,838 @@
+# benchmarks/fakes.py
+#
+# Offline stand-ins for the Google services the functions talk to: Firestore,
+# FCM, Maps, Gemini (generativeai and vertexai), Vision, Secret Manager and
+# plain HTTP image downloads.
+#
+# install() registers them under the real module names in sys.modules, so
+# main.py, posts.py and quiz.py import them unchanged. Every call goes
+# through a ServiceProfile, which adds latency, injects errors and counts
+# the call against the handler that made it.
+
+import contextvars
+import copy
+import hashlib
+import io
+import json
+import random
+import re
+import sys
+import threading
+import time
+import types
+import urllib.request
+import urllib.response
+import uuid
+from email.message import Message as _Headers
+from typing import Generic, TypeVar
+
+# Handler the current call is attributed to (set by the replay runner).
+current_handler = contextvars.ContextVar("current_handler", default="unattributed")
+
+
+class FakeServiceError(Exception):
+    """Injected failure."""
+
+
+class QuotaExceeded(FakeServiceError):
+    """Injected quota failure; its message matches rate_limits.is_quota_error."""
+
+    def __init__(self, service: str):
+        super().__init__(f"429 RESOURCE_EXHAUSTED: injected {service} quota error")
+
+
+class CallRecorder:
+    """Thread-safe external-call counts, keyed by handler and then "service.op"."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, service: str, op: str) -> None:
+        key = f"{service}.{op}"
+        with self._lock:
+            per_handler = self._counts.setdefault(current_handler.get(), {})
+            per_handler[key] = per_handler.get(key, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {handler: dict(counts) for handler, counts in self._counts.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts = {}
+
+
+calls = CallRecorder()
+
+
+class ServiceProfile:
+    """Latency and failure behaviour of one fake service."""
+
+    def __init__(self, service: str, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 error_rate: float = 0.0, quota_error_rate: float = 0.0):
+        self.service = service
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.quota_error_rate = quota_error_rate
+        self._random = random.Random(service)
+        self._lock = threading.Lock()
+
+    def call(self, op: str) -> None:
+        calls.record(self.service, op)
+        with self._lock:
+            delay_ms = max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms))
+            roll = self._random.random()
+        if delay_ms:
+            time.sleep(delay_ms / 1000)
+        if roll < self.quota_error_rate:
+            raise QuotaExceeded(self.service)
+        if roll < self.quota_error_rate + self.error_rate:
+            raise FakeServiceError(f"Injected {self.service}.{op} failure")
+
+
+# Defaults are in the range of what the real services show from asia-southeast1.
+profiles = {
+    "firestore": ServiceProfile("firestore", latency_ms=8, jitter_ms=4),
+    "fcm": ServiceProfile("fcm", latency_ms=40, jitter_ms=15),
+    "maps": ServiceProfile("maps", latency_ms=120, jitter_ms=40),
+    "gemini": ServiceProfile("gemini", latency_ms=1500, jitter_ms=500),
+    "vision": ServiceProfile("vision", latency_ms=400, jitter_ms=100),
+    "secretmanager": ServiceProfile("secretmanager", latency_ms=60, jitter_ms=20),
+    "http": ServiceProfile("http", latency_ms=80, jitter_ms=30),
+}
+
+
+def configure(latency: dict | None = None, errors: dict | None = None,
+              quota_errors: dict | None = None, jitter: dict | None = None) -> None:
+    """Overrides per-service behaviour, e.g. configure(latency={"gemini": 300})."""
+    for attr, values in (("latency_ms", latency), ("error_rate", errors),
+                         ("quota_error_rate", quota_errors), ("jitter_ms", jitter)):
+        for service, value in (values or {}).items():
+            if service not in profiles:
+                raise KeyError(f"Unknown service '{service}'. Known: {', '.join(profiles)}")
+            setattr(profiles[service], attr, float(value))
+
+
+def _stable_int(*parts) -> int:
+    return int(hashlib.sha256("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:12], 16)
+
+
+# --- Firestore ----------------------------------------------------------------
+
+class _Transform:
+    def __init__(self, value=None):
+        self.value = value
+
+
+class Increment(_Transform):
+    def apply(self, current):
+        return (current or 0) + self.value
+
+
+class ArrayUnion(_Transform):
+    def apply(self, current):
+        result = list(current or [])
+        result.extend(v for v in self.value if v not in result)
+        return result
+
+
+class ArrayRemove(_Transform):
+    def apply(self, current):
+        return [v for v in (current or []) if v not in self.value]
+
+
+class Minimum(_Transform):
+    def apply(self, current):
+        return self.value if current is None else min(current, self.value)
+
+
+class Maximum(_Transform):
+    def apply(self, current):
+        return self.value if current is None else max(current, self.value)
+
+
+class _Sentinel:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+DELETE_FIELD = _Sentinel("DELETE_FIELD")
+SERVER_TIMESTAMP = _Sentinel("SERVER_TIMESTAMP")
+
+
+def _resolve(value, current):
+    if isinstance(value, _Transform):
+        return value.apply(current)
+    if value is SERVER_TIMESTAMP:
+        return time.time()
+    if isinstance(value, dict):
+        return {k: _resolve(v, None) for k, v in value.items() if v is not DELETE_FIELD}
+    return copy.deepcopy(value)
+
+
+def _set_path(data: dict, path: list, value) -> None:
+    for key in path[:-1]:
+        child = data.get(key)
+        if not isinstance(child, dict):
+            child = data[key] = {}
+        data = child
+    if value is DELETE_FIELD:
+        data.pop(path[-1], None)
+    else:
+        data[path[-1]] = _resolve(value, data.get(path[-1]))
+
+
+def _merge(data: dict, fields: dict, prefix: list) -> None:
+    for key, value in fields.items():
+        if isinstance(value, dict) and value:
+            _merge(data, value, prefix + [key])
+        else:
+            _set_path(data, prefix + [key], value)
+
+
+def _get_path(data: dict, field: str):
+    for key in field.split("."):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data: dict | None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self) -> dict | None:
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str):
+        # Like the real SDK: None for a missing document, KeyError for a missing field.
+        if self._data is None:
+            return None
+        value = self._data
+        for key in field.split("."):
+            if not isinstance(value, dict) or key not in value:
+                raise KeyError(f"{field!r} is not contained in the data")
+            value = value[key]
+        return copy.deepcopy(value)
+
+
+class _Watch:
+    is_active = True
+
+    def unsubscribe(self) -> None:
+        self.is_active = False
+
+
+class DocumentReference:
+    def __init__(self, client, path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str):
+        return CollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, transaction=None, field_paths=None) -> DocumentSnapshot:
+        profiles["firestore"].call("get")
+        return self._client._read(self)
+
+    def set(self, data: dict, merge: bool = False) -> None:
+        profiles["firestore"].call("set")
+        self._client._apply([("set", self, data, merge)])
+
+    def create(self, data: dict) -> None:
+        profiles["firestore"].call("create")
+        self._client._apply([("create", self, data, False)])
+
+    def update(self, data: dict) -> None:
+        profiles["firestore"].call("update")
+        self._client._apply([("update", self, data, False)])
+
+    def delete(self) -> None:
+        profiles["firestore"].call("delete")
+        self._client._apply([("delete", self, None, False)])
+
+    def on_snapshot(self, callback):
+        profiles["firestore"].call("listen")
+        callback([self._client._read(self)], [], time.time())
+        return _Watch()
+
+
+class _AggregateResult:
+    def __init__(self, value):
+        self.value = value
+
+
+class _CountQuery:
+    def __init__(self, query):
+        self._query = query
+
+    def get(self):
+        profiles["firestore"].call("count")
+        return [[_AggregateResult(len(self._query._matching()))]]
+
+
+class Query:
+    def __init__(self, client, path: str, filters=None, order=None, limit_count=None):
+        self._client = client
+        self._path = path
+        self._filters = filters or []
+        self._order = order or []
+        self._limit = limit_count
+
+    def _copy(self, **changes):
+        values = {"filters": list(self._filters), "order": list(self._order), "limit_count": self._limit}
+        values.update(changes)
+        return Query(self._client, self._path, **values)
+
+    def where(self, field: str = None, op: str = None, value=None, filter=None):
+        if filter is not None:
+            field, op, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field, op, value)])
+
+    def order_by(self, field: str, direction: str = "ASCENDING"):
+        return self._copy(order=self._order + [(field, direction)])
+
+    def limit(self, count: int):
+        return self._copy(limit_count=count)
+
+    def count(self):
+        return _CountQuery(self)
+
+    def _matching(self) -> list:
+        ops = {
+            "==": lambda a, b: a == b, "!=": lambda a, b: a != b,
+            "<": lambda a, b: a is not None and a < b, "<=": lambda a, b: a is not None and a <= b,
+            ">": lambda a, b: a is not None and a > b, ">=": lambda a, b: a is not None and a >= b,
+            "in": lambda a, b: a in b, "array_contains": lambda a, b: isinstance(a, list) and b in a,
+            "array_contains_any": lambda a, b: isinstance(a, list) and any(v in a for v in b),
+        }
+        snapshots = []
+        for ref, data in self._client._children(self._path):
+            if all(ops[op](_get_path(data, field), value) for field, op, value in self._filters):
+                snapshots.append(DocumentSnapshot(ref, data))
+        for field, direction in reversed(self._order):
+            if field == "__name__":
+                snapshots.sort(key=lambda s: s.reference.path, reverse=direction in ("DESCENDING", "desc"))
+                continue
+            # Firestore leaves out documents that don't have the ordered field.
+            snapshots = [s for s in snapshots if _get_path(s._data, field) is not None]
+            snapshots.sort(key=lambda s: _get_path(s._data, field), reverse=direction in ("DESCENDING", "desc"))
+        return snapshots[:self._limit] if self._limit is not None else snapshots
+
+    def stream(self, transaction=None):
+        profiles["firestore"].call("query")
+        return iter(self._matching())
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path: str):
+        super().__init__(client, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: str | None = None) -> DocumentReference:
+        return DocumentReference(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data: dict):
+        ref = self.document()
+        ref.set(data)
+        return time.time(), ref
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append(("set", ref, data, merge))
+
+    def create(self, ref, data):
+        self._ops.append(("create", ref, data, False))
+
+    def update(self, ref, data):
+        self._ops.append(("update", ref, data, False))
+
+    def delete(self, ref):
+        self._ops.append(("delete", ref, None, False))
+
+    def commit(self):
+        profiles["firestore"].call("commit")
+        ops, self._ops = self._ops, []
+        self._client._apply(ops)
+        return [time.time()] * len(ops)
+
+
+class Transaction(WriteBatch):
+    """Serialised through the client's lock, so transactions never conflict."""
+
+
+def transactional(func):
+    def wrapper(transaction, *args, **kwargs):
+        with transaction._client._transaction_lock:
+            result = func(transaction, *args, **kwargs)
+            transaction.commit()
+        return result
+    return wrapper
+
+
+class Client:
+    """In-memory Firestore: documents are stored as plain dicts keyed by path."""
+
+    def __init__(self):
+        self._docs = {}
+        self._lock = threading.RLock()
+        self._transaction_lock = threading.RLock()
+
+    def collection(self, name: str) -> CollectionReference:
+        return CollectionReference(self, name)
+
+    def document(self, path: str) -> DocumentReference:
+        return DocumentReference(self, path)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def transaction(self) -> Transaction:
+        return Transaction(self)
+
+    def get_all(self, refs, field_paths=None, transaction=None):
+        profiles["firestore"].call("get_all")
+        return [self._read(ref) for ref in refs]
+
+    def _read(self, ref) -> DocumentSnapshot:
+        with self._lock:
+            return DocumentSnapshot(ref, copy.deepcopy(self._docs.get(ref.path)))
+
+    def _children(self, collection_path: str) -> list:
+        prefix = collection_path + "/"
+        with self._lock:
+            return [
+                (DocumentReference(self, path), copy.deepcopy(data))
+                for path, data in self._docs.items()
+                if path.startswith(prefix) and "/" not in path[len(prefix):]
+            ]
+
+    def _apply(self, ops: list) -> None:
+        with self._lock:
+            staged = {}
+            for kind, ref, data, merge in ops:
+                current = staged.get(ref.path, self._docs.get(ref.path))
+                if kind == "delete":
+                    staged[ref.path] = None
+                    continue
+                if kind == "update" and current is None:
+                    raise FakeServiceError(f"404 No document to update: {ref.path}")
+                if kind == "create" and current is not None:
+                    raise FakeServiceError(f"409 Document already exists: {ref.path}")
+                document = copy.deepcopy(current) if (merge or kind == "update") and current else {}
+                if kind == "update":
+                    for field, value in data.items():
+                        _set_path(document, field.split("."), value)
+                else:
+                    _merge(document, data, [])
+                staged[ref.path] = document
+            for path, document in staged.items():
+                if document is None:
+                    self._docs.pop(path, None)
+                else:
+                    self._docs[path] = document
+
+    def seed(self, path: str, data: dict) -> None:
+        """Writes a document without latency or call accounting."""
+        with self._lock:
+            self._docs[path] = copy.deepcopy(data)
+
+    def snapshot(self, path: str) -> DocumentSnapshot:
+        """Reads a document without latency or call accounting."""
+        return self._read(DocumentReference(self, path))
+
+    def peek(self, path: str) -> dict | None:
+        with self._lock:
+            return copy.deepcopy(self._docs.get(path))
+
+    def remove(self, path: str) -> None:
+        with self._lock:
+            self._docs.pop(path, None)
+
+    def clear(self, collection_path: str) -> None:
+        """Deletes every document directly under a collection."""
+        for ref, _ in self._children(collection_path):
+            self.remove(ref.path)
+
+
+_db = Client()
+
+
+def firestore_client(app=None) -> Client:
+    return _db
+
+
+# --- FCM ----------------------------------------------------------------------
+
+class Notification:
+    def __init__(self, title=None, body=None, image=None):
+        self.title, self.body, self.image = title, body, image
+
+
+class Message:
+    def __init__(self, notification=None, token=None, data=None, **kwargs):
+        self.notification, self.token, self.data = notification, token, data
+
+
+class SendResponse:
+    def __init__(self, message_id=None, exception=None):
+        self.message_id = message_id
+        self.exception = exception
+        self.success = exception is None
+
+
+class BatchResponse:
+    def __init__(self, responses: list):
+        self.responses = responses
+        self.success_count = sum(r.success for r in responses)
+        self.failure_count = len(responses) - self.success_count
+
+
+def fcm_send(message, dry_run=False, app=None) -> str:
+    profiles["fcm"].call("send")
+    return f"projects/fake/messages/{uuid.uuid4().hex[:12]}"
+
+
+def fcm_send_each(messages, dry_run=False, app=None) -> BatchResponse:
+    profiles["fcm"].call("send_each")
+    responses = []
+    for _ in messages:
+        calls.record("fcm", "message")
+        if profiles["fcm"]._random.random() < profiles["fcm"].error_rate:
+            responses.append(SendResponse(exception=FakeServiceError("Injected FCM delivery failure")))
+        else:
+            responses.append(SendResponse(message_id=f"projects/fake/messages/{uuid.uuid4().hex[:12]}"))
+    return BatchResponse(responses)
+
+
+# --- Maps ---------------------------------------------------------------------
+
+_PLACE_TYPES_BY_WORD = {
+    "hotel": ["lodging"], "hotels": ["lodging"], "restaurants": ["restaurant", "food"],
+    "cafes": ["cafe", "food"], "museums": ["museum"], "landmarks": ["tourist_attraction"],
+    "bars": ["bar"], "nightlife": ["night_club", "bar"], "shopping": ["shopping_mall"],
+    "markets": ["store"], "parks": ["park"], "viewpoints": ["tourist_attraction"],
+}
+PLACES_PER_SEARCH = 12
+# Each search draws from a pool per (city, type), so overlapping keywords share places.
+PLACE_POOL_SIZE = 40
+
+
+class MapsClient:
+    """Deterministic Maps responses; coordinates and places derive from the query text."""
+
+    _places = {}
+    _places_lock = threading.Lock()
+
+    def __init__(self, key=None, timeout=None, retry_timeout=None, **kwargs):
+        self.key = key
+
+    def geocode(self, address: str, **kwargs):
+        profiles["maps"].call("geocode")
+        seed = _stable_int("city", address.strip().lower())
+        lat = (seed % 12000) / 100 - 60
+        lng = (seed // 12000 % 36000) / 100 - 180
+        return [{"formatted_address": address, "geometry": {"location": {"lat": lat, "lng": lng}}}]
+
+    def _place(self, city_center: dict, place_type: str, index: int) -> dict:
+        seed = _stable_int(round(city_center["lat"], 3), round(city_center["lng"], 3), place_type, index)
+        return {
+            "place_id": f"fake-{seed:x}",
+            "name": f"{place_type.replace('_', ' ').title()} {index + 1}",
+            "rating": round(3.0 + (seed % 21) / 10, 1) if seed % 7 else None,
+            "geometry": {"location": {
+                "lat": city_center["lat"] + ((seed >> 4) % 2000 - 1000) / 10000,
+                "lng": city_center["lng"] + ((seed >> 16) % 2000 - 1000) / 10000,
+            }},
+            "types": [place_type, "point_of_interest", "establishment"],
+            "vicinity": f"{index + 1} Fake Street",
+            "photos": [{"photo_reference": f"photo-{seed:x}"}],
+        }
+
+    def places(self, query: str, location=None, radius=None, **kwargs):
+        profiles["maps"].call("places")
+        center = location or {"lat": 0.0, "lng": 0.0}
+        words = query.lower().split()
+        place_types = next((_PLACE_TYPES_BY_WORD[w] for w in words if w in _PLACE_TYPES_BY_WORD),
+                           ["tourist_attraction"])
+        start = _stable_int(query.lower()) % (PLACE_POOL_SIZE - PLACES_PER_SEARCH)
+        results = [self._place(center, place_types[0], index)
+                   for index in range(start, start + PLACES_PER_SEARCH)]
+        with self._places_lock:
+            self._places.update((place["place_id"], place) for place in results)
+        return {"results": copy.deepcopy(results), "status": "OK"}
+
+    def place(self, place_id: str, fields=None, **kwargs):
+        profiles["maps"].call("place")
+        with self._places_lock:
+            place = copy.deepcopy(self._places.get(place_id))
+        if place is None:
+            return {"result": {}, "status": "NOT_FOUND"}
+        return {"result": place, "status": "OK"}
+
+    def places_photo(self, photo_reference: str, max_width=None, max_height=None, **kwargs):
+        profiles["maps"].call("places_photo")
+        width = min(max_width or 1600, 1600)
+        height = min(max_height or 1600, width * 3 // 4)
+        return iter([_photo_bytes(photo_reference, width, height)])
+
+
+def _photo_bytes(photo_reference: str, width: int, height: int) -> bytes:
+    """A real JPEG when Pillow is installed, so the photo pipeline can decode it."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return random.Random(photo_reference).randbytes(IMAGE_BYTES)
+    seed = _stable_int(photo_reference)
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (seed % 256, seed // 256 % 256, seed // 65536 % 256)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+# --- Gemini -------------------------------------------------------------------
+
+_CANDIDATE_LINE = re.compile(r'\{"id":"(p\d+)","name":"((?:[^"\\]|\\.)*)"')
+
+
+class _Chunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class GenerateContentResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+def _answer(prompt: str) -> str:
+    """Produces a plausible JSON answer for the prompts the functions send."""
+    if '"search_keywords"' in prompt:
+        city = re.search(r"trip to ([^.\n]+)\.", prompt)
+        city = city.group(1).strip() if city else "the city"
+        return json.dumps({"search_keywords": [f"museums in {city}", f"restaurants in {city}",
+                                               f"hotels in {city}"]})
+    if '"correctOptionIndex"' in prompt:
+        listed = re.findall(r"^\s*\d+\. (.+)$", prompt, re.MULTILINE)
+        single = re.search(r'country is "([^"]+)"', prompt)
+        quizzes = [_quiz(country) for country in listed or [single.group(1) if single else "Japan"]]
+        return json.dumps(quizzes if listed else quizzes[0])
+    if '"rewrite": true' in prompt:
+        moved = re.findall(r'^\s*(\{"position": \d+.*"rewrite": true\})$', prompt, re.MULTILINE)
+        steps = [json.loads(line) for line in moved]
+        return json.dumps({"steps": [{"position": step["position"], "time": step["time"],
+                                      "activity_description": f"Later on, {step['activity_description'][0].lower()}"
+                                                              f"{step['activity_description'][1:]}"}
+                                     for step in steps]})
+    steps = []
+    for i, (short_id, escaped_name) in enumerate(_CANDIDATE_LINE.findall(prompt)[:5]):
+        name = json.loads(f'"{escaped_name}"')
+        steps.append({"id": short_id, "time": f"{3 + i}:00 PM", "place_name": name,
+                      "activity_description": f"Spend an unhurried hour at {name}."})
+    return json.dumps({"plan": steps, "estimated_total_cost": 1000 * (len(steps) + 20)})
+
+
+def _quiz(country: str) -> dict:
+    seed = _stable_int(country, time.time_ns())
+    return {
+        "question": f"Which dish is most closely associated with {country}? ({seed % 10000})",
+        "options": [f"Dish {seed % 97}a", f"Dish {seed % 89}b", f"Dish {seed % 83}c", f"Dish {seed % 79}d"],
+        "correctOptionIndex": seed % 4,
+        "explanation": f"It is a classic of {country}'s cuisine.",
+        "country": country,
+    }
+
+
+class GenerativeModel:
+    def __init__(self, model_name: str = "gemini", **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, prompt, stream: bool = False, **kwargs):
+        prompt_text = prompt if isinstance(prompt, str) else json.dumps(prompt, default=str)
+        profiles["gemini"].call("stream" if stream else "generate")
+        text = _answer(prompt_text)
+        if not stream:
+            return GenerateContentResponse(text)
+        return iter([_Chunk(text[i:i + 64]) for i in range(0, len(text), 64)])
+
+
+def genai_configure(api_key=None, **kwargs) -> None:
+    pass
+
+
+# --- Vision -------------------------------------------------------------------
+
+VISION_LABELS = ["food", "sushi", "ramen", "beach", "mountain", "temple", "museum", "night",
+                 "street", "architecture", "park", "coffee", "market", "art", "sky", "city"]
+
+
+class _Namespace:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class ImageAnnotatorClient:
+    def batch_annotate_images(self, requests=None, **kwargs):
+        profiles["vision"].call("batch_annotate")
+        responses = []
+        for request in requests or []:
+            calls.record("vision", "image")
+            uri = request.image.source.image_uri
+            seed = _stable_int(uri)
+            labels = [
+                _Namespace(description=VISION_LABELS[(seed >> (4 * i)) % len(VISION_LABELS)],
+                           score=0.6 + ((seed >> (3 * i)) % 40) / 100)
+                for i in range(5)
+            ]
+            responses.append(_Namespace(error=_Namespace(message=""), label_annotations=labels))
+        return _Namespace(responses=responses)
+
+
+# --- Secret Manager -----------------------------------------------------------
+
+class SecretManagerServiceClient:
+    def access_secret_version(self, request=None, name=None, **kwargs):
+        profiles["secretmanager"].call("access")
+        return _Namespace(payload=_Namespace(data=b"fake-secret"))
+
+
+# --- HTTP ---------------------------------------------------------------------
+
+IMAGE_BYTES = 64 * 1024
+
+
+class FakeHTTPHandler(urllib.request.BaseHandler):
+    """Answers every http(s) request with deterministic bytes derived from the URL."""
+
+    handler_order = 100
+
+    def _respond(self, request):
+        profiles["http"].call("get")
+        url = request.full_url
+        rng = random.Random(url)
+        body = rng.randbytes(IMAGE_BYTES)
+        headers = _Headers()
+        headers["Content-Type"] = "image/jpeg"
+        headers["Content-Length"] = str(len(body))
+        response = urllib.response.addinfourl(io.BytesIO(body), headers, url, 200)
+        response.msg = "OK"
+        return response
+
+    http_open = _respond
+    https_open = _respond
+
+
+# --- Module registration --------------------------------------------------------
+
+T = TypeVar("T")
+
+
+class Event(Generic[T]):
+    def __init__(self, data=None, params: dict | None = None, id: str | None = None):
+        self.data = data
+        self.params = params or {}
+        self.id = id or uuid.uuid4().hex
+
+
+class Change(Generic[T]):
+    def __init__(self, before=None, after=None):
+        self.before = before
+        self.after = after
+
+
+class ScheduledEvent:
+    def __init__(self, schedule_time=None, job_name="benchmark"):
+        self.schedule_time = schedule_time
+        self.job_name = job_name
+
+
+def _passthrough(*args, **kwargs):
+    return lambda func: func
+
+
+def _module(name: str, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install() -> Client:
+    """Registers the fakes in sys.modules and returns the fake Firestore client."""
+    firestore = _module(
+        "firebase_admin.firestore",
+        client=firestore_client, transactional=transactional, DocumentSnapshot=DocumentSnapshot,
+        Increment=Increment, ArrayUnion=ArrayUnion, ArrayRemove=ArrayRemove, Minimum=Minimum,
+        Maximum=Maximum, DELETE_FIELD=DELETE_FIELD, SERVER_TIMESTAMP=SERVER_TIMESTAMP,
+        Query=_Namespace(DESCENDING="DESCENDING", ASCENDING="ASCENDING"),
+    )
+    messaging = _module(
+        "firebase_admin.messaging",
+        Message=Message, Notification=Notification, send=fcm_send, send_each=fcm_send_each,
+    )
+    _module("firebase_admin", initialize_app=lambda *args, **kwargs: None,
+            firestore=firestore, messaging=messaging)
+
+    memory = _Namespace(MB_256="256MB", MB_512="512MB", GB_1="1GB", GB_2="2GB", GB_4="4GB")
+    _module("firebase_functions",
+            options=_module("firebase_functions.options",
+                            set_global_options=lambda **kwargs: None, MemoryOption=memory),
+            firestore_fn=_module("firebase_functions.firestore_fn",
+                                 on_document_created=_passthrough, on_document_updated=_passthrough,
+                                 on_document_deleted=_passthrough, on_document_written=_passthrough,
+                                 Event=Event, Change=Change, DocumentSnapshot=DocumentSnapshot),
+            scheduler_fn=_module("firebase_functions.scheduler_fn",
+                                 on_schedule=_passthrough, ScheduledEvent=ScheduledEvent))
+
+    _module("googlemaps", Client=MapsClient)
+
+    try:
+        import google
+    except ImportError:
+        google = _module("google", __path__=[])
+    generativeai = _module("google.generativeai", configure=genai_configure, GenerativeModel=GenerativeModel)
+    vision_type = _Namespace(LABEL_DETECTION="LABEL_DETECTION")
+    vision = _module(
+        "google.cloud.vision",
+        ImageAnnotatorClient=ImageAnnotatorClient,
+        AnnotateImageRequest=lambda image=None, features=None: _Namespace(image=image, features=features),
+        Image=lambda source=None, content=None: _Namespace(source=source, content=content),
+        ImageSource=lambda image_uri=None: _Namespace(image_uri=image_uri),
+        Feature=type("Feature", (), {"Type": vision_type,
+                                     "__init__": lambda self, type_=None: setattr(self, "type_", type_)}),
+    )
+    secretmanager = _module("google.cloud.secretmanager", SecretManagerServiceClient=SecretManagerServiceClient)
+    try:
+        import google.cloud as cloud
+    except ImportError:
+        cloud = _module("google.cloud", __path__=[])
+    cloud.vision = vision
+    cloud.secretmanager = secretmanager
+    google.generativeai = generativeai
+    google.cloud = cloud
+
+    generative_models = _module("vertexai.generative_models", GenerativeModel=GenerativeModel)
+    _module("vertexai", init=lambda **kwargs: None, generative_models=generative_models)
+
+    # Openers built after install() (e.g. label_cache's) get the fake handler too.
+    build_opener = urllib.request.build_opener
+    urllib.request.build_opener = lambda *handlers: build_opener(FakeHTTPHandler(), *handlers)
+    urllib.request.install_opener(urllib.request.build_opener())
+    return _db
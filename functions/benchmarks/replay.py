@@ -0,0 +1,413 @@
+# benchmarks/replay.py
+#
+# Offline load replay for the Cloud Functions handlers.
+#
+# Replays a recorded or synthetic event stream against the fakes in
+# benchmarks/fakes.py at a chosen concurrency and reports, per handler,
+# throughput, p50/p95/p99 latency and the external calls it made. Nothing
+# touches the network, so runs are comparable across changes.
+#
+# Usage (from the functions/ directory):
+#   python -m benchmarks.replay --count 200 --concurrency 8
+#   python -m benchmarks.replay --handlers generate_travel_plan --latency gemini=300 --errors maps=0.05
+#   python -m benchmarks.replay --record events.jsonl --count 500     # save the synthetic stream
+#   python -m benchmarks.replay --events events.jsonl --save baseline.json
+#   python -m benchmarks.replay --events events.jsonl --compare baseline.json --max-regression-pct 10
+#
+# Event streams are JSON lines: {"handler": ..., "at": seconds, ...} plus the
+# handler's fields (see the _run_* adapters). --paced honours "at"; otherwise
+# events are submitted as fast as the concurrency allows. Plans and posts are
+# guarded by the event ledger, so replaying a stream twice in one process
+# skips work that already completed, as it would in production.
+
+import argparse
+import contextvars
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks import fakes
+
+FUNCTIONS_DIR = Path(__file__).resolve().parent.parent
+REPLAY_BUCKET = "replay.firebasestorage.app"
+
+DEFAULT_MIX = {
+    "generate_travel_plan": 0.10,
+    "autoTagPost": 0.15,
+    "onPostInteraction": 0.25,
+    "onLikeCreated": 0.15,
+    "onPostSaved": 0.10,
+    "onPostUnsaved": 0.05,
+    "send_like_notifications": 0.15,
+    "generate_daily_quiz": 0.05,
+    "refresh_user_feeds": 0.02,
+    "fold_preference_deltas": 0.03,
+}
+
+CITIES = ["Tokyo", "Kyoto", "Osaka", "Kuala Lumpur", "Penang", "Bangkok", "Seoul", "Taipei"]
+PROMPTS = [
+    "food and museums, relaxed pace",
+    "nightlife and bars with friends",
+    "romantic anniversary trip with great views and dinner",
+    "shopping and local markets",
+    "parks, gardens and hiking",
+    "a quiet day of tea ceremonies and calligraphy",  # Needs the LLM fallback.
+]
+
+_modules = {}
+
+
+def _load_functions():
+    """Installs the fakes, then imports the function modules exactly as deployed."""
+    if _modules:
+        return _modules
+    os.environ.setdefault("Maps_API_KEY", "fake-maps-key")
+    os.environ.setdefault("GOOGLE_AI_API_KEY", "fake-ai-key")
+    os.environ.setdefault("PHOTO_STORE_BACKEND", "local")
+    os.environ.setdefault("PHOTO_LOCAL_DIR", tempfile.mkdtemp(prefix="replay-photos-"))
+    os.environ.setdefault("IMAGE_BUCKET", REPLAY_BUCKET)
+    db = fakes.install()
+    sys.path.insert(0, str(FUNCTIONS_DIR))
+
+    import instrumentation
+    instrumentation.set_exporter(instrumentation.MemoryExporter())
+    import main
+    import posts
+    import post_notifications
+    import quiz
+
+    _modules.update(db=db, main=main, feed_engine=sys.modules["feed_engine"], posts=posts, post_notifications=post_notifications,
+                    quiz=quiz, instrumentation=instrumentation)
+    return _modules
+
+
+# --- World and event stream ---------------------------------------------------
+
+def seed_world(db, users: int, posts: int, images: int, rng: random.Random) -> dict:
+    """Seeds users, tokens, posts and the tag taxonomy. Returns the ids used."""
+    labels = fakes.VISION_LABELS
+    db.seed("taxonomies/master_list", {
+        "cuisine": ["food", "sushi", "ramen", "coffee", "market"],
+        "culture": ["temple", "museum", "art", "architecture"],
+        "outdoors": ["beach", "mountain", "park", "sky"],
+        "urban": ["night", "street", "city"],
+    })
+    user_ids = [f"user{i}" for i in range(users)]
+    for user_id in user_ids:
+        db.seed(f"users/{user_id}", {"username": user_id, "preferences": {}})
+        db.seed(f"users_token/{user_id}", {"username": user_id, "fcmToken": f"token-{user_id}"})
+    image_urls = [f"https://firebasestorage.googleapis.com/v0/b/{REPLAY_BUCKET}/o/posts%2F{i}.jpg?alt=media"
+                  for i in range(images)]
+    post_ids = [f"post{i}" for i in range(posts)]
+    for post_id in post_ids:
+        db.seed(f"posts/{post_id}", {
+            "userId": rng.choice(user_ids),
+            "imageUrls": rng.sample(image_urls, k=min(3, len(image_urls))),
+            "AutoTags": sorted(rng.sample(labels, k=4)),
+            "likedBy": [],
+        })
+    return {"users": user_ids, "posts": post_ids, "images": image_urls}
+
+
+def synthetic_events(world: dict, count: int, mix: dict, rng: random.Random, rate_per_sec: float) -> list:
+    """Builds a reproducible event stream following the handler mix."""
+    handlers = list(mix)
+    weights = [mix[h] for h in handlers]
+    events = []
+    at = 0.0
+    for _ in range(count):
+        handler = rng.choices(handlers, weights)[0]
+        at += rng.expovariate(rate_per_sec)
+        event = {"handler": handler, "at": round(at, 3)}
+        user_id = rng.choice(world["users"])
+        post_id = rng.choice(world["posts"])
+        if handler == "generate_travel_plan":
+            event.update(params={"userId": user_id, "planId": uuid.UUID(int=rng.getrandbits(128)).hex},
+                         data={"request": rng.choice(PROMPTS), "city": rng.choice(CITIES),
+                               "fcmToken": f"token-{user_id}"})
+        elif handler == "autoTagPost":
+            event.update(params={"postId": f"new-{uuid.UUID(int=rng.getrandbits(128)).hex[:12]}"},
+                         data={"userId": user_id, "imageUrls": rng.sample(world["images"], k=rng.randint(1, 4))})
+        elif handler == "onPostInteraction":
+            before = rng.sample(world["users"], k=rng.randint(0, 5))
+            likers = [u for u in rng.sample(world["users"], k=rng.randint(1, 3)) if u not in before]
+            event.update(params={"postId": post_id},
+                         before={"likedBy": before}, after={"likedBy": before + likers})
+        elif handler in ("onPostSaved", "onPostUnsaved", "onLikeCreated"):
+            event.update(params={"userId": user_id, "postId": post_id})
+        elif handler == "send_like_notifications":
+            event.update(post_id=post_id, author_id=rng.choice(world["users"]),
+                         liker_ids=rng.sample(world["users"], k=rng.randint(1, 3)))
+        elif handler == "generate_daily_quiz":
+            event.update(restage=rng.random() < 0.3)
+        events.append(event)
+    return events
+
+
+# --- Handler adapters ---------------------------------------------------------
+
+def _run_generate_travel_plan(m, event):
+    path = f"travelRequests/{event['params']['userId']}/plans/{event['params']['planId']}"
+    m["db"].seed(path, {**event["data"], "status": "pending"})
+    m["main"].generate_travel_plan(fakes.Event(data=m["db"].snapshot(path), params=event["params"]))
+
+
+def _run_auto_tag_post(m, event):
+    path = f"posts/{event['params']['postId']}"
+    m["db"].seed(path, {**event["data"], "likedBy": []})
+    m["posts"].autoTagPost(fakes.Event(data=m["db"].snapshot(path), params=event["params"]))
+
+
+def _run_post_interaction(m, event):
+    path = f"posts/{event['params']['postId']}"
+    current = m["db"].peek(path) or {}
+    ref = m["db"].document(path)
+    change = fakes.Change(before=fakes.DocumentSnapshot(ref, {**current, **event["before"]}),
+                          after=fakes.DocumentSnapshot(ref, {**current, **event["after"]}))
+    m["posts"].onPostInteraction(fakes.Event(data=change, params=event["params"]))
+
+
+def _run_like_created(m, event):
+    path = f"posts/{event['params']['postId']}/likes/{event['params']['userId']}"
+    m["db"].seed(path, {"createdAt": time.time()})
+    m["posts"].onLikeCreated(fakes.Event(data=m["db"].snapshot(path), params=event["params"]))
+
+
+def _run_post_saved(m, event):
+    m["posts"].onPostSaved(fakes.Event(params=event["params"]))
+
+
+def _run_post_unsaved(m, event):
+    m["posts"].onPostUnsaved(fakes.Event(params=event["params"]))
+
+
+def _run_send_like_notifications(m, event):
+    m["post_notifications"].send_like_notifications(event["post_id"], event["author_id"], event["liker_ids"])
+
+
+def _run_generate_daily_quiz(m, event):
+    # Most runs find the week already staged; "restage" clears it to measure a generation run.
+    if event.get("restage"):
+        m["db"].clear("quizzes")
+    m["quiz"].generate_daily_quiz(fakes.ScheduledEvent())
+
+
+def _run_refresh_user_feeds(m, event):
+    m["feed_engine"].refresh_user_feeds(fakes.ScheduledEvent())
+
+
+def _run_fold_preference_deltas(m, event):
+    m["main"].fold_preference_deltas(fakes.ScheduledEvent())
+
+
+HANDLERS = {
+    "generate_travel_plan": _run_generate_travel_plan,
+    "autoTagPost": _run_auto_tag_post,
+    "onPostInteraction": _run_post_interaction,
+    "onLikeCreated": _run_like_created,
+    "onPostSaved": _run_post_saved,
+    "onPostUnsaved": _run_post_unsaved,
+    "send_like_notifications": _run_send_like_notifications,
+    "generate_daily_quiz": _run_generate_daily_quiz,
+    "refresh_user_feeds": _run_refresh_user_feeds,
+    "fold_preference_deltas": _run_fold_preference_deltas,
+}
+
+
+# --- Replay and report --------------------------------------------------------
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def replay(events: list, concurrency: int, paced: bool = False) -> dict:
+    """Runs the events and returns the per-handler report."""
+    m = _load_functions()
+    fakes.calls.reset()
+    results = []
+
+    def _run(event):
+        fakes.current_handler.set(event["handler"])
+        started = time.perf_counter()
+        error = None
+        try:
+            HANDLERS[event["handler"]](m, event)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        results.append((event["handler"], (time.perf_counter() - started) * 1000, error))
+
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for event in events:
+            if paced:
+                delay = event.get("at", 0) - (time.perf_counter() - wall_started)
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(contextvars.copy_context().run, _run, event))
+        for future in futures:
+            future.result()
+    wall_sec = time.perf_counter() - wall_started
+
+    calls = fakes.calls.snapshot()
+    spans = {}
+    for record in m["instrumentation"].get_exporter().records:
+        for name, span in record.get("spans", {}).items():
+            entry = spans.setdefault(record["run"], {}).setdefault(name, [0, 0.0])
+            entry[0] += span["count"]
+            entry[1] += span["total_ms"]
+    m["instrumentation"].get_exporter().records.clear()
+
+    handlers = {}
+    for handler in dict.fromkeys(h for h, _, _ in results):
+        latencies = sorted(ms for h, ms, _ in results if h == handler)
+        errors = [e for h, _, e in results if h == handler and e]
+        handler_calls = calls.get(handler, {})
+        handlers[handler] = {
+            "events": len(latencies),
+            "errors": len(errors),
+            "first_error": errors[0] if errors else None,
+            "throughput_per_sec": round(len(latencies) / wall_sec, 2),
+            "p50_ms": round(_percentile(latencies, 50), 1),
+            "p95_ms": round(_percentile(latencies, 95), 1),
+            "p99_ms": round(_percentile(latencies, 99), 1),
+            "mean_ms": round(statistics.fmean(latencies), 1),
+            "external_calls": dict(sorted(handler_calls.items())),
+            "external_calls_per_event": round(sum(handler_calls.values()) / len(latencies), 2),
+            "spans_ms": {name: round(total / len(latencies), 1)
+                         for name, (_, total) in sorted(spans.get(handler, {}).items())},
+        }
+    return {
+        "events": len(results),
+        "concurrency": concurrency,
+        "wall_sec": round(wall_sec, 2),
+        "throughput_per_sec": round(len(results) / wall_sec, 2),
+        "handlers": handlers,
+    }
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Percentage change of p50/p95/p99 and external calls per handler versus a baseline."""
+    deltas = {}
+    for handler, row in report["handlers"].items():
+        base = baseline.get("handlers", {}).get(handler)
+        if not base:
+            continue
+        deltas[handler] = {
+            key: round((row[key] - base[key]) / base[key] * 100, 1) if base[key] else None
+            for key in ("p50_ms", "p95_ms", "p99_ms", "external_calls_per_event")
+        }
+    return deltas
+
+
+def _key_values(pairs: list, option: str) -> dict:
+    values = {}
+    for pair in pairs or []:
+        key, _, value = pair.partition("=")
+        if not value:
+            raise SystemExit(f"{option} expects service=value, got '{pair}'")
+        values[key] = float(value)
+    return values
+
+
+def _print_report(report: dict) -> None:
+    print(f"{report['events']} events in {report['wall_sec']}s at concurrency {report['concurrency']} "
+          f"({report['throughput_per_sec']}/s)")
+    print(f"{'handler':<26} {'events':>6} {'errors':>6} {'per sec':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'calls/ev':>8}")
+    for handler, row in report["handlers"].items():
+        print(f"{handler:<26} {row['events']:>6} {row['errors']:>6} {row['throughput_per_sec']:>8} "
+              f"{row['p50_ms']:>7.1f}ms {row['p95_ms']:>7.1f}ms {row['p99_ms']:>7.1f}ms "
+              f"{row['external_calls_per_event']:>8}")
+        print(f"    calls: {', '.join(f'{k}={v}' for k, v in row['external_calls'].items()) or 'none'}")
+        if row["first_error"]:
+            print(f"    first error: {row['first_error']}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline load replay for the Cloud Functions handlers.")
+    parser.add_argument("--events", help="JSONL event stream to replay. Synthetic if omitted.")
+    parser.add_argument("--record", help="Write the synthetic event stream to this JSONL file.")
+    parser.add_argument("--count", type=int, default=200, help="Synthetic events to generate.")
+    parser.add_argument("--rate", type=float, default=20.0, help="Synthetic arrival rate (events/sec) for --paced.")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--handlers", help="Comma-separated handlers to include.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--paced", action="store_true", help="Submit events at their recorded 'at' offsets.")
+    parser.add_argument("--latency", action="append", metavar="SERVICE=MS", help="Mean latency override.")
+    parser.add_argument("--jitter", action="append", metavar="SERVICE=MS", help="Latency jitter override.")
+    parser.add_argument("--errors", action="append", metavar="SERVICE=RATE", help="Injected error rate.")
+    parser.add_argument("--quota-errors", action="append", metavar="SERVICE=RATE", help="Injected 429 rate.")
+    parser.add_argument("--no-latency", action="store_true", help="Zero latency for every service.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    parser.add_argument("--save", help="Write the report to this file (e.g. as a baseline).")
+    parser.add_argument("--compare", help="Baseline report to compare against.")
+    parser.add_argument("--max-regression-pct", type=float,
+                        help="With --compare, exit 1 if any handler's p95 grew by more than this.")
+    parser.add_argument("--verbose", action="store_true", help="Show the functions' own logging.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    if args.no_latency:
+        fakes.configure(latency={s: 0 for s in fakes.profiles}, jitter={s: 0 for s in fakes.profiles})
+    fakes.configure(latency=_key_values(args.latency, "--latency"),
+                    jitter=_key_values(args.jitter, "--jitter"),
+                    errors=_key_values(args.errors, "--errors"),
+                    quota_errors=_key_values(args.quota_errors, "--quota-errors"))
+
+    rng = random.Random(args.seed)
+    m = _load_functions()
+    world = seed_world(m["db"], users=200, posts=300, images=120, rng=rng)
+
+    if args.events:
+        with open(args.events, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = synthetic_events(world, args.count, DEFAULT_MIX, rng, args.rate)
+    if args.handlers:
+        wanted = set(args.handlers.split(","))
+        unknown = wanted - set(HANDLERS)
+        if unknown:
+            raise SystemExit(f"Unknown handler(s): {', '.join(sorted(unknown))}")
+        events = [e for e in events if e["handler"] in wanted]
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(e) + "\n" for e in events)
+
+    report = replay(events, args.concurrency, args.paced)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
+    if args.save:
+        Path(args.save).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    if args.compare:
+        deltas = compare(report, json.loads(Path(args.compare).read_text(encoding="utf-8")))
+        print("Change vs baseline (%):")
+        for handler, row in deltas.items():
+            print(f"    {handler:<26} " + "  ".join(f"{k}={v:+}" if v is not None else f"{k}=n/a"
+                                                    for k, v in row.items()))
+        if args.max_regression_pct is not None:
+            regressed = {h: d["p95_ms"] for h, d in deltas.items()
+                         if d["p95_ms"] is not None and d["p95_ms"] > args.max_regression_pct}
+            if regressed:
+                print(f"p95 regression over {args.max_regression_pct}%: {regressed}", file=sys.stderr)
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+# benchmarks/startup.py
+#
+# Measures cold-start cost per deployed entry point.
+#
+# Every Cloud Functions instance imports main.py (module load) and then, on its
+# first invocation, whatever its trigger imports lazily (first-use init). Each
+# measurement runs in a fresh interpreter so nothing is served from a warm
+# module cache.
+#
+# Usage (from the functions/ directory):
+#   python -m benchmarks.startup
+#   python -m benchmarks.startup --runs 5 --json
+#   python -m benchmarks.startup --max-total-ms 1500   # exits 1 on regression
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+FUNCTIONS_DIR = Path(__file__).resolve().parent.parent
+
+# Modules each entry point imports lazily on its first invocation.
+# Keep in sync with the in-function imports of the trigger modules.
+ENTRY_POINTS = {
+    "generate_travel_plan": [
+        "google.cloud.secretmanager", "googlemaps", "google.generativeai", "route_optimizer",
+        "firebase_admin.storage",
+    ],
+    "autoTagPost": ["google.cloud.vision"],
+    "onPostInteraction": [],
+    "onPostSaved": [],
+    "onPostUnsaved": [],
+    "onPostDeleted": [],
+    "onLikeCreated": [],
+    "onLikeDeleted": [],
+    "flush_like_digests": [],
+    "refresh_user_feeds": [],
+    "fold_preference_deltas": [],
+    "generate_daily_quiz": ["vertexai", "vertexai.generative_models"],
+    "drain_plan_queue": [
+        "google.cloud.secretmanager", "googlemaps", "google.generativeai", "route_optimizer",
+        "firebase_admin.storage",
+    ],
+}
+
+_PROBE = r"""
+import importlib, json, sys, time
+sys.path.insert(0, {functions_dir!r})
+timings = {{}}
+start = time.perf_counter()
+import main
+timings["module_load_ms"] = (time.perf_counter() - start) * 1000
+for name in {modules!r}:
+    start = time.perf_counter()
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        timings[name] = None
+        continue
+    timings[name] = (time.perf_counter() - start) * 1000
+print(json.dumps(timings))
+"""
+
+
+def _probe(modules: list) -> dict:
+    """Runs one fresh interpreter and returns its timings in milliseconds."""
+    code = _PROBE.format(functions_dir=str(FUNCTIONS_DIR), modules=modules)
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=FUNCTIONS_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure(runs: int) -> dict:
+    """Returns median timings per entry point over `runs` fresh interpreters."""
+    report = {}
+    for entry_point, modules in ENTRY_POINTS.items():
+        samples = [_probe(modules) for _ in range(runs)]
+        module_load = statistics.median(s["module_load_ms"] for s in samples)
+        first_use = {}
+        for name in modules:
+            values = [s[name] for s in samples if s[name] is not None]
+            first_use[name] = statistics.median(values) if values else None
+        report[entry_point] = {
+            "module_load_ms": round(module_load, 1),
+            "first_use_ms": {k: (round(v, 1) if v is not None else None) for k, v in first_use.items()},
+            "total_ms": round(module_load + sum(v for v in first_use.values() if v), 1),
+        }
+    return report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for Cloud Functions entry points.")
+    parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters per entry point.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    parser.add_argument("--max-total-ms", type=float, help="Fail if any entry point exceeds this total.")
+    args = parser.parse_args()
+
+    report = measure(args.runs)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'entry point':<24} {'module load':>12} {'first use':>12} {'total':>10}")
+        for entry_point, row in report.items():
+            first_use = sum(v for v in row["first_use_ms"].values() if v)
+            print(f"{entry_point:<24} {row['module_load_ms']:>10.1f}ms {first_use:>10.1f}ms {row['total_ms']:>8.1f}ms")
+            for name, value in row["first_use_ms"].items():
+                shown = "not installed" if value is None else f"{value:.1f}ms"
+                print(f"    {name:<36} {shown}")
+
+    if args.max_total_ms is not None:
+        slow = {k: v["total_ms"] for k, v in report.items() if v["total_ms"] > args.max_total_ms}
+        if slow:
+            print(f"Cold-start budget of {args.max_total_ms}ms exceeded: {slow}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
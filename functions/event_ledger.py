@@ -0,0 +1,115 @@
+# event_ledger.py
+
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+
+LEDGER_COLLECTION = "eventLedger"
+# Longer than the function timeout, so a live run never loses its lease.
+DEFAULT_LEASE_SEC = 150
+# Ledger documents carry an "expiresAt" timestamp this far past their last
+# claim, and a Firestore TTL policy on that field (firestore.indexes.json)
+# deletes them. Longer than the 7 days Cloud Functions retries an event.
+LEDGER_RETENTION_SEC = float(os.environ.get("EVENT_LEDGER_RETENTION_DAYS", "8")) * 24 * 3600
+
+
+class LedgerEntry:
+    """
+    A claimed unit of work. Stage results are persisted as they complete, so
+    a redelivered event resumes after the last finished stage.
+    """
+
+    def __init__(self, doc_ref, owner: str, lease_sec: float, stages: dict):
+        self.doc_ref = doc_ref
+        self.owner = owner
+        self.lease_sec = lease_sec
+        self._stages = stages
+
+    def stage(self, name: str, func):
+        """Returns the recorded result of `name`, or runs func() and records it."""
+        if name in self._stages:
+            logging.info(f"⏭️ Stage '{name}' already completed. Reusing its result.")
+            return json.loads(self._stages[name])
+        result = func()
+        encoded = json.dumps(result)
+        self.doc_ref.update({
+            f"stages.{name}": encoded,
+            "leaseExpiresAt": time.time() + self.lease_sec,
+        })
+        self._stages[name] = encoded
+        return result
+
+    def complete(self) -> None:
+        self.doc_ref.update({"status": "completed", "completedAt": time.time(), "leaseOwner": None})
+
+    def fail(self, error: Exception) -> None:
+        """Releases the lease; finished stages are kept for the next delivery."""
+        try:
+            self.doc_ref.update({"status": "failed", "lastError": str(error), "leaseOwner": None,
+                                 "leaseExpiresAt": 0})
+        except Exception as e:
+            logging.warning(f"Could not release ledger lease: {e}")
+
+
+@firestore.transactional
+def _claim(transaction, doc_ref, owner: str, event_id: str, work_key: str, lease_sec: float):
+    snapshot = doc_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    now = time.time()
+
+    if data.get("status") == "completed":
+        return None, "completed"
+    if data.get("leaseOwner") and data.get("leaseExpiresAt", 0) > now:
+        return None, "leased"
+
+    transaction.set(doc_ref, {
+        "work": work_key,
+        "status": "running",
+        "leaseOwner": owner,
+        "leaseExpiresAt": now + lease_sec,
+        "attempts": data.get("attempts", 0) + 1,
+        "eventIds": firestore.ArrayUnion([event_id]),
+        "expiresAt": datetime.now(timezone.utc) + timedelta(seconds=LEDGER_RETENTION_SEC),
+    }, merge=True)
+    return data.get("stages", {}), "claimed"
+
+
+def claim(function_name: str, document_path: str, event_id: str,
+          lease_sec: float = DEFAULT_LEASE_SEC) -> LedgerEntry | None:
+    """
+    Claims the work for (function, document) with a transactional lease.
+
+    Returns None when the work already completed or another delivery holds a
+    live lease, in which case the caller should exit without side effects.
+    If the ledger itself is unavailable, the work runs unguarded.
+    """
+    work_key = f"{function_name}:{document_path}"
+    doc_ref = firestore.client().collection(LEDGER_COLLECTION).document(
+        hashlib.sha256(work_key.encode("utf-8")).hexdigest()
+    )
+    owner = f"{event_id}:{uuid.uuid4().hex}"
+    try:
+        stages, outcome = _claim(firestore.client().transaction(), doc_ref, owner, event_id, work_key, lease_sec)
+    except Exception as e:
+        logging.warning(f"Event ledger unavailable for {work_key}, running without it: {e}")
+        return LedgerEntry(_NullRef(), owner, lease_sec, {})
+
+    if outcome != "claimed":
+        logging.info(f"🔁 Duplicate delivery of event {event_id} for {work_key} ({outcome}). Skipping.")
+        return None
+    if stages:
+        logging.info(f"♻️ Resuming {work_key} after stages: {', '.join(stages)}.")
+    return LedgerEntry(doc_ref, owner, lease_sec, dict(stages))
+
+
+class _NullRef:
+    """Stands in for the ledger document when Firestore can't be reached."""
+
+    def update(self, fields: dict) -> None:
+        pass
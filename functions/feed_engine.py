@@ -0,0 +1,224 @@
+# feed_engine.py
+
+import heapq
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import firestore
+from firebase_functions import scheduler_fn
+
+import instrumentation
+
+TAG_INDEX_COLLECTION = "tagIndex"
+# Postings live at tagIndex/{tag}/posts/{postId}, one small document each, so
+# popular tags neither grow a single document nor make it a write hotspot.
+POSTINGS_SUBCOLLECTION = "posts"
+USER_FEEDS_COLLECTION = "userFeeds"
+FEED_STATE_DOC = "feedMeta/state"
+# Posts kept per feed document.
+FEED_SIZE = int(os.environ.get("FEED_SIZE", "50"))
+# Only a user's strongest tags are used to gather candidates.
+FEED_TOP_TAGS = int(os.environ.get("FEED_TOP_TAGS", "20"))
+# Most recent posts considered per tag.
+FEED_POSTS_PER_TAG = int(os.environ.get("FEED_POSTS_PER_TAG", "300"))
+# A post's score halves every this many days.
+FEED_HALF_LIFE_DAYS = float(os.environ.get("FEED_HALF_LIFE_DAYS", "7"))
+# Changed users refreshed per scheduled run; the rest wait for the next run.
+FEED_MAX_USERS_PER_RUN = int(os.environ.get("FEED_MAX_USERS_PER_RUN", "500"))
+MAX_POSTING_QUERIES = 8
+
+
+def _epoch(value) -> float:
+    """Firestore timestamps arrive as datetimes; the index stores epoch seconds."""
+    if hasattr(value, "timestamp"):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    return time.time()
+
+
+def _postings(db, tag: str):
+    return db.collection(TAG_INDEX_COLLECTION).document(tag).collection(POSTINGS_SUBCOLLECTION)
+
+
+def _is_document_id(tag) -> bool:
+    """Whether a tag can be used as a Firestore document ID."""
+    return (isinstance(tag, str) and 0 < len(tag.encode("utf-8")) <= 1500 and "/" not in tag
+            and tag not in (".", "..") and not (tag.startswith("__") and tag.endswith("__")))
+
+
+def _indexable(post_id: str, tags) -> list:
+    valid = [tag for tag in dict.fromkeys(tags or []) if _is_document_id(tag)]
+    if len(valid) < len(tags or []):
+        logging.warning(f"Skipping tags of post {post_id} that aren't valid document IDs.")
+    return valid
+
+
+def index_post(post_id: str, tags: list, author_id: str | None, created_at=None) -> None:
+    """
+    Adds a tagIndex/{tag}/posts/{postId} posting for each of the post's tags.
+
+    Each posting carries what scoring needs (created time, tag count,
+    author), so feeds are built without reading post documents.
+    """
+    valid_tags = _indexable(post_id, tags)
+    if not valid_tags:
+        return
+    entry = {"t": _epoch(created_at), "n": len(tags), "a": author_id}
+    try:
+        db = firestore.client()
+        batch = db.batch()
+        for tag in valid_tags:
+            batch.set(_postings(db, tag).document(post_id), entry)
+        batch.commit()
+        logging.info(f"Indexed post {post_id} under {len(valid_tags)} tag(s).")
+    except Exception as e:
+        logging.error(f"Failed to index post {post_id}: {e}")
+
+
+def unindex_post(post_id: str, tags: list) -> None:
+    """Removes the post's tagIndex/{tag}/posts/{postId} postings, so it leaves feeds on their next refresh."""
+    valid_tags = _indexable(post_id, tags)
+    if not valid_tags:
+        return
+    db = firestore.client()
+    batch = db.batch()
+    for tag in valid_tags:
+        batch.delete(_postings(db, tag).document(post_id))
+    batch.commit()
+    logging.info(f"Removed post {post_id} from {len(valid_tags)} tag(s).")
+
+
+def preference_vector(preferences: dict) -> dict:
+    """
+    Sparse, L2-normalized {tag: weight} from the nested
+    preferences.{category}.{tag} scores. Non-positive scores are dropped.
+    """
+    weights = {}
+    for tags in (preferences or {}).values():
+        if not isinstance(tags, dict):
+            continue
+        for tag, score in tags.items():
+            if isinstance(score, (int, float)):
+                weights[tag] = weights.get(tag, 0) + score
+    weights = {tag: w for tag, w in weights.items() if w > 0}
+    norm = math.sqrt(sum(w * w for w in weights.values()))
+    return {tag: w / norm for tag, w in weights.items()} if norm else {}
+
+
+def score_posts(vector: dict, tag_postings: dict, user_id: str, now: float) -> list:
+    """
+    Top FEED_SIZE (post_id, score) pairs for a preference vector.
+
+    Score is the cosine between the user vector and the post's binary tag
+    vector, decayed by post age. Only postings of the user's tags are
+    visited, so the cost doesn't depend on the total number of posts.
+    """
+    dots = {}
+    entries = {}
+    for tag, weight in vector.items():
+        for post_id, entry in tag_postings.get(tag, {}).items():
+            if entry.get("a") == user_id:
+                continue
+            dots[post_id] = dots.get(post_id, 0.0) + weight
+            entries[post_id] = entry
+
+    decay_sec = FEED_HALF_LIFE_DAYS * 24 * 3600
+    scored = []
+    for post_id, dot in dots.items():
+        entry = entries[post_id]
+        cosine = dot / math.sqrt(max(entry.get("n", 1), 1))
+        age = max(now - entry.get("t", now), 0.0)
+        scored.append((cosine * 0.5 ** (age / decay_sec), post_id))
+    return [(post_id, round(score, 6)) for score, post_id in heapq.nlargest(FEED_SIZE, scored)]
+
+
+class _TagPostings:
+    """Loads tag postings on demand and keeps them for the rest of a run."""
+
+    def __init__(self, db):
+        self._db = db
+        self._postings = {}
+
+    def _newest(self, tag: str) -> dict:
+        # Newest first, capped, so hot tags don't dominate the run.
+        query = (_postings(self._db, tag)
+                 .order_by("t", direction=firestore.Query.DESCENDING)
+                 .limit(FEED_POSTS_PER_TAG))
+        return {doc.id: doc.to_dict() for doc in query.stream()}
+
+    def load(self, tags) -> dict:
+        missing = [tag for tag in tags if tag not in self._postings]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(MAX_POSTING_QUERIES, len(missing))) as executor:
+                for tag, postings in zip(missing, executor.map(self._newest, missing)):
+                    self._postings[tag] = postings
+            instrumentation.count("feed.tag_queries", len(missing))
+        return self._postings
+
+
+def refresh_feeds(max_users: int = FEED_MAX_USERS_PER_RUN) -> int:
+    """
+    Rebuilds the feed of every user whose preferences changed since the last
+    run (preferencesUpdatedAt after the stored watermark). Returns the number
+    of feeds written.
+    """
+    db = firestore.client()
+    state_ref = db.document(FEED_STATE_DOC)
+    state = state_ref.get()
+    watermark = (state.to_dict() or {}).get("watermark") if state.exists else None
+
+    query = db.collection("users")
+    if watermark is not None:
+        query = query.where("preferencesUpdatedAt", ">", watermark)
+    changed = list(query.order_by("preferencesUpdatedAt").limit(max_users).stream())
+    if not changed:
+        logging.info("No preference changes since the last feed refresh.")
+        return 0
+    if len(changed) == max_users:
+        # Users flushed together share a timestamp. Don't cut that group in
+        # half, or the watermark would skip its remaining users.
+        last = changed[-1].get("preferencesUpdatedAt")
+        earlier = [doc for doc in changed if doc.get("preferencesUpdatedAt") != last]
+        if earlier:
+            changed = earlier
+        else:
+            changed = list(db.collection("users").where("preferencesUpdatedAt", "==", last).stream())
+
+    postings = _TagPostings(db)
+    now = time.time()
+    batch = db.batch()
+    pending = 0
+    written = 0
+    for user_doc in changed:
+        vector = preference_vector((user_doc.to_dict() or {}).get("preferences") or {})
+        top_tags = dict(heapq.nlargest(FEED_TOP_TAGS, vector.items(), key=lambda item: item[1]))
+        ranked = score_posts(top_tags, postings.load(top_tags), user_doc.id, now)
+        batch.set(db.collection(USER_FEEDS_COLLECTION).document(user_doc.id), {
+            "posts": [{"postId": post_id, "score": score} for post_id, score in ranked],
+            "builtAt": firestore.SERVER_TIMESTAMP,
+        })
+        pending += 1
+        if pending == 500:
+            batch.commit()
+            written += pending
+            batch = db.batch()
+            pending = 0
+
+    # The watermark only moves once the feeds before it are written.
+    batch.set(state_ref, {"watermark": changed[-1].get("preferencesUpdatedAt")}, merge=True)
+    batch.commit()
+    written += pending
+    instrumentation.count("feed.feeds_written", written)
+    logging.info(f"📰 Refreshed {written} feed(s).")
+    return written
+
+
+@scheduler_fn.on_schedule(schedule="every 10 minutes")
+@instrumentation.instrumented()
+def refresh_user_feeds(event: scheduler_fn.ScheduledEvent) -> None:
+    """Materializes userFeeds/{userId} for users whose preferences changed."""
+    refresh_feeds()
@@ -0,0 +1,172 @@
+# instrumentation.py
+
+import contextvars
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# "json" writes one structured log line per run to stdout (picked up by Cloud
+# Logging), "memory" keeps records in-process for offline runs, "none" drops them.
+INSTRUMENTATION_EXPORTER = os.environ.get("INSTRUMENTATION_EXPORTER", "json")
+
+_current = contextvars.ContextVar("instrumentation_run", default=None)
+
+
+class Run:
+    """
+    Timing spans and counters for one function invocation.
+
+    Spans with the same name are aggregated (count, total and max), so a
+    stage that makes many calls stays a single entry in the summary.
+    """
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.error = None
+        self._started = time.perf_counter()
+        self._duration_ms = None
+        self._spans = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, duration_ms: float) -> None:
+        with self._lock:
+            span = self._spans.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            span["count"] += 1
+            span["total_ms"] += duration_ms
+            span["max_ms"] = max(span["max_ms"], duration_ms)
+
+    def add_count(self, name: str, amount: float) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def finish(self) -> None:
+        self._duration_ms = (time.perf_counter() - self._started) * 1000
+
+    def summary(self) -> dict:
+        """Snapshot of the run; can be taken before the run finishes."""
+        with self._lock:
+            duration_ms = self._duration_ms
+            if duration_ms is None:
+                duration_ms = (time.perf_counter() - self._started) * 1000
+            return {
+                "run": self.name,
+                **self.attrs,
+                "duration_ms": round(duration_ms, 1),
+                "error": self.error,
+                "spans": {
+                    name: {"count": s["count"], "total_ms": round(s["total_ms"], 1), "max_ms": round(s["max_ms"], 1)}
+                    for name, s in self._spans.items()
+                },
+                "counters": dict(self._counters),
+            }
+
+
+class JsonLogExporter:
+    """Writes each run as a single JSON line that Cloud Logging parses as a structured entry."""
+
+    def export(self, record: dict) -> None:
+        entry = {"severity": "ERROR" if record.get("error") else "INFO",
+                 "message": f"metrics {record['run']}", "metrics": record}
+        sys.stdout.write(json.dumps(entry, default=str) + "\n")
+        sys.stdout.flush()
+
+
+class MemoryExporter:
+    """Keeps records in memory, for benchmarks and local runs."""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def export(self, record: dict) -> None:
+        with self._lock:
+            self.records.append(record)
+
+
+class NullExporter:
+    def export(self, record: dict) -> None:
+        pass
+
+
+_EXPORTERS = {"json": JsonLogExporter, "memory": MemoryExporter, "none": NullExporter}
+_exporter = _EXPORTERS.get(INSTRUMENTATION_EXPORTER, JsonLogExporter)()
+
+
+def set_exporter(exporter) -> None:
+    """Replaces the exporter. Anything with an export(record: dict) method works."""
+    global _exporter
+    _exporter = exporter
+
+
+def get_exporter():
+    return _exporter
+
+
+@contextmanager
+def run(name: str, **attrs):
+    """Records spans and counters for one invocation and exports them at the end."""
+    recorder = Run(name, attrs)
+    token = _current.set(recorder)
+    try:
+        yield recorder
+    except Exception as e:
+        recorder.error = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        recorder.finish()
+        try:
+            _exporter.export(recorder.summary())
+        except Exception as e:
+            logging.warning(f"Could not export metrics for {name}: {e}")
+
+
+def instrumented(name: str | None = None):
+    """Decorator form of run() for trigger functions; goes under the trigger decorator."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with run(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def span(name: str):
+    """Times a block into the current run. A no-op outside of a run."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder = _current.get()
+        if recorder is not None:
+            recorder.add_span(name, (time.perf_counter() - started) * 1000)
+
+
+def count(name: str, amount: float = 1) -> None:
+    """Adds to a counter on the current run. A no-op outside of a run."""
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.add_count(name, amount)
+
+
+def current() -> Run | None:
+    return _current.get()
+
+
+def bind(func):
+    """
+    Wraps func to run in a copy of the caller's context, so spans and
+    counters from worker threads land on the caller's run. Bind once per
+    submitted task; a bound function must not run on two threads at once.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
@@ -0,0 +1,144 @@
+# keyword_extractor.py
+
+import logging
+import os
+import re
+
+from maps_cache import FirestoreCache, LRUCache
+
+# Share of meaningful request words that must map to a known intent before
+# the local keywords are trusted without asking the LLM.
+MIN_CONFIDENCE = float(os.environ.get("KEYWORD_MIN_CONFIDENCE", "0.5"))
+MAX_KEYWORDS = 5
+DECONSTRUCTION_TTL_SEC = 7 * 24 * 3600
+
+# intent -> (trigger words, Maps search keyword templates)
+INTENT_TEMPLATES = {
+    "food": (
+        {"food", "eat", "eating", "restaurant", "restaurants", "dinner", "lunch", "breakfast",
+         "brunch", "cuisine", "foodie", "gourmet", "sushi", "ramen", "cafe", "cafes", "coffee",
+         "dessert"},
+        ["highly-rated local restaurants in {city}", "popular cafes in {city}"],
+    ),
+    "museums": (
+        {"museum", "museums", "art", "arts", "gallery", "galleries", "history", "historical",
+         "historic", "culture", "cultural", "exhibition", "heritage", "temple", "temples"},
+        ["museums in {city}", "historical landmarks in {city}"],
+    ),
+    "nightlife": (
+        {"nightlife", "night", "bar", "bars", "club", "clubs", "drinks", "drink", "party",
+         "pub", "pubs", "cocktail", "cocktails"},
+        ["best bars in {city}", "nightlife spots in {city}"],
+    ),
+    "shopping": (
+        {"shopping", "shop", "shops", "market", "markets", "mall", "malls", "boutique",
+         "boutiques", "souvenir", "souvenirs", "fashion"},
+        ["shopping districts in {city}", "local markets in {city}"],
+    ),
+    "nature": (
+        {"nature", "park", "parks", "hike", "hiking", "garden", "gardens", "beach", "beaches",
+         "mountain", "mountains", "outdoor", "outdoors", "scenic", "view", "views", "lake"},
+        ["parks and gardens in {city}", "scenic viewpoints in {city}"],
+    ),
+    "hotels": (
+        {"hotel", "hotels", "stay", "accommodation", "ryokan", "hostel", "resort", "lodging"},
+        ["hotels in {city}"],
+    ),
+}
+
+# intent -> Places types served by that intent's searches.
+INTENT_PLACE_TYPES = {
+    "food": {"restaurant", "cafe", "bakery"},
+    "museums": {"museum", "art_gallery", "tourist_attraction"},
+    "nightlife": {"bar", "night_club"},
+    "shopping": {"shopping_mall", "store", "clothing_store"},
+    "nature": {"park", "natural_feature"},
+    "hotels": {"lodging"},
+}
+
+_STOPWORDS = {
+    "a", "an", "and", "the", "to", "in", "of", "for", "with", "on", "at", "my", "our", "we",
+    "i", "me", "us", "want", "would", "like", "love", "some", "go", "visit", "see", "trip",
+    "day", "days", "plan", "good", "best", "nice", "great", "place", "places", "spot", "spots",
+    "around", "near", "please", "also", "then", "do", "is", "are", "be", "it", "that", "this",
+}
+
+_memo_local = LRUCache(max_entries=1000)
+_memo_shared = FirestoreCache(collection="keywordCache")
+
+
+def normalize_request(user_prompt: str, city: str) -> str:
+    """Order-insensitive cache key: city plus the request's meaningful words."""
+    words = sorted(set(re.findall(r"[a-z0-9']+", user_prompt.lower())) - _STOPWORDS)
+    return f"{city.strip().lower()}|{' '.join(words)}"
+
+
+def extract_keywords(user_prompt: str, city: str) -> tuple[list, float]:
+    """
+    Maps the request to intent keyword templates locally.
+
+    Returns (keywords, confidence), where confidence is the share of
+    meaningful words covered by a known intent.
+    """
+    words = [w for w in re.findall(r"[a-z0-9']+", user_prompt.lower()) if w not in _STOPWORDS]
+    if not words:
+        return [], 0.0
+
+    matched_intents = []
+    covered = 0
+    for word in words:
+        hit = False
+        for intent, (triggers, _) in INTENT_TEMPLATES.items():
+            if word in triggers:
+                hit = True
+                if intent not in matched_intents:
+                    matched_intents.append(intent)
+        covered += hit
+
+    keywords = []
+    for intent in matched_intents:
+        keywords.extend(t.format(city=city) for t in INTENT_TEMPLATES[intent][1])
+    # Every plan starts at a hotel, so always search for one.
+    hotel_keyword = INTENT_TEMPLATES["hotels"][1][0].format(city=city)
+    keywords = [k for k in keywords if k != hotel_keyword][:MAX_KEYWORDS - 1] + [hotel_keyword]
+    return keywords, covered / len(words)
+
+
+def keyword_place_types(keyword: str) -> set:
+    """Places types a search keyword is looking for, based on its intent words."""
+    words = set(re.findall(r"[a-z0-9']+", keyword.lower()))
+    place_types = set()
+    for intent, (triggers, _) in INTENT_TEMPLATES.items():
+        if words & triggers:
+            place_types |= INTENT_PLACE_TYPES[intent]
+    return place_types
+
+
+def get_search_keywords(user_prompt: str, city: str, llm_deconstruct) -> list:
+    """
+    Returns Maps search keywords for a request.
+
+    Order: the local extractor if confident, then a memoized LLM result for
+    the normalized request, then `llm_deconstruct()` (result memoized).
+    """
+    keywords, confidence = extract_keywords(user_prompt, city)
+    if keywords and confidence >= MIN_CONFIDENCE:
+        logging.info(f"⚡ Local keyword extraction (confidence {confidence:.2f}).")
+        return keywords
+
+    key = f"keywords:{normalize_request(user_prompt, city)}"
+    cached = _memo_local.get(key)
+    if cached is None:
+        cached = _memo_shared.get(key)
+        if cached is not None:
+            _memo_local.set(key, cached, DECONSTRUCTION_TTL_SEC)
+    if cached:
+        logging.info("🔁 Reusing memoized keyword deconstruction.")
+        return cached
+
+    logging.info(f"🤖 Local keyword confidence {confidence:.2f} too low. Asking the LLM.")
+    keywords = llm_deconstruct()
+    if keywords:
+        _memo_local.set(key, keywords, DECONSTRUCTION_TTL_SEC)
+        _memo_shared.set(key, keywords, DECONSTRUCTION_TTL_SEC, "keywords")
+    return keywords
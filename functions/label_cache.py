@@ -0,0 +1,255 @@
+# label_cache.py
+
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+
+try:
+    from PIL import Image
+except ImportError:  # Perceptual hashing is optional; byte hashes still work.
+    Image = None
+
+LABEL_CACHE_COLLECTION = "imageLabels"
+LABEL_CACHE_TTL_DAYS = int(os.environ.get("LABEL_CACHE_TTL_DAYS", "30"))
+# "firestore" shares entries across instances; "memory" keeps them in process (local runs).
+LABEL_CACHE_BACKEND = os.environ.get("LABEL_CACHE_BACKEND", "firestore")
+DOWNLOAD_TIMEOUT_SEC = 10
+# Larger images are not fingerprinted (matches Vision's own size limit).
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+# Perceptual hashes of flat or low-texture images (solid colours, plain
+# backgrounds) are mostly noise and collide with each other, so they are not
+# used: below this mean difference between neighbouring pixels (0-255 grey
+# levels) no hash is computed, and hashes with fewer than MIN_PHASH_BITS set
+# or unset bits are never looked up.
+MIN_PHASH_CONTRAST = 2.0
+MIN_PHASH_BITS = 8
+# Post images are only downloaded from Cloud Storage, as {host: path prefix
+# before the bucket name}.
+IMAGE_HOSTS = {"firebasestorage.googleapis.com": "/v0/b/", "storage.googleapis.com": "/"}
+
+
+def _default_bucket() -> str | None:
+    # FIREBASE_CONFIG is set on deployed functions; it may also be a file path.
+    config = os.environ.get("FIREBASE_CONFIG", "")
+    if config.startswith("{"):
+        return json.loads(config).get("storageBucket")
+    return None
+
+
+# The app's bucket. When unknown, any bucket on IMAGE_HOSTS is accepted.
+IMAGE_BUCKET = os.environ.get("IMAGE_BUCKET") or _default_bucket()
+
+
+def is_allowed_image_url(url: str) -> bool:
+    """True for https URLs of objects in the app's Cloud Storage bucket."""
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return False
+    prefix = IMAGE_HOSTS.get(parts.hostname)
+    if parts.scheme != "https" or port not in (None, 443) or prefix is None:
+        return False
+    if ".." in parts.path.split("/"):
+        return False
+    return not IMAGE_BUCKET or parts.path.startswith(f"{prefix}{IMAGE_BUCKET}/")
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Turns redirects into errors, so an allowed URL can't lead elsewhere."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect())
+
+
+def download_image(url: str) -> bytes | None:
+    """
+    Downloads a post image from the app's Storage bucket, returning None if
+    the URL is not allowed, the download fails or the image is too large.
+    """
+    if not is_allowed_image_url(url):
+        logging.warning(f"Not downloading image from a disallowed URL: {url[:200]}")
+        return None
+    try:
+        with _opener.open(url, timeout=DOWNLOAD_TIMEOUT_SEC) as response:
+            content = response.read(MAX_DOWNLOAD_BYTES + 1)
+    except Exception as e:
+        logging.warning(f"Could not download image {url}: {e}")
+        return None
+    if len(content) > MAX_DOWNLOAD_BYTES:
+        logging.warning(f"Image {url} is larger than {MAX_DOWNLOAD_BYTES} bytes. Not fingerprinting.")
+        return None
+    return content
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def perceptual_hash(content: bytes) -> str | None:
+    """
+    64-bit difference hash (dHash). Re-encoded or resized copies of the same
+    photo usually produce the same value. Returns None without Pillow or for
+    images with too little texture to tell apart.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as img:
+            pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except Exception as e:
+        logging.warning(f"Could not compute perceptual hash: {e}")
+        return None
+    bits = 0
+    contrast = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+            contrast += abs(left - right)
+    if contrast / 64 < MIN_PHASH_CONTRAST:
+        return None
+    return f"{bits:016x}"
+
+
+def is_distinctive(phash: str | None) -> bool:
+    """Whether a perceptual hash is specific enough to match other images by."""
+    if not phash:
+        return False
+    set_bits = bin(int(phash, 16)).count("1")
+    return MIN_PHASH_BITS <= set_bits <= 64 - MIN_PHASH_BITS
+
+
+class FirestoreLabelStore:
+    """Label cache entries stored in Firestore, one document per content hash."""
+
+    def __init__(self, collection: str = LABEL_CACHE_COLLECTION):
+        self.collection = collection
+
+    def _collection(self):
+        return firestore.client().collection(self.collection)
+
+    def get(self, sha256: str) -> dict | None:
+        doc = self._collection().document(sha256).get()
+        return doc.to_dict() if doc.exists else None
+
+    def find_by_phash(self, phash: str) -> dict | None:
+        docs = list(self._collection().where("phash", "==", phash).limit(1).stream())
+        return docs[0].to_dict() if docs else None
+
+    def put(self, sha256: str, entry: dict) -> None:
+        self._collection().document(sha256).set(entry)
+
+
+class MemoryLabelStore:
+    """In-process stand-in for FirestoreLabelStore (local runs and benchmarks)."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, sha256: str) -> dict | None:
+        with self._lock:
+            return self._entries.get(sha256)
+
+    def find_by_phash(self, phash: str) -> dict | None:
+        with self._lock:
+            return next((e for e in self._entries.values() if e.get("phash") == phash), None)
+
+    def put(self, sha256: str, entry: dict) -> None:
+        with self._lock:
+            self._entries[sha256] = entry
+
+
+def _default_store():
+    if LABEL_CACHE_BACKEND == "memory":
+        return MemoryLabelStore()
+    return FirestoreLabelStore()
+
+
+class LabelCache:
+    """
+    Content-addressed cache of Vision labels.
+
+    Lookups try the exact byte hash first, then the perceptual hash. Entries
+    older than the TTL are treated as misses and overwritten on the next put.
+    """
+
+    def __init__(self, store=None, ttl_days: int = LABEL_CACHE_TTL_DAYS):
+        self.store = store or _default_store()
+        self.ttl = timedelta(days=ttl_days)
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _fresh(self, entry: dict | None) -> bool:
+        if not entry or entry.get("expiresAt") is None:
+            return False
+        return entry["expiresAt"] > datetime.now(timezone.utc)
+
+    def lookup(self, sha256: str, phash: str | None) -> list | None:
+        """Returns cached labels as [{"description", "score"}] or None on a miss."""
+        try:
+            entry = self.store.get(sha256)
+            if self._fresh(entry):
+                self._count("exact_hits")
+                return entry["labels"]
+            if is_distinctive(phash):
+                entry = self.store.find_by_phash(phash)
+                if self._fresh(entry):
+                    self._count("perceptual_hits")
+                    # Stored under this copy's hash too, so the next repost is an exact hit.
+                    self._put(sha256, {**entry, "phash": phash})
+                    return entry["labels"]
+        except Exception as e:
+            logging.warning(f"Label cache lookup failed: {e}")
+            self._count("errors")
+            return None
+        self._count("misses")
+        return None
+
+    def _put(self, sha256: str, entry: dict) -> None:
+        try:
+            self.store.put(sha256, entry)
+        except Exception as e:
+            logging.warning(f"Label cache write failed: {e}")
+            self._count("errors")
+
+    def store_labels(self, sha256: str, phash: str | None, labels: list) -> None:
+        now = datetime.now(timezone.utc)
+        self._put(sha256, {
+            "labels": labels,
+            "phash": phash,
+            "createdAt": now,
+            "expiresAt": now + self.ttl,
+        })
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.exact_hits + self.perceptual_hits + self.misses
+            hits = self.exact_hits + self.perceptual_hits
+            return {
+                "exact_hits": self.exact_hits,
+                "perceptual_hits": self.perceptual_hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,33 @@
+# likes.py
+
+import os
+import random
+
+from firebase_admin import firestore
+
+# Likes live at posts/{postId}/likes/{userId}; totals are split over
+# posts/{postId}/likeShards/{n} so concurrent likes don't contend on one document.
+LIKES_SUBCOLLECTION = "likes"
+SHARDS_SUBCOLLECTION = "likeShards"
+LIKE_COUNTER_SHARDS = int(os.environ.get("LIKE_COUNTER_SHARDS", "10"))
+# Shard holding the counts migrated from likedBy arrays; set absolutely, so
+# re-running the backfill doesn't double count.
+BACKFILL_SHARD = "backfill"
+
+
+def like_ref(db, post_id: str, user_id: str):
+    return db.collection("posts").document(post_id).collection(LIKES_SUBCOLLECTION).document(user_id)
+
+
+def add_to_counter(db, post_id: str, delta: int) -> None:
+    """Applies +1/-1 to a random shard: one write, whatever the post's like count."""
+    shard_id = str(random.randrange(LIKE_COUNTER_SHARDS))
+    db.collection("posts").document(post_id).collection(SHARDS_SUBCOLLECTION).document(shard_id).set(
+        {"count": firestore.Increment(delta)}, merge=True
+    )
+
+
+def like_count(db, post_id: str) -> int:
+    """Sums the post's shards (at most LIKE_COUNTER_SHARDS + 1 small documents)."""
+    shards = db.collection("posts").document(post_id).collection(SHARDS_SUBCOLLECTION).stream()
+    return int(sum(shard.get("count") or 0 for shard in shards))
@@ -1,17 +1,17 @@
 # main.py
 
+import json
 import logging
 import os
-import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 import firebase_admin
 from firebase_admin import firestore, messaging
-from firebase_functions import options, firestore_fn
+from firebase_functions import options, firestore_fn, scheduler_fn
 
-# Google Cloud Services
-from google.cloud import secretmanager
-import google.generativeai as genai
-import googlemaps
-import vertexai
+# Google Cloud Services (generativeai, googlemaps, and secretmanager via
+# secret_store) are imported lazily where they are used, so triggers that
+# don't need them start faster.
 
 # --- Step 1: Initialize Firebase Admin SDK ---
 firebase_admin.initialize_app()
@@ -25,82 +25,213 @@ options.set_global_options(
 
 gmaps_client = None
 generative_model = None
+# The API key each client above was built with, so refreshed secrets can be applied.
+_client_keys = {}
 
 # --- Step 4: Import Function Definitions ---
-from posts import autoTagPost, onPostInteraction, onPostSaved, onPostUnsaved
-from post_notifications import send_like_notification
+from posts import (autoTagPost, onPostInteraction, onPostSaved, onPostUnsaved, onLikeCreated, onLikeDeleted,
+                   onPostDeleted)
+from post_notifications import flush_like_digests
+from feed_engine import refresh_user_feeds
+from preference_writer import fold_preference_deltas
+from quiz import generate_daily_quiz
+from places_fetch import CALL_TIMEOUT_SEC, MAX_CANDIDATES, search_candidates, fetch_valid_places
+from prompt_builder import PlaceNameIndex, rank_candidates, encode_candidates
+from maps_cache import CachedMapsClient
+from secret_store import REFRESH_INTERVAL_SEC as SECRET_REFRESH_INTERVAL_SEC, get_secrets
+from plan_progress import ThrottledDocWriter, PlanStepStreamParser
+from keyword_extractor import get_search_keywords, keyword_place_types
+from place_store import STORE_RADIUS_KM, place_store
+from photo_store import PHOTO_VARIANTS, photo_store
+import event_ledger
+import instrumentation
+import plan_queue
+import structured_output
+from rate_limits import rate_limited, stats as rate_limit_stats
+from structured_output import StructuredOutputError
+
+# Stream the synthesis response and append plan steps as they complete.
+PLAN_STREAMING = os.environ.get("PLAN_STREAMING", "true").lower() == "true"
+# Write the run's timing/counter summary onto the plan document as "metrics".
+PLAN_METRICS_ON_DOC = os.environ.get("PLAN_METRICS_ON_DOC", "true").lower() == "true"
+# Malformed plan steps re-asked individually per plan; the rest are dropped.
+MAX_STEP_REASKS = int(os.environ.get("MAX_STEP_REASKS", "3"))
+
+# Response schemas for Gemini's constrained JSON output.
+KEYWORDS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"search_keywords": {"type": "ARRAY", "items": {"type": "STRING"}}},
+    "required": ["search_keywords"],
+}
+PLAN_STEP_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "id": {"type": "STRING"},
+        "time": {"type": "STRING"},
+        "place_name": {"type": "STRING"},
+        "activity_description": {"type": "STRING"},
+    },
+    "required": ["id", "time", "place_name", "activity_description"],
+}
+PLAN_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "plan": {"type": "ARRAY", "items": PLAN_STEP_SCHEMA},
+        "estimated_total_cost": {"type": "INTEGER"},
+    },
+    "required": ["plan", "estimated_total_cost"],
+}
+RETIMED_STEPS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "steps": {"type": "ARRAY", "items": {
+            "type": "OBJECT",
+            "properties": {
+                "position": {"type": "INTEGER"},
+                "time": {"type": "STRING"},
+                "activity_description": {"type": "STRING"},
+            },
+            "required": ["position", "time", "activity_description"],
+        }},
+    },
+    "required": ["steps"],
+}
 
 
-def _get_secret(secret_id: str, project_id: str) -> str | None:
-    """Fetches a secret from Google Cloud Secret Manager."""
-    try:
-        client = secretmanager.SecretManagerServiceClient()
-        name = f"projects/{project_id}/secrets/{secret_id}/versions/latest"
-        response = client.access_secret_version(request={"name": name})
-        return response.payload.data.decode("UTF-8")
-    except Exception as e:
-        logging.error(f"Failed to access secret {secret_id}. Error: {e}")
-        return None
-
 def _initialize_clients():
     """
-    Initializes API clients if they haven't been already.
+    Initializes API clients if they haven't been already. With
+    SECRET_REFRESH_INTERVAL_SEC set, a client whose key changed in Secret
+    Manager is rebuilt with the new key.
     """
     global gmaps_client, generative_model
 
+    if gmaps_client is not None and generative_model is not None and SECRET_REFRESH_INTERVAL_SEC <= 0:
+        return
+
+    # Secrets can also come from environment variables of the same name, so
+    # GCP_PROJECT is only required when Secret Manager has to be used.
     PROJECT_ID = os.environ.get("GCP_PROJECT")
     if not PROJECT_ID:
-        logging.critical("GCP_PROJECT environment variable not set. Cannot initialize clients.")
-        return
+        logging.warning("GCP_PROJECT environment variable not set. Only environment secrets are available.")
+
+    # Cached by secret_store until the refresh interval elapses.
+    secrets = get_secrets(["Maps_API_KEY", "GOOGLE_AI_API_KEY"], PROJECT_ID)
 
     # Initialize Google Maps Client
-    if gmaps_client is None:
-        MAPS_API_KEY = _get_secret("Maps_API_KEY", PROJECT_ID)
+    MAPS_API_KEY = secrets["Maps_API_KEY"]
+    if gmaps_client is None or (MAPS_API_KEY and MAPS_API_KEY != _client_keys.get("maps")):
+        import googlemaps
+
         if MAPS_API_KEY:
-            gmaps_client = googlemaps.Client(key=MAPS_API_KEY)
+            if gmaps_client is not None:
+                logging.info("🔑 Maps API key changed. Rebuilding the Maps client.")
+            client = googlemaps.Client(key=MAPS_API_KEY, timeout=CALL_TIMEOUT_SEC, retry_timeout=CALL_TIMEOUT_SEC)
+            # A rebuilt client keeps the cached Maps results.
+            gmaps_client = (CachedMapsClient(client, local=gmaps_client.local, shared=gmaps_client.shared)
+                            if gmaps_client is not None else CachedMapsClient(client))
+            _client_keys["maps"] = MAPS_API_KEY
         else:
             logging.error("Maps API Key is missing. Maps functionality will be disabled.")
 
     # Initialize Generative AI Model
-    if generative_model is None:
-        GOOGLE_AI_API_KEY = _get_secret("GOOGLE_AI_API_KEY", PROJECT_ID)
+    GOOGLE_AI_API_KEY = secrets["GOOGLE_AI_API_KEY"]
+    if generative_model is None or (GOOGLE_AI_API_KEY and GOOGLE_AI_API_KEY != _client_keys.get("gemini")):
+        import google.generativeai as genai
+
         if GOOGLE_AI_API_KEY:
+            if generative_model is not None:
+                logging.info("🔑 Google AI API key changed. Rebuilding the generative model.")
             genai.configure(api_key=GOOGLE_AI_API_KEY)
             generative_model = genai.GenerativeModel('gemini-1.5-flash')
+            _client_keys["gemini"] = GOOGLE_AI_API_KEY
         else:
             logging.error("Google AI API Key is missing. AI functionality will be disabled.")
-            
-    try:
-        vertexai.init(project=PROJECT_ID)
-    except Exception as e:
-        logging.warning(f"Could not initialize Vertex AI: {e}")
 
 
-@firestore_fn.on_document_created(document="travelRequests/{userId}/plans/{planId}")
-def generate_travel_plan(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None:
+def _generate_json_text(prompt: str, schema: dict) -> str:
+    """One small, schema-constrained Gemini call; used to re-ask for a malformed piece."""
+    instrumentation.count("gemini.calls")
+    instrumentation.count("gemini.bytes_sent", len(prompt.encode("utf-8")))
+    with instrumentation.span("gemini.reask"):
+        return rate_limited("gemini", lambda: structured_output.generate_json(generative_model, prompt, schema)).text
+
+
+def _retime_steps(city: str, user_prompt: str, steps: list, moved: list) -> dict | None:
     """
-    Triggered by Firestore document creation to generate an AI travel plan.
+    Asks the model to rewrite only the steps that route optimization moved
+    (see route_optimizer.optimize_route). Returns {position: {"time",
+    "activity_description"}}, or None if the answer is unusable.
     """
-    _initialize_clients()
-    
-    if not gmaps_client or not generative_model:
-        logging.error("Aborting travel plan generation due to client initialization failure.")
-        return
+    lines = "\n".join(json.dumps({
+        "position": position,
+        "place_name": step.get("place_name"),
+        "time": step.get("time"),
+        "activity_description": step.get("activity_description"),
+        "rewrite": position in moved,
+    }, ensure_ascii=False) for position, step in enumerate(steps))
+    prompt = f"""
+    This travel plan for a trip to {city} was reordered into a shorter route. The user's preferences are: "{user_prompt}".
+    One JSON object per line, in visiting order:
+    {lines}
+
+    For every step with "rewrite": true, return its "position", a "time" that fits between the times of the steps
+    before and after it, and its "activity_description" rewritten for that time and order, keeping the same voice.
+    Output ONLY a JSON object with a key "steps".
+    """
+    try:
+        answer = structured_output.parse_json(_generate_json_text(prompt, RETIMED_STEPS_SCHEMA), expect=dict)
+    except Exception as e:
+        logging.warning(f"⚠️ Re-timing the reordered plan failed: {e}")
+        return None
+    rewritten = {}
+    for item in answer.get("steps") or []:
+        if not isinstance(item, dict) or item.get("position") not in moved:
+            continue
+        time_slot, description = item.get("time"), item.get("activity_description")
+        if isinstance(time_slot, str) and time_slot.strip() and isinstance(description, str) and description.strip():
+            rewritten[item["position"]] = {"time": time_slot.strip(), "activity_description": description.strip()}
+    instrumentation.count("route.steps_retimed", len(rewritten))
+    return rewritten
+
+
+def _enrich_step(step: dict, places_by_short_id: dict, name_index: PlaceNameIndex) -> dict | None:
+    """
+    Attaches place ID, geometry and photo reference to an AI plan step.
+    Returns None if the step doesn't match any candidate place.
+    """
+    place_name = step.get("place_name")
+    # Match by the short id first; fall back to the (normalized, then fuzzy) name.
+    matching_place = places_by_short_id.get(str(step.pop("id", "")).strip().lower())
+    if matching_place is None:
+        matching_place = name_index.find(place_name)
+
+    if not matching_place:
+        logging.warning(f"AI generated a place '{place_name}' not found in the valid places list. Skipping.")
+        return None
 
-    db = firebase_admin.firestore.client()
-    user_id = event.params["userId"]
-    plan_id = event.params["planId"]
-    request_data = event.data.to_dict()
-    doc_ref = db.collection("travelRequests").document(user_id).collection("plans").document(plan_id)
+    step["place_name"] = matching_place.get("name")
+    step["place_id"] = matching_place.get("place_id")
+    step["geometry"] = matching_place.get("geometry")
+    # Add photo reference to each step if available
+    if matching_place.get('photos'):
+        step['photo_reference'] = matching_place['photos'][0].get('photo_reference')
+    return step
 
-    logging.info(f"🚀 Processing request {plan_id} for user {user_id}.")
-    doc_ref.update({"status": "processing"})
 
-    try:
-        user_prompt = request_data.get("request", "")
-        city = request_data.get("city", "")
-        fcm_token = request_data.get("fcmToken")
-        
+def _fetch_place_photo(photo_reference: str) -> bytes:
+    """Downloads a Places photo at the size of the largest stored variant."""
+    size = max(PHOTO_VARIANTS.values())
+    return rate_limited("place_photo", lambda: b"".join(
+        gmaps_client.places_photo(photo_reference, max_width=size, max_height=size)
+    ))
+
+
+def _discover(user_prompt: str, city: str, progress: ThrottledDocWriter) -> dict:
+    """
+    Works out the Maps search keywords and geocodes the city.
+    """
+    def _deconstruct_with_llm():
         deconstruction_prompt = f"""
         Analyze the following user request for a trip to {city}. 
         Based on the request "{user_prompt}", generate a JSON object with a key "search_keywords" 
@@ -108,102 +239,305 @@ def generate_travel_plan(event: firestore_fn.Event[firestore.DocumentSnapshot])
         For example: "historical landmarks in {city}", "highly-rated local restaurants in {city}", "modern art museums in {city}".
         Output ONLY the JSON object.
         """
-        response = generative_model.generate_content(deconstruction_prompt)
-        structured_query = json.loads(response.text.strip().replace("```json", "").replace("```", ""))
-        search_keywords = structured_query.get("search_keywords", [])
+        instrumentation.count("gemini.calls")
+        instrumentation.count("gemini.bytes_sent", len(deconstruction_prompt.encode("utf-8")))
+        with instrumentation.span("gemini.deconstruct"):
+            response = rate_limited("gemini", lambda: structured_output.generate_json(
+                generative_model, deconstruction_prompt, KEYWORDS_SCHEMA
+            ))
+        try:
+            structured_query = structured_output.parse_json(response.text, expect=dict)
+        except StructuredOutputError as e:
+            logging.warning(f"⚠️ Keyword response was malformed ({e}). Re-asking.")
+            structured_query = structured_output.reask(_generate_json_text, response.text, KEYWORDS_SCHEMA,
+                                                       "search keyword object")
+        if not isinstance(structured_query, dict) or not isinstance(structured_query.get("search_keywords"), list):
+            return []
+        return [k for k in structured_query["search_keywords"] if isinstance(k, str) and k.strip()]
+
+    # Geocode speculatively while the keywords are worked out, so the
+    # deconstruction (possibly an LLM call) is off the critical path.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        geocode_future = executor.submit(instrumentation.bind(gmaps_client.geocode), city)
+        search_keywords = get_search_keywords(user_prompt, city, _deconstruct_with_llm)
         logging.info(f"🔍 Deconstructed keywords: {search_keywords}")
+        progress.update({"progress.stage": "searching", "progress.keywords": search_keywords})
+        geocode_result = geocode_future.result()
+
+    if not geocode_result:
+        raise ValueError(f"Could not find coordinates for city: {city}")
+
+    return {
+        "search_keywords": search_keywords,
+        "start_location": geocode_result[0]['geometry']['location'],
+    }
+
 
-        geocode_result = gmaps_client.geocode(city)
-        if not geocode_result:
-            raise ValueError(f"Could not find coordinates for city: {city}")
-        
-        start_location = geocode_result[0]['geometry']['location']
-        candidate_place_ids = set()
-        for keyword in search_keywords:
-            places_result = gmaps_client.places(query=keyword, location=start_location, radius=20000)
-            for place in places_result.get('results', []):
-                candidate_place_ids.add(place['place_id'])
-        
-        logging.info(f"📍 Found {len(candidate_place_ids)} candidate places.")
-
-        valid_places = []
-        for place_id in list(candidate_place_ids)[:15]:
-            details = gmaps_client.place(place_id=place_id, fields=['place_id', 'name', 'vicinity', 'rating', 'geometry', 'photo', 'type'])
-            place_data = details.get('result', {})
-            if place_data.get('rating'):
-                valid_places.append({
-                    "place_id": place_data.get('place_id'),
-                    "name": place_data.get('name'),
-                    "address": place_data.get('vicinity'),
-                    "rating": place_data.get('rating'), 
-                    "geometry": place_data.get('geometry', {}).get('location', {}),
-                    "photos": place_data.get('photos'),
-                    "types": place_data.get('types')
-                })
-        
-        logging.info(f"✅ Filtered down to {len(valid_places)} valid places with details.")
-        
+def _gather_valid_places(search_keywords: list, start_location: dict, progress: ThrottledDocWriter) -> list:
+    """
+    Finds candidate places for the keywords and returns the rated ones with details.
+    """
+    # Keywords whose place types are well covered by the local place store
+    # are answered from it; only the rest go to the Places API.
+    stored_places = {}
+    api_keywords = []
+    for keyword in search_keywords:
+        place_types = keyword_place_types(keyword)
+        found = place_store.find_places(start_location, STORE_RADIUS_KM, place_types) if place_types else None
+        if found is None:
+            api_keywords.append(keyword)
+            continue
+        for place in found:
+            stored_places.setdefault(place["place_id"], place)
+    logging.info(f"🗺️ Place store served {len(search_keywords) - len(api_keywords)}/{len(search_keywords)} keyword(s).")
+
+    searched = search_candidates(gmaps_client, api_keywords, start_location)
+    searched_ids = {c["place_id"] for c in searched}
+    candidates = rank_candidates(
+        searched + [p for p in stored_places.values() if p["place_id"] not in searched_ids],
+        start_location,
+    )
+
+    logging.info(f"📍 Found {len(candidates)} candidate places.")
+    progress.update({"progress.stage": "fetching_details", "progress.candidatesFound": len(candidates)})
+
+    # Details are only fetched for the best-ranked candidates that the
+    # place store doesn't already have.
+    top_candidates = candidates[:MAX_CANDIDATES]
+    fetched_places = fetch_valid_places(
+        gmaps_client, [c["place_id"] for c in top_candidates if c["place_id"] not in stored_places]
+    )
+    place_store.index_places(fetched_places)
+    fetched_by_id = {p["place_id"]: p for p in fetched_places}
+    valid_places = []
+    for candidate in top_candidates:
+        place = stored_places.get(candidate["place_id"]) or fetched_by_id.get(candidate["place_id"])
+        if place and place.get("rating"):
+            valid_places.append(place)
+
+    logging.info(f"✅ Filtered down to {len(valid_places)} valid places with details.")
+    logging.info(f"🗄️ Maps cache stats: {gmaps_client.stats()}")
+    logging.info(f"🚦 Rate limiter stats: {rate_limit_stats()}")
+    progress.update({"progress.stage": "synthesizing", "progress.placesValidated": len(valid_places)})
+    return valid_places
+
+
+def _build_synthesis_prompt(city: str, user_prompt: str, candidate_block: str) -> str:
+    """Builds the Gemini prompt that turns the candidate places into a plan."""
+    return f"""
+    You are a master storyteller and a travel poet, creating an unforgettable narrative for a trip to {city}.
+    The user's preferences are: "{user_prompt}".
+
+    Here is a palette of inspirational places, including potential hotels. One JSON object per line:
+    "id" is the place's short id, "km" its distance from the city center.
+    {candidate_block}
+
+    **Your Mission:**
+    1. **Select a Hotel:** From the list, choose ONE suitable hotel that will serve as the starting and ending point of the journey.
+    2. **Curate a Journey:** Select 3-5 additional places that perfectly align with the user's request, creating a logical and magical flow for their day.
+    3. **Breathe Life into Each Step:** For each place (including the hotel check-in), write a captivating 'activity_description'. Frame each activity as a unique experience. Adapt your voice to the user's occasion.
+    4. **Calculate Estimated Cost:** Based on the selected places and activities, calculate an estimated total cost for the entire plan in Japanese Yen (JPY). Consider typical expenses like food, tickets, and transport.
+    5. **Format as JSON:** The final output MUST be a valid JSON object. It should have a key "plan" (an array of events) and a key "estimated_total_cost" (an integer). Each event MUST include the place's short "id" from the list. The first event in the plan should always be the hotel check-in.
+
+    **Example of Your Art:**
+    {{
+        "plan": [
+            {{
+                "id": "p1",
+                "time": "3:00 PM",
+                "place_name": "The Grand Palace Hotel",
+                "activity_description": "Your adventure begins here. Drop off your bags in a room with a view, take a deep breath, and feel the excitement of the city settle in. This is your sanctuary, your basecamp for the story you're about to write."
+            }},
+            {{
+                "id": "p4",
+                "time": "5:00 PM",
+                "place_name": "Serenity Art Gallery",
+                "activity_description": "As the afternoon sun casts a golden glow, wander hand-in-hand with your partner through halls of inspiration. Let the quiet hum of the gallery be the soundtrack to your own private world."
+            }}
+        ],
+        "estimated_total_cost": 25000
+    }}
+
+    Now, begin your creation for the user's trip to {city}. Output ONLY the JSON object.
+    """
+
+
+def _generate_plan_text(synthesis_prompt: str, places_by_short_id: dict, name_index: PlaceNameIndex,
+                        progress: ThrottledDocWriter) -> str:
+    """
+    Runs the synthesis call and returns the raw response text.
+
+    In streaming mode, each step is enriched and appended to the plan
+    document as soon as it is complete.
+    """
+    instrumentation.count("gemini.calls")
+    instrumentation.count("gemini.bytes_sent", len(synthesis_prompt.encode("utf-8")))
+    if not PLAN_STREAMING:
+        return rate_limited(
+            "gemini", lambda: structured_output.generate_json(generative_model, synthesis_prompt, PLAN_SCHEMA)
+        ).text
+
+    parser = PlanStepStreamParser()
+    streamed_plan = []
+    call_started_at = None
+
+    def _open_stream():
+        # generativeai reads the first chunk before generate_content() returns,
+        # so the wait for the first token is inside this call.
+        nonlocal call_started_at
+        call_started_at = time.perf_counter()
+        with instrumentation.span("gemini.stream_open"):
+            return structured_output.generate_json(generative_model, synthesis_prompt, PLAN_SCHEMA, stream=True)
+
+    stream = rate_limited("gemini", _open_stream)
+    first_chunk = True
+    for chunk in stream:
+        if first_chunk:
+            instrumentation.count("gemini.first_chunk_ms", round((time.perf_counter() - call_started_at) * 1000, 1))
+            first_chunk = False
+        try:
+            chunk_text = chunk.text
+        except ValueError:
+            continue  # Chunks without text (e.g. only safety metadata).
+        for step in parser.feed(chunk_text):
+            enriched_step = _enrich_step(step, places_by_short_id, name_index)
+            if enriched_step:
+                streamed_plan.append(enriched_step)
+                progress.update({"plan": list(streamed_plan), "progress.stepsReady": len(streamed_plan)})
+    return parser.text
+
+
+def _is_complete_step(step) -> bool:
+    return isinstance(step, dict) and bool(step.get("id") or step.get("place_name")) \
+        and bool(step.get("activity_description"))
+
+
+def _parse_plan_steps(plan_text: str) -> list:
+    """
+    Plan steps from the synthesis response.
+
+    Each step is parsed (and if needed repaired) on its own, so a malformed
+    step doesn't discard the plan. Steps that still can't be used are
+    re-asked individually, up to MAX_STEP_REASKS per plan.
+    """
+    steps = []
+    reasks = 0
+    for raw_step in structured_output.split_array(plan_text, key="plan"):
+        try:
+            step = structured_output.parse_json(raw_step, expect=dict)
+        except StructuredOutputError:
+            step = None
+        if not _is_complete_step(step):
+            if reasks >= MAX_STEP_REASKS:
+                logging.warning("⚠️ Dropping a malformed plan step (re-ask limit reached).")
+                continue
+            reasks += 1
+            logging.warning("⚠️ Plan step was malformed or incomplete. Re-asking for that step only.")
+            step = structured_output.reask(_generate_json_text, raw_step, PLAN_STEP_SCHEMA, "travel plan step")
+            if not _is_complete_step(step):
+                continue
+        steps.append(step)
+    return steps
+
+
+def _attach_photos(doc_ref, plan: list, thumbnail_photo_reference: str | None) -> None:
+    """
+    Stores the plan's place photos and adds their URLs to the completed plan
+    in a follow-up update. Runs after the plan is saved, so slow or failing
+    photo downloads never hold back or fail the plan itself; steps without
+    URLs keep their photo reference.
+    """
+    photo_references = [step.get("photo_reference") for step in plan] + [thumbnail_photo_reference]
+    try:
+        with instrumentation.span("stage.photos"):
+            photo_urls = photo_store.store_photos(photo_references, _fetch_place_photo)
+        logging.info(f"🖼️ Stored photos for {len(photo_urls)}/{len(set(filter(None, photo_references)))} reference(s).")
+        if not photo_urls:
+            return
+        for step in plan:
+            if step.get("photo_reference") in photo_urls:
+                step["photo_urls"] = photo_urls[step["photo_reference"]]
+        update_data = {"plan": plan}
+        if thumbnail_photo_reference in photo_urls:
+            update_data["thumbnail_photo_urls"] = photo_urls[thumbnail_photo_reference]
+        if PLAN_METRICS_ON_DOC and instrumentation.current():
+            update_data["metrics"] = instrumentation.current().summary()
+        with instrumentation.span("firestore.save_photos"):
+            doc_ref.update(update_data)
+    except Exception as e:
+        logging.warning(f"⚠️ Could not attach photos to plan {doc_ref.id}: {e}")
+
+
+def _process_plan(doc_ref, request_data: dict, event_id: str) -> bool:
+    """
+    Generates the AI travel plan for one request document. Returns False if
+    another delivery owns (or already finished) the work.
+
+    Each stage's result is recorded in the event ledger, so a redelivered
+    event resumes after the last completed stage and a completed plan is
+    never processed again.
+    """
+    plan_id = doc_ref.id
+    ledger = event_ledger.claim("generate_travel_plan", doc_ref.path, event_id)
+    if ledger is None:
+        return False
+
+    logging.info(f"🚀 Processing request {plan_id}.")
+    doc_ref.update({"status": "processing", "progress": {"stage": "started"}})
+    progress = ThrottledDocWriter(doc_ref)
+
+    try:
+        user_prompt = request_data.get("request", "")
+        city = request_data.get("city", "")
+        fcm_token = request_data.get("fcmToken")
+
+        with instrumentation.span("stage.discovery"):
+            discovery = ledger.stage("discovery", lambda: _discover(user_prompt, city, progress))
+        start_location = discovery["start_location"]
+
+        with instrumentation.span("stage.places"):
+            valid_places = ledger.stage(
+                "places", lambda: _gather_valid_places(discovery["search_keywords"], start_location, progress)
+            )
         if not valid_places:
             raise ValueError("No valid places found after filtering.")
 
-        # main.py の修正案 (synthesis_prompt の部分)
-
-        synthesis_prompt = f"""
-        You are a master storyteller and a travel poet, creating an unforgettable narrative for a trip to {city}.
-        The user's preferences are: "{user_prompt}".
-
-        Here is a palette of inspirational places, including potential hotels:
-        {json.dumps(valid_places, indent=2)}
-
-        **Your Mission:**
-        1. **Select a Hotel:** From the list, choose ONE suitable hotel that will serve as the starting and ending point of the journey.
-        2. **Curate a Journey:** Select 3-5 additional places that perfectly align with the user's request, creating a logical and magical flow for their day.
-        3. **Breathe Life into Each Step:** For each place (including the hotel check-in), write a captivating 'activity_description'. Frame each activity as a unique experience. Adapt your voice to the user's occasion.
-        4. **Calculate Estimated Cost:** Based on the selected places and activities, calculate an estimated total cost for the entire plan in Japanese Yen (JPY). Consider typical expenses like food, tickets, and transport.
-        5. **Format as JSON:** The final output MUST be a valid JSON object. It should have a key "plan" (an array of events) and a key "estimated_total_cost" (an integer). The first event in the plan should always be the hotel check-in.
-
-        **Example of Your Art:**
-        {{
-            "plan": [
-                {{
-                    "time": "3:00 PM",
-                    "place_name": "The Grand Palace Hotel",
-                    "activity_description": "Your adventure begins here. Drop off your bags in a room with a view, take a deep breath, and feel the excitement of the city settle in. This is your sanctuary, your basecamp for the story you're about to write."
-                }},
-                {{
-                    "time": "5:00 PM",
-                    "place_name": "Serenity Art Gallery",
-                    "activity_description": "As the afternoon sun casts a golden glow, wander hand-in-hand with your partner through halls of inspiration. Let the quiet hum of the gallery be the soundtrack to your own private world."
-                }}
-            ],
-            "estimated_total_cost": 25000
-        }}
-
-        Now, begin your creation for the user's trip to {city}. Output ONLY the JSON object.
-        """
-        
-        final_plan_response = generative_model.generate_content(synthesis_prompt)
-        ai_plan_data = json.loads(final_plan_response.text.strip().replace("```json", "").replace("```", ""))
-        ai_plan = ai_plan_data.get("plan", [])
+        candidate_block, places_by_short_id = encode_candidates(
+            rank_candidates(valid_places, start_location), start_location
+        )
+        logging.info(f"🧾 Encoded {len(places_by_short_id)} places in {len(candidate_block)} chars for synthesis.")
+        synthesis_prompt = _build_synthesis_prompt(city, user_prompt, candidate_block)
+
+        name_index = PlaceNameIndex(valid_places)
+
+        with instrumentation.span("stage.synthesis"):
+            final_plan_text = ledger.stage(
+                "synthesis",
+                lambda: _generate_plan_text(synthesis_prompt, places_by_short_id, name_index, progress),
+            )
+
+        ai_plan = _parse_plan_steps(final_plan_text)
 
         enriched_plan = []
         for step in ai_plan:
-            place_name = step.get("place_name")
-            matching_place = next((p for p in valid_places if p["name"] == place_name), None)
-            
-            if matching_place:
-                step["place_id"] = matching_place.get("place_id")
-                step["geometry"] = matching_place.get("geometry")
-                # Add photo reference to each step if available
-                if matching_place.get('photos'):
-                    step['photo_reference'] = matching_place['photos'][0].get('photo_reference')
-                enriched_plan.append(step)
-            else:
-                logging.warning(f"AI generated a place '{place_name}' not found in the valid places list. Skipping.")
+            enriched_step = _enrich_step(step, places_by_short_id, name_index)
+            if enriched_step:
+                enriched_plan.append(enriched_step)
 
         if not enriched_plan:
             raise ValueError("AI failed to generate a valid plan from the provided places.")
 
+        route_summary = None
+        try:
+            # Imported lazily: numpy is only needed by this trigger.
+            from route_optimizer import optimize_route
+            with instrumentation.span("stage.route"):
+                enriched_plan, route_summary = optimize_route(
+                    enriched_plan, lambda steps, moved: _retime_steps(city, user_prompt, steps, moved)
+                )
+        except Exception as e:
+            logging.warning(f"⚠️ Route optimization failed, keeping the AI's order: {e}")
+
         thumbnail_photo_reference = None
         if enriched_plan:
             first_step_place_id = enriched_plan[0].get("place_id")
@@ -216,12 +550,22 @@ def generate_travel_plan(event: firestore_fn.Event[firestore.DocumentSnapshot])
         update_data = {
             "status": "completed",
             "plan": enriched_plan,
+            "progress.stage": "completed",
             "updatedAt": firestore.SERVER_TIMESTAMP
         }
         if thumbnail_photo_reference:
             update_data["thumbnail_photo_reference"] = thumbnail_photo_reference
-
-        doc_ref.update(update_data)
+        if route_summary:
+            update_data["route"] = route_summary
+
+        # Pending progress must land before the final write, not after it.
+        progress.flush()
+        instrumentation.count("firestore.progress_writes", progress.writes)
+        if PLAN_METRICS_ON_DOC and instrumentation.current():
+            update_data["metrics"] = instrumentation.current().summary()
+        with instrumentation.span("firestore.save_plan"):
+            doc_ref.update(update_data)
+        ledger.complete()
         logging.info(f"🎉 Successfully generated and saved enriched plan for request {plan_id}.")
 
         if fcm_token:
@@ -233,13 +577,107 @@ def generate_travel_plan(event: firestore_fn.Event[firestore.DocumentSnapshot])
                     ),
                     token=fcm_token,
                 )
-                response = messaging.send(message)
+                with instrumentation.span("fcm.send"):
+                    response = messaging.send(message)
                 logging.info(f"✅ Successfully sent notification: {response}")
             except Exception as e:
                 logging.error(f"❌ Failed to send notification for plan {plan_id}: {e}")
         else:
             logging.warning(f"⚠️ No FCM token found for plan {plan_id}. Cannot send notification.")
 
+        _attach_photos(doc_ref, enriched_plan, thumbnail_photo_reference)
+
     except Exception as e:
         logging.error(f"❌ Error processing request {plan_id}: {e}", exc_info=True)
-        doc_ref.update({"status": "error", "errorMessage": str(e)})
\ No newline at end of file
+        ledger.fail(e)
+        progress.flush()
+        instrumentation.count("plan.errors")
+        doc_ref.update({"status": "error", "errorMessage": str(e), "progress.stage": "error"})
+    return True
+
+
+def _run_with_slot(lease, doc_ref, request_data: dict, event_id: str, **run_attrs) -> None:
+    """Runs a plan while keeping its slot alive, then frees the slot."""
+    claimed = False
+    try:
+        with lease.keep_alive(), instrumentation.run("generate_travel_plan", plan=doc_ref.id, **run_attrs):
+            claimed = _process_plan(doc_ref, request_data, event_id)
+    finally:
+        # A duplicate delivery of a running plan shares its slot; only the
+        # delivery that did the work may free it.
+        if claimed or not lease.shared:
+            lease.release()
+
+
+@firestore_fn.on_document_created(document="travelRequests/{userId}/plans/{planId}")
+def generate_travel_plan(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None:
+    """
+    Triggered by Firestore document creation to generate an AI travel plan.
+
+    At most PLAN_MAX_IN_FLIGHT plans run at once; beyond that the request is
+    queued and picked up by drain_plan_queue as slots free up.
+    """
+    _initialize_clients()
+
+    if not gmaps_client or not generative_model:
+        logging.error("Aborting travel plan generation due to client initialization failure.")
+        return
+
+    db = firebase_admin.firestore.client()
+    doc_ref = db.collection("travelRequests").document(event.params["userId"]) \
+        .collection("plans").document(event.params["planId"])
+
+    lease = plan_queue.try_acquire(doc_ref.path)
+    if lease is None:
+        plan_queue.enqueue(doc_ref.path)
+        doc_ref.update({"status": "queued", "progress": {"stage": "queued"}})
+        logging.info(f"🚦 No plan slot available. Queued request {doc_ref.id}.")
+        return
+
+    _run_with_slot(lease, doc_ref, event.data.to_dict(), event.id)
+
+
+@scheduler_fn.on_schedule(schedule="every 1 minutes", timeout_sec=540)
+def drain_plan_queue(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Runs queued travel plans, oldest first, while plan slots are free.
+    """
+    pending = plan_queue.oldest_pending(plan_queue.MAX_IN_FLIGHT)
+    if not pending:
+        return
+
+    _initialize_clients()
+    if not gmaps_client or not generative_model:
+        logging.error("Aborting queue drain due to client initialization failure.")
+        return
+
+    db = firebase_admin.firestore.client()
+    claimed = []
+    for plan_path, enqueued_at in pending:
+        lease = plan_queue.try_acquire(plan_path, dequeue=True)
+        if lease is None:
+            break
+        if lease.shared:
+            continue  # Already running elsewhere.
+        claimed.append((plan_path, enqueued_at, lease))
+    logging.info(f"🚦 Queue depth {plan_queue.queue_depth() + len(claimed)}, draining {len(claimed)} plan(s).")
+    if not claimed:
+        return
+
+    def _run(item):
+        plan_path, enqueued_at, lease = item
+        logging.info(f"⏱️ Plan {plan_path} waited {time.time() - enqueued_at:.1f}s in the queue.")
+        doc_ref = db.document(plan_path)
+        try:
+            snapshot = doc_ref.get()
+        except Exception:
+            lease.release()
+            raise
+        if not snapshot.exists:
+            lease.release()
+            return
+        _run_with_slot(lease, doc_ref, snapshot.to_dict(), f"queue:{enqueued_at}",
+                       queued=True, queue_wait_ms=round((time.time() - enqueued_at) * 1000))
+
+    with ThreadPoolExecutor(max_workers=len(claimed)) as executor:
+        list(executor.map(_run, claimed))
@@ -0,0 +1,230 @@
+# maps_cache.py
+
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+
+import instrumentation
+from rate_limits import rate_limited
+
+# Per-kind TTLs. Geocodes almost never change; place content is refreshed daily.
+GEOCODE_TTL_SEC = 30 * 24 * 3600
+PLACES_SEARCH_TTL_SEC = 12 * 3600
+PLACE_DETAILS_TTL_SEC = 24 * 3600
+
+LOCAL_MAX_ENTRIES = 2000
+SHARED_MAX_ENTRIES = 50000
+SHARED_COLLECTION = "mapsCache"
+# Fraction of shared-tier writes that also run the size-bounded eviction pass.
+SHARED_EVICTION_SAMPLE_RATE = 0.02
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU with per-entry expiry and hit/miss counters.
+    """
+
+    def __init__(self, max_entries: int = LOCAL_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value, ttl_sec: float) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl_sec)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+class FirestoreCache:
+    """
+    Shared cache tier backed by a Firestore collection.
+
+    Each entry stores a JSON payload and an `expiresAt` timestamp. Expired
+    entries are ignored on read; configure a Firestore TTL policy on
+    `expiresAt` to have them deleted automatically. The collection is also
+    kept under `max_entries` by occasionally deleting the least recently
+    written entries.
+    """
+
+    def __init__(self, collection: str = SHARED_COLLECTION, max_entries: int = SHARED_MAX_ENTRIES):
+        self.collection = collection
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.evictions = 0
+
+    def _doc(self, key: str):
+        doc_id = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return firestore.client().collection(self.collection).document(doc_id)
+
+    def _count(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def get(self, key: str):
+        try:
+            doc = self._doc(key).get()
+        except Exception as e:
+            logging.warning(f"Shared Maps cache read failed: {e}")
+            self._count("errors")
+            return None
+        data = doc.to_dict() if doc.exists else None
+        if not data or data.get("expiresAt") is None or data["expiresAt"] <= datetime.now(timezone.utc):
+            self._count("misses")
+            return None
+        self._count("hits")
+        return json.loads(data["payload"])
+
+    def set(self, key: str, value, ttl_sec: float, kind: str) -> None:
+        now = datetime.now(timezone.utc)
+        try:
+            self._doc(key).set({
+                "kind": kind,
+                "payload": json.dumps(value),
+                "createdAt": now,
+                "expiresAt": now + timedelta(seconds=ttl_sec),
+            })
+            if random.random() < SHARED_EVICTION_SAMPLE_RATE:
+                self._evict_overflow()
+        except Exception as e:
+            logging.warning(f"Shared Maps cache write failed: {e}")
+            self._count("errors")
+
+    def _evict_overflow(self) -> None:
+        """Deletes the oldest entries once the collection grows past max_entries."""
+        collection = firestore.client().collection(self.collection)
+        total = collection.count().get()[0][0].value
+        overflow = int(total - self.max_entries)
+        if overflow <= 0:
+            return
+        db = firestore.client()
+        oldest = collection.order_by("createdAt").limit(overflow).stream()
+        batch = db.batch()
+        pending = 0
+        for doc in oldest:
+            batch.delete(doc.reference)
+            pending += 1
+            if pending == 500:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+        if pending:
+            batch.commit()
+        self._count("evictions", overflow)
+        logging.info(f"🧹 Evicted {overflow} entries from shared Maps cache.")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "errors": self.errors, "evictions": self.evictions}
+
+
+class CachedMapsClient:
+    """
+    Drop-in wrapper for googlemaps.Client that caches geocode, places and
+    place lookups in an in-process LRU backed by a shared Firestore tier.
+    Cache misses go through the per-API rate limiters.
+    """
+
+    def __init__(self, client, local: LRUCache | None = None, shared: FirestoreCache | None = None):
+        self._client = client
+        self.local = local or LRUCache()
+        self.shared = shared or FirestoreCache()
+
+    def _cached(self, kind: str, key_parts: dict, ttl_sec: float, fetch):
+        key = f"{kind}:{json.dumps(key_parts, sort_keys=True)}"
+
+        value = self.local.get(key)
+        if value is not None:
+            instrumentation.count(f"maps.{kind}.local_hits")
+            return value
+
+        value = self.shared.get(key)
+        if value is not None:
+            instrumentation.count(f"maps.{kind}.shared_hits")
+            self.local.set(key, value, ttl_sec)
+            return value
+
+        instrumentation.count(f"maps.{kind}.api_calls")
+        with instrumentation.span(f"maps.{kind}"):
+            value = fetch()
+        # Empty answers are not cached so a transient miss can't stick around.
+        if value:
+            self.local.set(key, value, ttl_sec)
+            self.shared.set(key, value, ttl_sec, kind)
+        return value
+
+    def geocode(self, address: str, **kwargs):
+        return self._cached(
+            "geocode",
+            {"address": address.strip().lower(), **kwargs},
+            GEOCODE_TTL_SEC,
+            lambda: rate_limited("geocode", lambda: self._client.geocode(address, **kwargs)),
+        )
+
+    def places(self, query: str, location=None, radius=None, **kwargs):
+        return self._cached(
+            "places",
+            {"query": query.strip().lower(), "location": location, "radius": radius, **kwargs},
+            PLACES_SEARCH_TTL_SEC,
+            lambda: rate_limited(
+                "places_search",
+                lambda: self._client.places(query=query, location=location, radius=radius, **kwargs),
+            ),
+        )
+
+    def place(self, place_id: str, fields=None, **kwargs):
+        return self._cached(
+            "place",
+            {"place_id": place_id, "fields": sorted(fields or []), **kwargs},
+            PLACE_DETAILS_TTL_SEC,
+            lambda: rate_limited(
+                "place_details", lambda: self._client.place(place_id=place_id, fields=fields, **kwargs)
+            ),
+        )
+
+    def stats(self) -> dict:
+        return {"local": self.local.stats(), "shared": self.shared.stats()}
+
+    def __getattr__(self, name):
+        # Everything else goes straight to the wrapped client.
+        return getattr(self._client, name)
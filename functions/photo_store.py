@@ -0,0 +1,226 @@
+# photo_store.py
+
+import hashlib
+import io
+import logging
+import os
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import instrumentation
+from maps_cache import LRUCache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Without Pillow, plans keep only their photo references.
+    Image = None
+
+# Longest side in pixels of each stored variant, largest first. Each one is
+# scaled down from the one before it, so the photo is decoded only once.
+PHOTO_VARIANTS = {"full": 1600, "card": 640, "thumbnail": 160}
+PHOTO_JPEG_QUALITY = int(os.environ.get("PHOTO_JPEG_QUALITY", "82"))
+# "gcs" stores variants in Cloud Storage; "local" on the filesystem (local runs and benchmarks).
+PHOTO_STORE_BACKEND = os.environ.get("PHOTO_STORE_BACKEND", "gcs")
+# Bucket for the "gcs" backend; the project's default Firebase bucket when unset.
+PHOTO_BUCKET = os.environ.get("PHOTO_BUCKET")
+PHOTO_LOCAL_DIR = os.environ.get("PHOTO_LOCAL_DIR", "/tmp/place-photos")
+# Prefix of the URLs written onto plans, for a CDN or public bucket in front
+# of the photos. Defaults to Firebase Storage download URLs (or file:// URLs
+# for the local backend).
+PHOTO_PUBLIC_BASE_URL = os.environ.get("PHOTO_PUBLIC_BASE_URL")
+PHOTO_PATH_PREFIX = "placePhotos"
+# Stored objects never change, so clients and CDNs may cache them for good.
+PHOTO_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Object metadata key holding Firebase Storage download tokens.
+DOWNLOAD_TOKENS_METADATA = "firebaseStorageDownloadTokens"
+MAX_PHOTO_WORKERS = 6
+KNOWN_PHOTOS_TTL_SEC = 24 * 3600
+
+
+def photo_key(photo_reference: str) -> str:
+    return hashlib.sha256(photo_reference.encode("utf-8")).hexdigest()[:32]
+
+
+def render_variants(content: bytes) -> dict | None:
+    """
+    Decodes a photo once and returns {variant: JPEG bytes} for every entry of
+    PHOTO_VARIANTS. Images are never scaled up. Returns None without Pillow
+    or if the photo can't be decoded.
+    """
+    if Image is None:
+        return None
+    largest = max(PHOTO_VARIANTS.values())
+    try:
+        with Image.open(io.BytesIO(content)) as source:
+            # For JPEGs, lets the decoder skip detail the largest variant doesn't need.
+            source.draft("RGB", (largest, largest))
+            img = ImageOps.exif_transpose(source).convert("RGB")
+    except Exception as e:
+        logging.warning(f"Could not decode place photo: {e}")
+        return None
+
+    variants = {}
+    for name, size in sorted(PHOTO_VARIANTS.items(), key=lambda item: -item[1]):
+        img.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=PHOTO_JPEG_QUALITY, optimize=True, progressive=True)
+        variants[name] = buffer.getvalue()
+    return variants
+
+
+class GCSPhotoBackend:
+    """
+    Variants stored as Cloud Storage objects. URLs are Firebase Storage
+    download URLs carrying the object's download token, so they work with
+    a private bucket, like the client's getDownloadURL(). With
+    PHOTO_PUBLIC_BASE_URL set, URLs point at that prefix instead.
+    """
+
+    def __init__(self, bucket_name: str | None = PHOTO_BUCKET, base_url: str | None = PHOTO_PUBLIC_BASE_URL):
+        self.bucket_name = bucket_name
+        self.base_url = base_url
+        self._bucket = None
+        self._tokens = {}  # path -> download token of objects this instance uploaded
+
+    def _get_bucket(self):
+        if self._bucket is None:
+            # Imported lazily: only plan generation stores photos.
+            from firebase_admin import storage
+            self._bucket = storage.bucket(self.bucket_name)
+        return self._bucket
+
+    def exists(self, path: str) -> bool:
+        return self._get_bucket().blob(path).exists()
+
+    def put(self, path: str, data: bytes, content_type: str) -> None:
+        blob = self._get_bucket().blob(path)
+        blob.cache_control = PHOTO_CACHE_CONTROL
+        token = uuid.uuid4().hex
+        blob.metadata = {DOWNLOAD_TOKENS_METADATA: token}
+        blob.upload_from_string(data, content_type=content_type)
+        self._tokens[path] = token
+
+    def _download_token(self, path: str) -> str:
+        token = self._tokens.get(path)
+        if token:
+            return token
+        blob = self._get_bucket().get_blob(path)
+        if blob is None:
+            raise FileNotFoundError(path)
+        metadata = blob.metadata or {}
+        # The metadata may list several comma-separated tokens; any of them works.
+        token = (metadata.get(DOWNLOAD_TOKENS_METADATA) or "").split(",")[0]
+        if not token:
+            # Objects stored before download tokens were set get one now.
+            token = uuid.uuid4().hex
+            blob.metadata = {**metadata, DOWNLOAD_TOKENS_METADATA: token}
+            blob.patch()
+        self._tokens[path] = token
+        return token
+
+    def url(self, path: str) -> str:
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/{path}"
+        bucket = self._get_bucket().name
+        return (f"https://firebasestorage.googleapis.com/v0/b/{bucket}/o/{urllib.parse.quote(path, safe='')}"
+                f"?alt=media&token={self._download_token(path)}")
+
+
+class LocalPhotoBackend:
+    """Filesystem stand-in for GCSPhotoBackend."""
+
+    def __init__(self, root: str = PHOTO_LOCAL_DIR, base_url: str | None = PHOTO_PUBLIC_BASE_URL):
+        self.root = Path(root)
+        self.base_url = base_url
+
+    def exists(self, path: str) -> bool:
+        return (self.root / path).exists()
+
+    def put(self, path: str, data: bytes, content_type: str) -> None:
+        target = self.root / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # Written under a temporary name first, so readers never see half a file.
+        partial = target.with_name(f".{target.name}.{os.getpid()}.partial")
+        partial.write_bytes(data)
+        os.replace(partial, target)
+
+    def url(self, path: str) -> str:
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/{path}"
+        return (self.root / path).resolve().as_uri()
+
+
+def _default_backend():
+    if PHOTO_STORE_BACKEND == "local":
+        return LocalPhotoBackend()
+    return GCSPhotoBackend()
+
+
+class PhotoStore:
+    """
+    Resized copies of Places photos, stored once per photo reference.
+
+    A photo is fetched from the Places Photo API only the first time any plan
+    uses it; afterwards its variant URLs come from the store (or this
+    instance's memory) without external calls.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or _default_backend()
+        self._known = LRUCache()
+
+    def _paths(self, photo_reference: str) -> dict:
+        key = photo_key(photo_reference)
+        return {name: f"{PHOTO_PATH_PREFIX}/{key}/{name}.jpg" for name in PHOTO_VARIANTS}
+
+    def _store_one(self, photo_reference: str, fetch) -> dict | None:
+        urls = self._known.get(photo_reference)
+        if urls is not None:
+            instrumentation.count("photos.local_hits")
+            return urls
+
+        paths = self._paths(photo_reference)
+        try:
+            # The smallest variant is written last, so its presence means the set is complete.
+            if self.backend.exists(paths["thumbnail"]):
+                instrumentation.count("photos.store_hits")
+            else:
+                instrumentation.count("photos.api_calls")
+                with instrumentation.span("photos.fetch"):
+                    content = fetch(photo_reference)
+                instrumentation.count("photos.bytes_fetched", len(content))
+                with instrumentation.span("photos.render"):
+                    variants = render_variants(content)
+                if not variants:
+                    return None
+                with instrumentation.span("photos.upload"):
+                    for name, data in variants.items():
+                        self.backend.put(paths[name], data, "image/jpeg")
+                instrumentation.count("photos.bytes_stored", sum(len(data) for data in variants.values()))
+            urls = {name: self.backend.url(path) for name, path in paths.items()}
+        except Exception as e:
+            logging.warning(f"Could not store place photo {photo_reference[:16]}…: {e}")
+            instrumentation.count("photos.errors")
+            return None
+
+        self._known.set(photo_reference, urls, KNOWN_PHOTOS_TTL_SEC)
+        return urls
+
+    def store_photos(self, photo_references, fetch) -> dict:
+        """
+        Makes sure every photo reference has its variants stored, calling
+        fetch(photo_reference) -> bytes for the ones that don't. Returns
+        {photo_reference: {variant: url}}; failed photos are left out.
+        """
+        references = list(dict.fromkeys(ref for ref in photo_references if ref))
+        if not references or Image is None:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(MAX_PHOTO_WORKERS, len(references))) as executor:
+            futures = {ref: executor.submit(instrumentation.bind(self._store_one), ref, fetch) for ref in references}
+        results = {ref: future.result() for ref, future in futures.items()}
+        return {ref: urls for ref, urls in results.items() if urls}
+
+
+photo_store = PhotoStore()
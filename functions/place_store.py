@@ -0,0 +1,256 @@
+# place_store.py
+
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import firestore
+
+import instrumentation
+from maps_cache import LRUCache
+from prompt_builder import haversine_km
+
+# One placeIndex/{placeId} document per place, with a "geohash" field that
+# lookups query by prefix range, filtered on "types" (composite index in
+# firestore.indexes.json).
+PLACE_INDEX_COLLECTION = "placeIndex"
+# Precision of the stored geohash (precision 9 cells are under 5m x 5m).
+GEOHASH_PRECISION = 9
+# A lookup uses the finest geohash prefixes that cover its circle with at
+# most this many range queries.
+MAX_PREFIX_QUERIES = 9
+# Firestore's limit for writes in one batch.
+MAX_BATCH_WRITES = 500
+# Firestore's limit for array_contains_any values.
+MAX_TYPES_PER_QUERY = 30
+# Upper bound on the documents one prefix query reads. Hitting it only costs
+# matches (and possibly a fallback to the Places API), never correctness.
+MAX_PLACES_PER_PREFIX = int(os.environ.get("PLACE_STORE_MAX_PER_PREFIX", "200"))
+# A query is only served locally when it finds at least this many places
+# fetched within the staleness window.
+MIN_PLACES_PER_QUERY = int(os.environ.get("PLACE_STORE_MIN_PLACES", "8"))
+STALE_AFTER_SEC = float(os.environ.get("PLACE_STORE_STALE_DAYS", "14")) * 24 * 3600
+PREFIX_CACHE_TTL_SEC = 600
+# Lookup radius; smaller than the Places search radius to keep reads low.
+STORE_RADIUS_KM = float(os.environ.get("PLACE_STORE_RADIUS_KM", "10"))
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lat: float, lng: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value, value_range = (lng, lng_range) if even else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            value_range[0] = mid
+        else:
+            bits <<= 1
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def _cell_size_deg(precision: int) -> tuple[float, float]:
+    """(lat, lng) size in degrees of a geohash cell."""
+    lng_bits = math.ceil(precision * 5 / 2)
+    lat_bits = math.floor(precision * 5 / 2)
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def cells_covering(center: dict, radius_km: float, precision: int = GEOHASH_PRECISION) -> list:
+    """Geohash cells that intersect the bounding box of a circle."""
+    lat_step, lng_step = _cell_size_deg(precision)
+    dlat = radius_km / 111.0
+    dlng = radius_km / (111.0 * max(math.cos(math.radians(center["lat"])), 0.01))
+    cells = []
+    lat = center["lat"] - dlat
+    while lat <= center["lat"] + dlat + lat_step:
+        lng = center["lng"] - dlng
+        while lng <= center["lng"] + dlng + lng_step:
+            cell = geohash_encode(max(min(lat, 90.0), -90.0), (lng + 180.0) % 360.0 - 180.0, precision)
+            if cell not in cells:
+                cells.append(cell)
+            lng += lng_step
+        lat += lat_step
+    return cells
+
+
+def query_prefixes(center: dict, radius_km: float) -> list:
+    """The longest geohash prefixes covering a circle in at most MAX_PREFIX_QUERIES cells."""
+    prefixes = cells_covering(center, radius_km, 1)
+    for precision in range(2, GEOHASH_PRECISION + 1):
+        cells = cells_covering(center, radius_km, precision)
+        if len(cells) > MAX_PREFIX_QUERIES:
+            break
+        prefixes = cells
+    return prefixes
+
+
+def _to_entry(place: dict) -> dict:
+    photos = place.get("photos") or []
+    return {
+        "place_id": place.get("place_id"),
+        "name": place.get("name"),
+        "address": place.get("address"),
+        "rating": place.get("rating"),
+        "geometry": place.get("geometry"),
+        "types": place.get("types") or [],
+        "photo_reference": photos[0].get("photo_reference") if photos else None,
+        "geohash": geohash_encode(place["geometry"]["lat"], place["geometry"]["lng"]),
+        "fetchedAt": time.time(),
+    }
+
+
+def _to_place(entry: dict) -> dict:
+    """Converts a stored entry back into the valid_places shape used by main.py."""
+    photo_reference = entry.get("photo_reference")
+    return {
+        "place_id": entry.get("place_id"),
+        "name": entry.get("name"),
+        "address": entry.get("address"),
+        "rating": entry.get("rating"),
+        "geometry": entry.get("geometry"),
+        "photos": [{"photo_reference": photo_reference}] if photo_reference else None,
+        "types": entry.get("types"),
+    }
+
+
+class PlaceStore:
+    """
+    Geohash-indexed store of place details we have already fetched.
+
+    Each placeIndex/{placeId} document holds a compact entry (name, address,
+    rating, location, types, photo reference) and the place's geohash.
+    Lookups run one range query per covering geohash prefix; recent query
+    results are kept in an in-process LRU.
+    """
+
+    def __init__(self, collection: str = PLACE_INDEX_COLLECTION):
+        self.collection = collection
+        self._prefixes = LRUCache(max_entries=500)
+        self.local_queries = 0
+        self.fallback_queries = 0
+
+    def _collection(self):
+        return firestore.client().collection(self.collection)
+
+    def index_places(self, places: list) -> None:
+        """Adds or refreshes one document per place, in batches of at most MAX_BATCH_WRITES."""
+        entries = {}
+        for place in places:
+            geometry = place.get("geometry") or {}
+            if not place.get("place_id") or "lat" not in geometry or "lng" not in geometry:
+                continue
+            entries[place["place_id"]] = _to_entry(place)
+        if not entries:
+            return
+
+        db = firestore.client()
+        items = list(entries.items())
+        try:
+            for start in range(0, len(items), MAX_BATCH_WRITES):
+                batch = db.batch()
+                for place_id, entry in items[start:start + MAX_BATCH_WRITES]:
+                    batch.set(self._collection().document(place_id), entry)
+                batch.commit()
+            logging.info(f"🗺️ Indexed {len(entries)} place(s).")
+        except Exception as e:
+            logging.warning(f"Could not index places: {e}")
+        # Drop stale local results of every prefix the places fall under.
+        for entry in entries.values():
+            for length in range(1, GEOHASH_PRECISION + 1):
+                self._prefixes.delete(entry["geohash"][:length])
+
+    def _query_prefix(self, prefix: str, types: list) -> list:
+        # "~" sorts after every geohash character, so this is the prefix's range.
+        entries = []
+        for start in range(0, len(types), MAX_TYPES_PER_QUERY):
+            query = (self._collection()
+                     .where("types", "array_contains_any", types[start:start + MAX_TYPES_PER_QUERY])
+                     .where("geohash", ">=", prefix)
+                     .where("geohash", "<", prefix + "~")
+                     .limit(MAX_PLACES_PER_PREFIX))
+            entries.extend(doc.to_dict() for doc in query.stream())
+        instrumentation.count("place_store.docs_read", len(entries))
+        return entries
+
+    def _load_prefixes(self, prefixes: list, place_types: set) -> list:
+        """Entries of `place_types` under the prefixes, cached per (prefix, types)."""
+        types = sorted(place_types)
+        types_key = ",".join(types)
+        entries = []
+        missing = []
+        for prefix in prefixes:
+            cached = (self._prefixes.get(prefix) or {}).get(types_key)
+            if cached is None:
+                missing.append(prefix)
+            else:
+                entries.extend(cached)
+        if missing:
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                futures = [executor.submit(instrumentation.bind(self._query_prefix), prefix, types)
+                           for prefix in missing]
+            for prefix, future in zip(missing, futures):
+                found = future.result()
+                by_types = {**(self._prefixes.get(prefix) or {}), types_key: found}
+                self._prefixes.set(prefix, by_types, PREFIX_CACHE_TTL_SEC)
+                entries.extend(found)
+        return entries
+
+    def find_places(self, center: dict, radius_km: float, place_types: set) -> list | None:
+        """
+        Places of any of `place_types` within `radius_km` of `center`.
+
+        Returns None when coverage is too thin or stale, in which case the
+        caller should fall back to the Places API. Results are ordered by
+        rating, then place ID, so they are deterministic.
+        """
+        try:
+            entries = self._load_prefixes(query_prefixes(center, radius_km), place_types)
+        except Exception as e:
+            logging.warning(f"Place store lookup failed: {e}")
+            self.fallback_queries += 1
+            return None
+
+        now = time.time()
+        matches = []
+        seen = set()
+        for entry in entries:
+            if entry.get("place_id") in seen:
+                continue  # Matched more than one chunk of types.
+            seen.add(entry.get("place_id"))
+            if now - entry.get("fetchedAt", 0) > STALE_AFTER_SEC:
+                continue
+            if not place_types.intersection(entry.get("types") or []):
+                continue
+            geometry = entry.get("geometry") or {}
+            if "lat" not in geometry or haversine_km(geometry, center) > radius_km:
+                continue
+            matches.append(_to_place(entry))
+
+        if len(matches) < MIN_PLACES_PER_QUERY:
+            self.fallback_queries += 1
+            return None
+        self.local_queries += 1
+        matches.sort(key=lambda p: (-(p.get("rating") or 0), p.get("place_id")))
+        return matches
+
+    def stats(self) -> dict:
+        return {"local_queries": self.local_queries, "fallback_queries": self.fallback_queries}
+
+
+place_store = PlaceStore()
@@ -0,0 +1,115 @@
+# places_fetch.py
+
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import instrumentation
+from rate_limits import deadline
+
+# Fields requested for every candidate place.
+PLACE_DETAIL_FIELDS = ['place_id', 'name', 'vicinity', 'rating', 'geometry', 'photo', 'type']
+
+SEARCH_RADIUS_METERS = 20000
+MAX_CANDIDATES = 15
+
+# Bounded pool shared by the search and details stages.
+MAX_WORKERS = 8
+# Upper bound for a single Maps call. Also passed to googlemaps.Client in main.py.
+CALL_TIMEOUT_SEC = 10
+# Extra stage time for rate limiter waits. Calls that can't get a token in
+# time fail fast (and are logged) instead of timing out unnoticed.
+LIMITER_WAIT_BUDGET_SEC = 5
+
+
+def _run_concurrently(func, items: list, label: str) -> list:
+    """
+    Runs func(item) for every item on a bounded thread pool.
+
+    Returns one result per item in the same order as `items`. Calls that raise
+    or do not finish in time yield None instead of failing the whole stage.
+    """
+    if not items:
+        return []
+
+    workers = min(MAX_WORKERS, len(items))
+    # Each "wave" of workers gets one call timeout, so the stage is bounded by
+    # the slowest call rather than by the sum of all calls.
+    stage_timeout = CALL_TIMEOUT_SEC * math.ceil(len(items) / workers) + LIMITER_WAIT_BUDGET_SEC
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        # Calls must start early enough to finish within the stage.
+        with deadline(stage_timeout - CALL_TIMEOUT_SEC):
+            futures = [executor.submit(instrumentation.bind(func), item) for item in items]
+        _, not_done = wait(futures, timeout=stage_timeout)
+    finally:
+        # Don't block on stragglers; their results are discarded.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    results = []
+    for item, future in zip(items, futures):
+        if future in not_done:
+            logging.warning(f"⏱️ {label} for '{item}' timed out after {stage_timeout}s. Skipping.")
+            results.append(None)
+            continue
+        error = future.exception()
+        if error is not None:
+            logging.warning(f"⚠️ {label} for '{item}' failed: {error}. Skipping.")
+            results.append(None)
+            continue
+        results.append(future.result())
+    return results
+
+
+def search_candidates(gmaps_client, search_keywords: list, location: dict) -> list:
+    """
+    Runs one Places text search per keyword concurrently.
+
+    Returns de-duplicated candidate summaries ({place_id, name, rating,
+    geometry, types}), ordered by keyword and then by the rank Places returned
+    them in, so the candidate list is deterministic.
+    """
+    def _search(keyword):
+        return gmaps_client.places(query=keyword, location=location, radius=SEARCH_RADIUS_METERS)
+
+    candidates = {}
+    for places_result in _run_concurrently(_search, list(search_keywords), "Places search"):
+        if not places_result:
+            continue
+        for place in places_result.get('results', []):
+            candidates.setdefault(place['place_id'], {
+                "place_id": place['place_id'],
+                "name": place.get('name'),
+                "rating": place.get('rating'),
+                "geometry": place.get('geometry', {}).get('location', {}),
+                "types": place.get('types'),
+            })
+    return list(candidates.values())
+
+
+def fetch_valid_places(gmaps_client, place_ids: list) -> list:
+    """
+    Fetches details for each place ID concurrently and keeps only rated places.
+
+    The returned list follows the order of `place_ids`.
+    """
+    def _details(place_id):
+        return gmaps_client.place(place_id=place_id, fields=PLACE_DETAIL_FIELDS)
+
+    valid_places = []
+    for details in _run_concurrently(_details, list(place_ids), "Place details"):
+        if not details:
+            continue
+        place_data = details.get('result', {})
+        if place_data.get('rating'):
+            valid_places.append({
+                "place_id": place_data.get('place_id'),
+                "name": place_data.get('name'),
+                "address": place_data.get('vicinity'),
+                "rating": place_data.get('rating'),
+                "geometry": place_data.get('geometry', {}).get('location', {}),
+                "photos": place_data.get('photos'),
+                "types": place_data.get('types')
+            })
+    return valid_places
@@ -0,0 +1,121 @@
+# plan_progress.py
+
+import json
+import logging
+import os
+import threading
+import time
+
+# Firestore sustains about one write per second per document.
+PROGRESS_MIN_INTERVAL_SEC = float(os.environ.get("PROGRESS_MIN_INTERVAL_SEC", "1.0"))
+
+
+class ThrottledDocWriter:
+    """
+    Coalesces progress updates to a single document.
+
+    Fields passed to update() are merged into a pending payload, which is
+    written at most once per `min_interval_sec`. flush() writes whatever is
+    still pending, so the last state always reaches Firestore.
+    """
+
+    def __init__(self, doc_ref, min_interval_sec: float = PROGRESS_MIN_INTERVAL_SEC):
+        self.doc_ref = doc_ref
+        self.min_interval_sec = min_interval_sec
+        self._pending = {}
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+        self.writes = 0
+
+    def update(self, fields: dict) -> None:
+        with self._lock:
+            self._pending.update(fields)
+            if time.monotonic() - self._last_write < self.min_interval_sec:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._pending:
+                return
+            payload, self._pending = self._pending, {}
+            self._last_write = time.monotonic()
+            self.writes += 1
+        try:
+            self.doc_ref.update(payload)
+        except Exception as e:
+            # Progress is best-effort; the final status write is what matters.
+            logging.warning(f"Progress update failed: {e}")
+
+
+class PlanStepStreamParser:
+    """
+    Incrementally extracts complete step objects from a streamed
+    {"plan": [ {...}, {...} ], ...} response.
+
+    feed() takes the next text chunk and returns the steps that became
+    complete with it. Strings and escapes are tracked so braces inside
+    descriptions don't confuse the scanner.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._in_plan = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._step_start = None
+        self._done = False
+
+    def feed(self, chunk: str) -> list:
+        self._buffer += chunk
+        steps = []
+        if self._done:
+            return steps
+
+        if not self._in_plan:
+            key = self._buffer.find('"plan"')
+            if key == -1:
+                return steps
+            bracket = self._buffer.find("[", key)
+            if bracket == -1:
+                return steps
+            self._in_plan = True
+            self._pos = bracket + 1
+
+        while self._pos < len(self._buffer):
+            char = self._buffer[self._pos]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    self._step_start = self._pos
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0 and self._step_start is not None:
+                    raw = self._buffer[self._step_start:self._pos + 1]
+                    self._step_start = None
+                    try:
+                        steps.append(json.loads(raw))
+                    except json.JSONDecodeError:
+                        logging.warning("Skipping a streamed plan step that is not valid JSON.")
+            elif char == "]" and self._depth == 0:
+                self._done = True
+                self._pos += 1
+                break
+            self._pos += 1
+        return steps
+
+    @property
+    def text(self) -> str:
+        """The full text received so far."""
+        return self._buffer
@@ -0,0 +1,160 @@
+# plan_queue.py
+
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from firebase_admin import firestore
+
+QUEUE_COLLECTION = "planQueue"
+QUEUE_STATE_DOC = "state"
+PENDING_SUBCOLLECTION = "pending"
+SLOTS_SUBCOLLECTION = "slots"
+# Plans allowed to run at once across all instances. Each slot is its own
+# document, so concurrent plan starts write to different documents.
+MAX_IN_FLIGHT = int(os.environ.get("PLAN_MAX_IN_FLIGHT", "20"))
+# A slot whose holder stopped renewing it (e.g. crashed) frees itself after this long.
+SLOT_LEASE_SEC = 180
+# Running plans renew their slot this often.
+SLOT_RENEW_SEC = 60
+# Free slots tried before giving up when other starts win the races for them.
+SLOT_CLAIM_ATTEMPTS = 3
+
+
+def _state_ref():
+    return firestore.client().collection(QUEUE_COLLECTION).document(QUEUE_STATE_DOC)
+
+
+def _pending_ref(plan_path: str):
+    doc_id = hashlib.sha256(plan_path.encode("utf-8")).hexdigest()
+    return _state_ref().collection(PENDING_SUBCOLLECTION).document(doc_id)
+
+
+def _slot_ref(index):
+    return _state_ref().collection(SLOTS_SUBCOLLECTION).document(str(index))
+
+
+def _slot_key(plan_path: str) -> str:
+    return hashlib.sha256(plan_path.encode("utf-8")).hexdigest()[:32]
+
+
+@firestore.transactional
+def _claim_slot(transaction, slot_ref, plan_key: str, owner: str, pending_ref) -> bool:
+    snapshot = slot_ref.get(transaction=transaction)
+    slot = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    if slot.get("expiresAt", 0) > time.time():
+        return False
+    transaction.set(slot_ref, {"plan": plan_key, "owner": owner, "expiresAt": time.time() + SLOT_LEASE_SEC})
+    if pending_ref is not None:
+        transaction.delete(pending_ref)
+    return True
+
+
+@firestore.transactional
+def _update_if_owner(transaction, slot_ref, owner: str, fields: dict) -> bool:
+    snapshot = slot_ref.get(transaction=transaction)
+    if not snapshot.exists or (snapshot.to_dict() or {}).get("owner") != owner:
+        return False
+    transaction.update(slot_ref, fields)
+    return True
+
+
+class SlotLease:
+    """
+    A held plan slot. `shared` is True when the plan already held the slot
+    (a duplicate delivery of a running plan); such a lease should only be
+    released by the delivery that actually ran the plan.
+    """
+
+    def __init__(self, slot_id: str, owner: str, shared: bool = False):
+        self.slot_id = slot_id
+        self.owner = owner
+        self.shared = shared
+
+    def renew(self) -> bool:
+        try:
+            return _update_if_owner(firestore.client().transaction(), _slot_ref(self.slot_id), self.owner,
+                                    {"expiresAt": time.time() + SLOT_LEASE_SEC})
+        except Exception as e:
+            logging.warning(f"Could not renew plan slot {self.slot_id}: {e}")
+            return False
+
+    def release(self) -> None:
+        try:
+            _update_if_owner(firestore.client().transaction(), _slot_ref(self.slot_id), self.owner,
+                             {"plan": None, "owner": None, "expiresAt": 0})
+        except Exception as e:
+            logging.warning(f"Could not release plan slot {self.slot_id}: {e}")
+
+    @contextmanager
+    def keep_alive(self):
+        """Renews the slot every SLOT_RENEW_SEC until the block exits."""
+        stopped = threading.Event()
+
+        def _renew():
+            while not stopped.wait(SLOT_RENEW_SEC):
+                if not self.renew():
+                    logging.warning(f"Lost plan slot {self.slot_id}.")
+                    return
+
+        thread = threading.Thread(target=_renew, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stopped.set()
+
+
+def try_acquire(plan_path: str, dequeue: bool = False) -> SlotLease | None:
+    """
+    Takes one of the MAX_IN_FLIGHT plan slots. With `dequeue`, the plan's
+    pending queue entry is removed in the same transaction.
+
+    Returns None when every slot is busy or the queue can't be reached; the
+    caller queues the plan then, so the cap also holds under contention.
+    """
+    plan_key = _slot_key(plan_path)
+    try:
+        db = firestore.client()
+        now = time.time()
+        free = []
+        for snapshot in db.get_all([_slot_ref(index) for index in range(MAX_IN_FLIGHT)]):
+            slot = (snapshot.to_dict() or {}) if snapshot.exists else {}
+            if slot.get("expiresAt", 0) <= now:
+                free.append(snapshot.reference)
+            elif slot.get("plan") == plan_key:
+                return SlotLease(snapshot.id, slot.get("owner"), shared=True)
+        random.shuffle(free)
+        owner = uuid.uuid4().hex
+        pending_ref = _pending_ref(plan_path) if dequeue else None
+        for slot_ref in free[:SLOT_CLAIM_ATTEMPTS]:
+            if _claim_slot(db.transaction(), slot_ref, plan_key, owner, pending_ref):
+                return SlotLease(slot_ref.id, owner)
+    except Exception as e:
+        logging.warning(f"Could not take a plan slot for {plan_path}: {e}")
+    return None
+
+
+def enqueue(plan_path: str) -> None:
+    """Parks a plan until drain_plan_queue finds a free slot. Idempotent per plan."""
+    _pending_ref(plan_path).set({"path": plan_path, "enqueuedAt": time.time()})
+
+
+def oldest_pending(limit: int) -> list:
+    """Returns up to `limit` queued plans as (path, enqueued_at), oldest first."""
+    docs = (
+        _state_ref().collection(PENDING_SUBCOLLECTION)
+        .order_by("enqueuedAt")
+        .limit(limit)
+        .stream()
+    )
+    return [(doc.get("path"), doc.get("enqueuedAt")) for doc in docs]
+
+
+def queue_depth() -> int:
+    return int(_state_ref().collection(PENDING_SUBCOLLECTION).count().get()[0][0].value)
@@ -1,78 +1,196 @@
 # post_notifications.py
 
 import logging
+import os
+import time
 import firebase_admin
 from firebase_admin import firestore, messaging
-from firebase_functions import firestore_fn
+from firebase_functions import scheduler_fn
+
+import instrumentation
 
 # IMPORTANT: Do NOT initialize the app here. main.py handles that.
+# Called by posts.onPostInteraction, which owns the posts/{postId} update trigger.
 
-@firestore_fn.on_document_updated(document="posts/{postId}")
-def send_like_notification(event: firestore_fn.Event[firestore_fn.Change]) -> None:
-    """
-    Triggers when a post document is updated. If a new user was added to the
-    'likedBy' array, it sends a notification to the post's author.
-    """
-    db = firebase_admin.firestore.client()
+# "immediate" sends one notification per update; "digest" buffers likes per
+# author and sends a summary from flush_like_digests.
+LIKE_NOTIFICATION_MODE = os.environ.get("LIKE_NOTIFICATION_MODE", "immediate")
+# A digest is sent once its oldest buffered like is at least this old...
+LIKE_DIGEST_WINDOW_SEC = float(os.environ.get("LIKE_DIGEST_WINDOW_SEC", "300"))
+# ...and the author hasn't received a digest within this interval.
+LIKE_DIGEST_MIN_INTERVAL_SEC = float(os.environ.get("LIKE_DIGEST_MIN_INTERVAL_SEC", "900"))
+LIKE_DIGESTS_COLLECTION = "likeDigests"
+# FCM's limit for messaging.send_each.
+FCM_BATCH_SIZE = 500
 
-    # Get the data before and after the change
-    before_data = event.data.before.to_dict()
-    after_data = event.data.after.to_dict()
 
-    before_likes = set(before_data.get("likedBy", []))
-    after_likes = set(after_data.get("likedBy", []))
+def _like_text(liker_username: str, total: int, post_count: int = 1) -> str:
+    target = "your post" if post_count <= 1 else f"{post_count} of your posts"
+    if total <= 1:
+        return f"{liker_username} liked {target}."
+    others = total - 1
+    return f"{liker_username} and {others} other{'s' if others > 1 else ''} liked {target}."
 
-    # Check if a new user was added to the likedBy array
-    new_likers = after_likes - before_likes
-    if not new_likers:
-        logging.info(f"No new likes on post {event.params['postId']}. Exiting.")
-        return
 
-    liker_id = new_likers.pop()
-    post_id = event.params["postId"]
-    author_id = after_data.get("userId")
+def _send_all(messages: list) -> None:
+    """Sends messages with send_each in chunks of FCM_BATCH_SIZE."""
+    for start in range(0, len(messages), FCM_BATCH_SIZE):
+        chunk = messages[start:start + FCM_BATCH_SIZE]
+        instrumentation.count("fcm.messages_sent", len(chunk))
+        try:
+            with instrumentation.span("fcm.send_each"):
+                response = messaging.send_each(chunk)
+            logging.info(f"Sent {response.success_count}/{len(chunk)} 'like' notification(s).")
+            for result in response.responses:
+                if not result.success:
+                    logging.error(f"Error sending 'like' notification: {result.exception}")
+        except Exception as e:
+            logging.error(f"Error sending 'like' notifications: {e}")
 
-    logging.info(f"New like on post {post_id} by user {liker_id}")
 
-    if not author_id or author_id == liker_id:
+def send_like_notifications(post_id: str, author_id: str | None, liker_ids: list) -> None:
+    """
+    Notifies the post's author about new likers.
+
+    Several likers arriving in one update produce a single "X and N others"
+    notification. In digest mode the likes are only buffered here.
+    """
+    liker_ids = [liker_id for liker_id in liker_ids if liker_id and liker_id != author_id]
+    if not author_id or not liker_ids:
         logging.info("Author not found or user liked their own post. No notification sent.")
         return
 
+    db = firebase_admin.firestore.client()
+
+    if LIKE_NOTIFICATION_MODE == "digest":
+        _buffer_likes(db, post_id, author_id, liker_ids)
+        return
+
+    # One round trip for the author's token and the liker's username.
+    latest_liker_id = liker_ids[-1]
     try:
-        author_ref = db.collection("users_token").document(author_id)
-        author_doc = author_ref.get()
-        if not author_doc.exists:
-            logging.error(f"Author {author_id} does not exist.")
-            return
-        fcm_token = author_doc.to_dict().get("fcmToken")
-        if not fcm_token:
-            logging.warning(f"Author {author_id} does not have an FCM token.")
-            return
+        tokens = db.collection("users_token")
+        with instrumentation.span("firestore.read_users"):
+            docs = {doc.id: doc for doc in db.get_all([tokens.document(author_id), tokens.document(latest_liker_id)])}
     except Exception as e:
         logging.error(f"Error getting author's FCM token: {e}")
         return
 
-    # Get Liker's Username
-    try:
-        liker_ref = db.collection("users_token").document(liker_id)
-        liker_doc = liker_ref.get()
-        liker_username = liker_doc.to_dict().get("username", "Someone") if liker_doc.exists else "Someone"
-    except Exception as e:
-        logging.error(f"Error getting liker's username: {e}")
-        liker_username = "Someone"
+    author_doc = docs.get(author_id)
+    if not author_doc or not author_doc.exists:
+        logging.error(f"Author {author_id} does not exist.")
+        return
+    fcm_token = author_doc.to_dict().get("fcmToken")
+    if not fcm_token:
+        logging.warning(f"Author {author_id} does not have an FCM token.")
+        return
+
+    liker_doc = docs.get(latest_liker_id)
+    liker_username = liker_doc.to_dict().get("username", "Someone") if liker_doc and liker_doc.exists else "Someone"
+
+    logging.info(f"{len(liker_ids)} new like(s) on post {post_id}, latest by user {latest_liker_id}")
 
     # Construct and Send Notification
     message = messaging.Message(
         notification=messaging.Notification(
             title="New Like! ❤️",
-            body=f"{liker_username} liked your post.",
+            body=_like_text(liker_username, len(liker_ids)),
         ),
         token=fcm_token,
         data={'postId': post_id, 'type': 'like'},
     )
+    _send_all([message])
 
+
+def _buffer_likes(db, post_id: str, author_id: str, liker_ids: list) -> None:
+    """
+    Adds likes to the author's pending digest without reading it first, so a
+    viral post doesn't cause transaction contention on the digest document.
+    """
     try:
-        response = messaging.send(message)
-        logging.info(f"Successfully sent 'like' notification: {response}")
+        db.collection(LIKE_DIGESTS_COLLECTION).document(author_id).set({
+            "pendingCount": firestore.Increment(len(liker_ids)),
+            "latestLikerId": liker_ids[-1],
+            "postIds": firestore.ArrayUnion([post_id]),
+            # Earliest buffered like; removed again when the digest is sent.
+            "windowStart": firestore.Minimum(time.time()),
+        }, merge=True)
+        logging.info(f"Buffered {len(liker_ids)} like(s) on post {post_id} for author {author_id}'s digest.")
     except Exception as e:
-        logging.error(f"Error sending 'like' notification: {e}")
\ No newline at end of file
+        logging.error(f"Error buffering likes for author {author_id}: {e}")
+
+
+@firestore.transactional
+def _claim_digest(transaction, digest_ref, now: float) -> dict | None:
+    """Resets a due digest and returns its contents, or None if it isn't due."""
+    snapshot = digest_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else None
+    if not data or not data.get("pendingCount") or data.get("windowStart") is None:
+        return None
+    if now - data["windowStart"] < LIKE_DIGEST_WINDOW_SEC:
+        return None
+    if now - data.get("lastSentAt", 0) < LIKE_DIGEST_MIN_INTERVAL_SEC:
+        return None
+    transaction.update(digest_ref, {
+        "pendingCount": 0,
+        "postIds": [],
+        "windowStart": firestore.DELETE_FIELD,
+        "lastSentAt": now,
+    })
+    return data
+
+
+@scheduler_fn.on_schedule(schedule="every 5 minutes")
+@instrumentation.instrumented()
+def flush_like_digests(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Sends pending like digests ("Alice and 12 others liked your post") whose
+    window has elapsed, using bulk reads and bulk FCM sends.
+    """
+    if LIKE_NOTIFICATION_MODE != "digest":
+        return
+
+    db = firebase_admin.firestore.client()
+    now = time.time()
+    due_docs = (
+        db.collection(LIKE_DIGESTS_COLLECTION)
+        .where("windowStart", "<=", now - LIKE_DIGEST_WINDOW_SEC)
+        .stream()
+    )
+
+    digests = {}
+    for doc in due_docs:
+        try:
+            data = _claim_digest(db.transaction(), doc.reference, now)
+        except Exception as e:
+            logging.error(f"Error claiming like digest for author {doc.id}: {e}")
+            continue
+        if data:
+            digests[doc.id] = data
+    if not digests:
+        logging.info("No like digests due.")
+        return
+
+    # Bulk read: every author's token and every latest liker's username at once.
+    tokens = db.collection("users_token")
+    user_ids = set(digests) | {d.get("latestLikerId") for d in digests.values() if d.get("latestLikerId")}
+    user_docs = {doc.id: doc.to_dict() for doc in db.get_all([tokens.document(uid) for uid in user_ids]) if doc.exists}
+
+    messages = []
+    for author_id, data in digests.items():
+        fcm_token = user_docs.get(author_id, {}).get("fcmToken")
+        if not fcm_token:
+            logging.warning(f"Author {author_id} does not have an FCM token.")
+            continue
+        liker_username = user_docs.get(data.get("latestLikerId"), {}).get("username", "Someone")
+        post_ids = data.get("postIds", [])
+        messages.append(messaging.Message(
+            notification=messaging.Notification(
+                title="New Likes! ❤️",
+                body=_like_text(liker_username, int(data["pendingCount"]), len(post_ids)),
+            ),
+            token=fcm_token,
+            data={'postId': post_ids[-1] if post_ids else '', 'type': 'like_digest'},
+        ))
+    instrumentation.count("like_digests.sent", len(messages))
+    _send_all(messages)
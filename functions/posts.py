@@ -1,11 +1,28 @@
 # posts.py
 
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from firebase_admin import firestore
 from firebase_functions import firestore_fn
-from google.cloud import vision
+from label_cache import LabelCache, content_hash, download_image, perceptual_hash
+from taxonomy_index import taxonomy_index
+from post_notifications import send_like_notifications
+from preference_writer import preference_writes
+import event_ledger
+import feed_engine
+import instrumentation
+import likes
+
+# Minimum Vision label score for a tag to be kept.
+AUTOTAG_MIN_SCORE = float(os.environ.get("AUTOTAG_MIN_SCORE", "0.75"))
+# Vision's limit for images per synchronous batch annotate request.
+VISION_BATCH_SIZE = 16
+
+_label_cache = LabelCache()
 
 @firestore_fn.on_document_created(document="posts/{postId}")
+@instrumentation.instrumented()
 def autoTagPost(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None:
     """
     Analyzes a list of images from a new post, aggregates all relevant tags,
@@ -26,124 +43,286 @@ def autoTagPost(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None:
         logging.info(f"Post {post_ref.id} has no valid list of imageUrls. Skipping.")
         return
 
+    ledger = event_ledger.claim("autoTagPost", post_ref.path, event.id)
+    if ledger is None:
+        return
+
     logging.info(f"Analyzing {len(image_urls)} image(s) for post {post_ref.id}.")
-    
-    aggregated_tags = set()
 
     try:
-        # LAZY INITIALIZATION: Initialize the client inside the function.
-        client = vision.ImageAnnotatorClient()
-
-        # LOOP: Analyze each image URL from the list.
-        for url in image_urls:
-            if not url: # Skip empty URL strings
-                continue
-            
-            logging.info(f"Processing URL: {url}")
-            image = vision.Image(source=vision.ImageSource(image_uri=url))
-            response = client.label_detection(image=image)
-            labels = response.label_annotations
-
-            # Add high-confidence labels to the set.
-            for label in labels:
-                if label.score > 0.75:
-                    aggregated_tags.add(label.description.lower())
+        urls = [url for url in image_urls if url]  # Skip empty URL strings
+        final_tags = ledger.stage("labels", lambda: _collect_tags(urls))
 
         # WRITE ONCE: After analyzing all images, update Firestore a single time.
-        if aggregated_tags:
-            # Convert the set to a list for Firestore.
-            final_tags = list(aggregated_tags)
+        if final_tags:
             logging.info(f"Aggregated unique tags: {', '.join(final_tags)}")
             post_ref.update({"AutoTags": final_tags})
+            feed_engine.index_post(post_ref.id, final_tags, post_data.get("userId"), post_data.get("timestamp"))
         else:
             logging.info("No tags above the confidence threshold were found in any image.")
+        ledger.complete()
 
     except Exception as e:
         logging.error(f"Error occurred during image processing for post {post_ref.id}: {e}", exc_info=True)
+        ledger.fail(e)
+
+def _collect_tags(urls: list) -> list:
+    """
+    Returns the sorted, unique high-confidence tags across all images.
+    """
+    aggregated_tags = set()
+
+    # FINGERPRINT: Download each image once and check the label cache, so
+    # reposted photos don't go through Vision again.
+    with instrumentation.span("images.fingerprint"):
+        images = _fingerprint_images(urls)
+    pending = []
+    for image in images:
+        cached = _label_cache.lookup(image["sha256"], image["phash"]) if image["sha256"] else None
+        if cached is not None:
+            _add_tags(aggregated_tags, cached)
+        else:
+            pending.append(image)
+    instrumentation.count("label_cache.hits", len(images) - len(pending))
+    instrumentation.count("label_cache.misses", len(pending))
+    logging.info(f"Label cache: {len(images) - len(pending)} hit(s), {len(pending)} miss(es). {_label_cache.stats()}")
+
+    if pending:
+        # LAZY IMPORT + INITIALIZATION: google.cloud.vision is only loaded by
+        # instances that actually tag posts, not by every trigger in main.py.
+        from google.cloud import vision
+        client = vision.ImageAnnotatorClient()
+
+        # BATCH: Send all uncached images in as few requests as possible.
+        with instrumentation.span("vision.label_detection"):
+            detected = _detect_labels(client, vision, pending)
+        for image, labels in zip(pending, detected):
+            if labels is None:
+                continue
+            _add_tags(aggregated_tags, labels)
+            if image["sha256"]:
+                _label_cache.store_labels(image["sha256"], image["phash"], labels)
+
+    return sorted(aggregated_tags)
+
+def _add_tags(tags: set, labels: list) -> None:
+    """Adds high-confidence labels to the set."""
+    for label in labels:
+        if label["score"] > AUTOTAG_MIN_SCORE:
+            tags.add(label["description"].lower())
+
+def _fingerprint_images(urls: list) -> list:
+    """
+    Downloads images concurrently and fingerprints them.
+
+    Returns one dict per URL with "url", "sha256" and "phash". Images that
+    could not be downloaded have no hashes and always go to Vision.
+    """
+    if not urls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(8, len(urls))) as executor:
+        futures = [executor.submit(instrumentation.bind(download_image), url) for url in urls]
+        contents = [future.result() for future in futures]
+    instrumentation.count("images.bytes_downloaded", sum(len(content) for content in contents if content))
+
+    images = []
+    for url, content in zip(urls, contents):
+        images.append({
+            "url": url,
+            "sha256": content_hash(content) if content else None,
+            "phash": perceptual_hash(content) if content else None,
+        })
+    return images
+
+def _detect_labels(client, vision, images: list) -> list:
+    """
+    Runs label detection for all images using batched annotate requests.
+
+    Images are sent by URI to keep requests small. Chunks are sent
+    concurrently, so latency stays close to a single round trip. Returns one
+    entry per image in input order: a list of {"description", "score"} dicts,
+    or None if that image (or its whole chunk) failed.
+    """
+    chunks = [images[i:i + VISION_BATCH_SIZE] for i in range(0, len(images), VISION_BATCH_SIZE)]
+    if not chunks:
+        return []
+
+    def _annotate(chunk):
+        requests = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(source=vision.ImageSource(image_uri=image["url"])),
+                features=[vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION)],
+            )
+            for image in chunk
+        ]
+        instrumentation.count("vision.images_sent", len(chunk))
+        try:
+            return client.batch_annotate_images(requests=requests).responses
+        except Exception as e:
+            logging.error(f"Batch label detection failed for {len(chunk)} image(s): {e}")
+            return [None] * len(chunk)
+
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        futures = [executor.submit(instrumentation.bind(_annotate), chunk) for chunk in chunks]
+        chunk_results = [future.result() for future in futures]
+
+    results = []
+    for chunk, responses in zip(chunks, chunk_results):
+        for image, response in zip(chunk, responses):
+            if response is None:
+                results.append(None)
+            elif response.error.message:
+                logging.warning(f"Label detection failed for {image['url']}: {response.error.message}")
+                results.append(None)
+            else:
+                results.append([
+                    {"description": label.description, "score": label.score}
+                    for label in response.label_annotations
+                ])
+    return results
 
 def _update_user_preferences(user_id: str, post_tags: list, weight: int):
     """
     Updates a user's preference scores based on post tags.
 
+    Increments are queued on preference_writes; the trigger must flush them
+    before it returns.
+
     Args:
         user_id (str): The ID of the user to update.
         post_tags (list): A list of tags from the post.
         weight (int): The value to increment the score by (e.g., 1 for a like, -1 for an unlike).
     """
-    print(f"--- _update_user_preferences called with user_id: {user_id}, post_tags: {post_tags}, weight: {weight} ---")
+    logging.debug(f"_update_user_preferences called with user_id: {user_id}, post_tags: {post_tags}, weight: {weight}")
     if not user_id or not isinstance(post_tags, list) or not post_tags:
-        print("Invalid input for preference update. Skipping.")
+        logging.info("Invalid input for preference update. Skipping.")
         return
 
-    db = firestore.client() 
-    
     try:
-        taxonomy_ref = db.collection("taxonomies").document("master_list")
-        taxonomies_doc = taxonomy_ref.get()
-        if not taxonomies_doc.exists:
-            logging.error("Taxonomy document 'master_list' not found. Cannot categorize tags.")
+        if not taxonomy_index.ensure_loaded():
             return
-        taxonomies = taxonomies_doc.to_dict()
     except Exception as e:
         logging.error(f"Failed to fetch taxonomies: {e}", exc_info=True)
         return
-        
-    user_ref = db.collection("users").document(user_id)
-    lower_case_post_tags = {tag.lower() for tag in post_tags}
+
     update_payload = {}
-    
-    for category, valid_tags in taxonomies.items():
-        if isinstance(valid_tags, list):
-            matched_tags = lower_case_post_tags.intersection({t.lower() for t in valid_tags})
-            for tag in matched_tags:
-                field_path = f"preferences.{category}.{tag}"
-                update_payload[field_path] = firestore.Increment(weight)
-            
-            print(f"--- ループ中 (カテゴリ: {category}) --- Payload: {update_payload}")
-
-    print(f"--- ループ終了後 (最終) --- Payload: {update_payload}")
-    
+    for category, matched_tags in taxonomy_index.categorize(post_tags).items():
+        for tag in matched_tags:
+            field_path = f"preferences.{category}.{tag}"
+            update_payload[field_path] = weight
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Preference payload for user {user_id}: {update_payload}")
+
     if update_payload:
-        logging.info(f"Updating preferences for user {user_id} with weight {weight}. Payload: {update_payload}")
-        
-        user_ref.update(update_payload)
-        
+        # Buffered and coalesced per user; callers flush via preference_writes.
+        logging.info(f"Queueing {len(update_payload)} preference update(s) for user {user_id} with weight {weight}.")
+        preference_writes.add(user_id, update_payload)
     else:
         logging.info(f"No tags from post matched any taxonomy for user {user_id}.")
 
 @firestore_fn.on_document_updated(document="posts/{postId}")
+@instrumentation.instrumented()
 def onPostInteraction(event: firestore_fn.Event[firestore_fn.Change]) -> None:
     """
-    Triggers on post updates to detect new likes or unlikes.
+    Single dispatcher for post updates.
+
+    Diffs 'likedBy' once and hands every added or removed user to the
+    preference updater, and every added user to the like notifier. This is
+    the path for clients still writing the legacy array; likes stored as
+    posts/{postId}/likes/{userId} go through onLikeCreated/onLikeDeleted.
     """
     before_data = event.data.before.to_dict() if event.data.before else {}
     after_data = event.data.after.to_dict() if event.data.after else {}
+    post_id = event.params["postId"]
 
-    if "likedBy" not in after_data or "AutoTags" not in after_data:
-        logging.info("Update was not related to 'likedBy' or 'AutoTags' are missing. Skipping.")
+    before_likers = before_data.get("likedBy", [])
+    after_likers = after_data.get("likedBy", [])
+    if before_likers == after_likers:
+        logging.info(f"Update to post {post_id} did not change 'likedBy'. Skipping.")
         return
 
+    before_set = set(before_likers)
+    after_set = set(after_likers)
+    # Keep array order so multi-user updates are processed deterministically.
+    new_likers = [user_id for user_id in dict.fromkeys(after_likers) if user_id not in before_set]
+    unlikers = [user_id for user_id in dict.fromkeys(before_likers) if user_id not in after_set]
+    if not new_likers and not unlikers:
+        logging.info(f"'likedBy' on post {post_id} was reordered only. Skipping.")
+        return
+    logging.info(f"Post {post_id}: {len(new_likers)} new like(s), {len(unlikers)} unlike(s).")
+
     post_tags = after_data.get("AutoTags", [])
-    before_likers = set(before_data.get("likedBy", []))
-    after_likers = set(after_data.get("likedBy", []))
+    if post_tags:
+        for liker_id in new_likers:
+            _update_user_preferences(liker_id, post_tags, weight=1)
+        for unliker_id in unlikers:
+            _update_user_preferences(unliker_id, post_tags, weight=-1)
+        preference_writes.flush()
+    else:
+        logging.info(f"Post {post_id} has no 'AutoTags'. Skipping preference updates.")
 
-    new_likers = after_likers - before_likers
     if new_likers:
-        liker_id = new_likers.pop()
-        print(f"User {liker_id} liked post {event.params['postId']}.")
-        _update_user_preferences(liker_id, post_tags, weight=1)
+        send_like_notifications(post_id, after_data.get("userId"), new_likers)
+
+
+def _apply_like(event, weight: int, notify: bool) -> None:
+    """
+    Shared body of onLikeCreated/onLikeDeleted: one shard increment, one
+    post read and one preference update per like, however popular the post.
+    """
+    post_id = event.params["postId"]
+    user_id = event.params["userId"]
+    like_path = f"posts/{post_id}/likes/{user_id}"
+
+    # Keyed by event as well, so a like after an unlike isn't mistaken for a redelivery.
+    ledger = event_ledger.claim("onLike" + ("Created" if weight > 0 else "Deleted"),
+                                f"{like_path}@{event.id}", event.id)
+    if ledger is None:
         return
 
-    # Case 2: Detect an "unlike" (a user was removed)
-    unlikers = before_likers - after_likers
-    if unlikers:
-        unliker_id = unlikers.pop()
-        logging.info(f"User {unliker_id} unliked post {event.params['postId']}.")
-        _update_user_preferences(unliker_id, post_tags, weight=-1)
+    try:
+        db = firestore.client()
+        likes.add_to_counter(db, post_id, weight)
+
+        post_doc = db.collection("posts").document(post_id).get()
+        post_data = post_doc.to_dict() if post_doc.exists else {}
+        post_tags = post_data.get("AutoTags", [])
+        if post_tags:
+            _update_user_preferences(user_id, post_tags, weight=weight)
+            preference_writes.flush()
+
+        if notify:
+            send_like_notifications(post_id, post_data.get("userId"), [user_id])
+        ledger.complete()
+    except Exception as e:
+        logging.error(f"Error processing like by {user_id} on post {post_id}: {e}", exc_info=True)
+        ledger.fail(e)
+
+
+@firestore_fn.on_document_created(document="posts/{postId}/likes/{userId}")
+@instrumentation.instrumented()
+def onLikeCreated(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None:
+    """
+    Triggers once per like stored as posts/{postId}/likes/{userId}.
+    """
+    if event.data is not None and (event.data.to_dict() or {}).get("backfilled"):
+        # Migrated from likedBy: counted by the backfill and already applied to preferences.
         return
+    _apply_like(event, weight=1, notify=True)
+
+
+@firestore_fn.on_document_deleted(document="posts/{postId}/likes/{userId}")
+@instrumentation.instrumented()
+def onLikeDeleted(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None:
+    """
+    Triggers once per unlike (the like document is deleted).
+    """
+    _apply_like(event, weight=-1, notify=False)
 
 
 @firestore_fn.on_document_created(document="users/{userId}/savedPosts/{postId}")
+@instrumentation.instrumented()
 def onPostSaved(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None:
     """
     Triggers when a user saves a post.
@@ -162,9 +341,28 @@ def onPostSaved(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None:
         
     post_tags = post_doc.to_dict().get("AutoTags", [])
     _update_user_preferences(user_id, post_tags, weight=1)
+    preference_writes.flush()
+
+
+@firestore_fn.on_document_deleted(document="posts/{postId}")
+@instrumentation.instrumented()
+def onPostDeleted(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None:
+    """
+    Triggers when a post is deleted. Removes its tag postings, so deleted
+    posts stop being scored into feeds.
+    """
+    post_id = event.params["postId"]
+    post_data = (event.data.to_dict() if event.data else None) or {}
+    tags = post_data.get("AutoTags") or []
+    if not tags:
+        logging.info(f"Deleted post {post_id} had no 'AutoTags'. Nothing to unindex.")
+        return
+    # Deletes are idempotent, so a redelivery simply repeats them.
+    feed_engine.unindex_post(post_id, tags)
 
 
 @firestore_fn.on_document_deleted(document="users/{userId}/savedPosts/{postId}")
+@instrumentation.instrumented()
 def onPostUnsaved(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None:
     """
     Triggers when a user unsaves a post (deletes the saved document).
@@ -186,3 +384,4 @@ def onPostUnsaved(event: firestore_fn.Event[firestore.DocumentSnapshot]) -> None
         
     post_tags = post_doc.to_dict().get("AutoTags", [])
     _update_user_preferences(user_id, post_tags, weight=-1)
+    preference_writes.flush()
@@ -0,0 +1,251 @@
+# preference_writer.py
+
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+from firebase_admin import firestore
+from firebase_functions import scheduler_fn
+
+import instrumentation
+
+# 0 writes users/{id} at the end of every event. A non-zero interval writes
+# each event's increments to a preferenceDeltas shard instead, and
+# fold_preference_deltas adds them to users/{id} about this often (rounded
+# up to whole minutes), so a user liking many posts gets one update per run.
+FLUSH_INTERVAL_SEC = float(os.environ.get("PREFERENCE_FLUSH_INTERVAL_SEC", "60"))
+# Firestore allows at most 500 writes per batch.
+MAX_BATCH_SIZE = min(int(os.environ.get("PREFERENCE_MAX_BATCH_SIZE", "500")), 500)
+PREFERENCE_DELTAS_COLLECTION = "preferenceDeltas"
+# Delta documents per user; events pick one at random, so concurrent likes
+# by one user rarely write the same document.
+DELTA_SHARDS = int(os.environ.get("PREFERENCE_DELTA_SHARDS", "4"))
+# Pages of up to MAX_BATCH_SIZE delta documents folded per scheduled run.
+MAX_FOLD_PAGES = 20
+
+
+def _nest(fields: dict) -> dict:
+    """{"a.b.c": v} -> {"a": {"b": {"c": v}}}, for set(merge=True)."""
+    nested = {}
+    for field_path, value in fields.items():
+        *parents, leaf = field_path.split(".")
+        node = nested
+        for key in parents:
+            node = node.setdefault(key, {})
+        node[leaf] = value
+    return nested
+
+
+def _flatten(nested: dict, prefix: str = "") -> dict:
+    """Inverse of _nest."""
+    fields = {}
+    for key, value in nested.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            fields.update(_flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)):
+            fields[path] = value
+    return fields
+
+
+def _user_payload(fields: dict) -> dict | None:
+    # Increments that cancelled out (like + unlike) don't need a write.
+    payload = {path: firestore.Increment(delta) for path, delta in fields.items() if delta}
+    if not payload:
+        return None
+    # Marks the user for the next feed refresh (feed_engine).
+    payload["preferencesUpdatedAt"] = firestore.SERVER_TIMESTAMP
+    return payload
+
+
+@firestore.transactional
+def _fold_users(transaction, db, refs_by_user: dict) -> int:
+    """Adds the users' delta documents to users/{id} and deletes them, atomically."""
+    refs = [ref for user_refs in refs_by_user.values() for ref in user_refs]
+    totals = {}
+    for snapshot in db.get_all(refs, transaction=transaction):
+        if not snapshot.exists:
+            continue
+        data = snapshot.to_dict() or {}
+        fields = totals.setdefault(data.get("userId"), {})
+        for path, delta in _flatten(data.get("deltas") or {}).items():
+            fields[path] = fields.get(path, 0) + delta
+        transaction.delete(snapshot.reference)
+    written = 0
+    for user_id, fields in totals.items():
+        payload = _user_payload(fields)
+        if user_id and payload:
+            transaction.update(db.collection("users").document(user_id), payload)
+            written += 1
+    return written
+
+
+class PreferenceWriteBuffer:
+    """
+    Coalesces preference increments per user document.
+
+    Increments for the same users/{id} field are summed in memory, so the
+    likes and unlikes of one event become one update per user, and updates
+    for different users are committed together in batched writes. Every
+    trigger must flush() before it returns, since the instance may be
+    throttled or shut down right after.
+
+    With a flush interval, flush() writes the sums to preferenceDeltas
+    shards, and fold() later adds every pending shard to users/{id}. Both
+    steps are durable, so coalescing across events survives instance
+    shutdowns.
+    """
+
+    def __init__(self, flush_interval_sec: float = FLUSH_INTERVAL_SEC, max_batch_size: int = MAX_BATCH_SIZE):
+        self.flush_interval_sec = flush_interval_sec
+        self.max_batch_size = max_batch_size
+        self._pending = {}  # user_id -> {field_path: delta}
+        self._lock = threading.Lock()
+        self.increments_buffered = 0
+        self.documents_written = 0
+        self.batches_committed = 0
+
+    def add(self, user_id: str, deltas: dict) -> None:
+        """Merges {field_path: delta} into the pending update for a user."""
+        with self._lock:
+            fields = self._pending.setdefault(user_id, {})
+            for field_path, delta in deltas.items():
+                fields[field_path] = fields.get(field_path, 0) + delta
+            self.increments_buffered += len(deltas)
+            full = len(self._pending) >= self.max_batch_size
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes all pending increments, one write per user."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        updates = [(user_id, fields) for user_id, fields in pending.items() if any(fields.values())]
+        if not updates:
+            return
+        if self.flush_interval_sec > 0:
+            self._write_deltas(updates)
+        else:
+            self._write_users(updates)
+
+    def _commit(self, batch, writes: int, counter: str) -> None:
+        with instrumentation.span("firestore.preference_batch"):
+            batch.commit()
+        instrumentation.count(counter, writes)
+        self.batches_committed += 1
+        self.documents_written += writes
+
+    def _write_users(self, updates: list) -> None:
+        db = firestore.client()
+        for start in range(0, len(updates), self.max_batch_size):
+            chunk = [(user_id, _user_payload(fields)) for user_id, fields in updates[start:start + self.max_batch_size]]
+            batch = db.batch()
+            for user_id, payload in chunk:
+                batch.update(db.collection("users").document(user_id), payload)
+            try:
+                self._commit(batch, len(chunk), "firestore.preference_writes")
+            except Exception as e:
+                # A batch fails as a whole (e.g. one missing user doc), so
+                # retry its users individually.
+                logging.warning(f"Preference batch of {len(chunk)} update(s) failed, retrying individually: {e}")
+                for user_id, payload in chunk:
+                    try:
+                        db.collection("users").document(user_id).update(payload)
+                        self.documents_written += 1
+                    except Exception as user_error:
+                        logging.error(f"Failed to update preferences for user {user_id}: {user_error}")
+        logging.info(f"Flushed preference updates for {len(updates)} user(s).")
+
+    def _write_deltas(self, updates: list) -> None:
+        db = firestore.client()
+        deltas = db.collection(PREFERENCE_DELTAS_COLLECTION)
+        for start in range(0, len(updates), self.max_batch_size):
+            chunk = updates[start:start + self.max_batch_size]
+            batch = db.batch()
+            for user_id, fields in chunk:
+                increments = {path: firestore.Increment(delta) for path, delta in fields.items() if delta}
+                batch.set(deltas.document(f"{user_id}:{random.randrange(DELTA_SHARDS)}"), {
+                    "userId": user_id,
+                    "deltas": _nest(increments),
+                    "updatedAt": time.time(),
+                }, merge=True)
+            # Unlike users/{id} updates, a set can't fail on a missing document.
+            self._commit(batch, len(chunk), "firestore.preference_delta_writes")
+        logging.info(f"Queued preference deltas for {len(updates)} user(s).")
+
+    def fold(self) -> int:
+        """
+        Adds every pending preferenceDeltas document to its users/{id} and
+        deletes it, one transaction per group of users. Returns the number
+        of user documents updated.
+        """
+        db = firestore.client()
+        folded = 0
+        for _ in range(MAX_FOLD_PAGES):
+            page = list(db.collection(PREFERENCE_DELTAS_COLLECTION).limit(self.max_batch_size).stream())
+            if not page:
+                break
+            refs_by_user = {}
+            for doc in page:
+                refs_by_user.setdefault((doc.to_dict() or {}).get("userId"), []).append(doc.reference)
+
+            # Each user costs one update plus one delete per shard.
+            chunks, chunk, writes = [], {}, 0
+            for user_id, refs in refs_by_user.items():
+                if chunk and writes + 1 + len(refs) > self.max_batch_size:
+                    chunks.append(chunk)
+                    chunk, writes = {}, 0
+                chunk[user_id] = refs
+                writes += 1 + len(refs)
+            chunks.append(chunk)
+
+            folded_before = folded
+            for chunk in chunks:
+                folded += self._fold_chunk(db, chunk)
+            if folded == folded_before:
+                break  # Nothing in this page could be folded; try again next run.
+        instrumentation.count("firestore.preference_writes", folded)
+        return folded
+
+    def _fold_chunk(self, db, refs_by_user: dict) -> int:
+        try:
+            return _fold_users(db.transaction(), db, refs_by_user)
+        except Exception as e:
+            if len(refs_by_user) == 1:
+                user_id, refs = next(iter(refs_by_user.items()))
+                if user_id and not db.collection("users").document(user_id).get().exists:
+                    logging.error(f"User {user_id} no longer exists. Dropping their preference deltas.")
+                    for ref in refs:
+                        ref.delete()
+                else:
+                    logging.error(f"Failed to fold preference deltas for user {user_id}: {e}")
+                return 0
+            # A transaction fails as a whole (e.g. one missing user doc), so
+            # retry its users individually.
+            logging.warning(f"Folding deltas for {len(refs_by_user)} user(s) failed, retrying individually: {e}")
+            return sum(self._fold_chunk(db, {user_id: refs}) for user_id, refs in refs_by_user.items())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending_users": len(self._pending),
+                "increments_buffered": self.increments_buffered,
+                "documents_written": self.documents_written,
+                "batches_committed": self.batches_committed,
+            }
+
+
+preference_writes = PreferenceWriteBuffer()
+
+
+@scheduler_fn.on_schedule(schedule=f"every {max(1, math.ceil(FLUSH_INTERVAL_SEC / 60))} minutes")
+@instrumentation.instrumented()
+def fold_preference_deltas(event: scheduler_fn.ScheduledEvent) -> None:
+    """Adds queued preference deltas to users/{id} (see PreferenceWriteBuffer)."""
+    if FLUSH_INTERVAL_SEC <= 0:
+        return
+    folded = preference_writes.fold()
+    logging.info(f"Folded preference deltas into {folded} user document(s).")
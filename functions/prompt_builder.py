@@ -0,0 +1,152 @@
+# prompt_builder.py
+
+import difflib
+import json
+import math
+import os
+import re
+import unicodedata
+
+# Approximate prompt budget for the candidate block, in tokens.
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "1500"))
+# Rough tokens-per-character ratio for English/JSON text.
+CHARS_PER_TOKEN = 4
+# Ranking: one star of rating is worth this many kilometres of distance.
+KM_PER_RATING_STAR = 10.0
+# Lodging slots kept at the top of the ranking so a hotel can always be chosen.
+RESERVED_HOTEL_SLOTS = 2
+# Fuzzy place-name matches below this similarity (0-1) are rejected.
+NAME_MATCH_MIN_SIMILARITY = float(os.environ.get("NAME_MATCH_MIN_SIMILARITY", "0.8"))
+# Place types worth sending to the model; the rest are Google bookkeeping.
+USEFUL_TYPES = {
+    "lodging", "restaurant", "cafe", "bar", "night_club", "bakery", "museum",
+    "art_gallery", "park", "tourist_attraction", "shopping_mall", "store",
+    "zoo", "aquarium", "amusement_park", "church", "hindu_temple", "mosque",
+    "synagogue", "spa", "stadium", "movie_theater", "library", "natural_feature",
+}
+
+
+def haversine_km(a: dict, b: dict) -> float:
+    """Great-circle distance between two {'lat', 'lng'} points in kilometres."""
+    lat1, lng1 = math.radians(a["lat"]), math.radians(a["lng"])
+    lat2, lng2 = math.radians(b["lat"]), math.radians(b["lng"])
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(h))
+
+
+def _distance_km(place: dict, center: dict) -> float | None:
+    geometry = place.get("geometry") or {}
+    if "lat" not in geometry or "lng" not in geometry:
+        return None
+    return haversine_km(geometry, center)
+
+
+def rank_candidates(places: list, center: dict) -> list:
+    """
+    Orders places by rating, penalised by distance from the city center.
+
+    The best lodging candidates are moved to the front so they survive any
+    later cut. Ties keep the input order, so ranking is deterministic.
+    """
+    def _score(place):
+        distance = _distance_km(place, center)
+        penalty = distance / KM_PER_RATING_STAR if distance is not None else 0.0
+        return (place.get("rating") or 0) - penalty
+
+    ranked = sorted(places, key=_score, reverse=True)
+    hotels = [p for p in ranked if "lodging" in (p.get("types") or [])][:RESERVED_HOTEL_SLOTS]
+    hotel_ids = {id(p) for p in hotels}
+    return hotels + [p for p in ranked if id(p) not in hotel_ids]
+
+
+def encode_candidates(places: list, center: dict, token_budget: int = PROMPT_TOKEN_BUDGET):
+    """
+    Encodes ranked places as compact JSON lines within the token budget.
+
+    Each place gets a short id (p1, p2, ...) and only the fields the model
+    needs. Returns (candidate_block, places_by_short_id) so photos and real
+    place IDs can be re-attached after generation.
+    """
+    lines = []
+    places_by_short_id = {}
+    used_chars = 0
+    for index, place in enumerate(places, start=1):
+        short_id = f"p{index}"
+        distance = _distance_km(place, center)
+        entry = {"id": short_id, "name": place.get("name"), "rating": place.get("rating")}
+        types = [t for t in (place.get("types") or []) if t in USEFUL_TYPES]
+        if types:
+            entry["types"] = types
+        if distance is not None:
+            entry["km"] = round(distance, 1)
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        if lines and (used_chars + len(line) + 1) / CHARS_PER_TOKEN > token_budget:
+            break
+        lines.append(line)
+        used_chars += len(line) + 1
+        places_by_short_id[short_id] = place
+    return "\n".join(lines), places_by_short_id
+
+
+def normalize_place_name(name: str) -> str:
+    """Case-, accent- and punctuation-insensitive form of a place name."""
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    text = "".join(c for c in decomposed if not unicodedata.combining(c)).casefold().replace("&", " and ")
+    words = re.findall(r"[^\W_]+", text)
+    if len(words) > 1 and words[0] == "the":
+        words = words[1:]
+    return " ".join(words)
+
+
+class PlaceNameIndex:
+    """
+    Finds the candidate place a model meant by name.
+
+    Exact and normalized names are dict lookups. Otherwise the places sharing
+    a word with the name are compared by string similarity, or by one name's
+    words containing the other's ("Louvre" / "Musee du Louvre"). A fuzzy
+    match that ties between two places is ambiguous and rejected.
+    """
+
+    def __init__(self, places: list):
+        self._exact = {}
+        self._normalized = {}
+        self._by_word = {}
+        for place in places:
+            name = place.get("name")
+            if not name:
+                continue
+            self._exact.setdefault(name, place)
+            normalized = normalize_place_name(name)
+            if normalized in self._normalized:
+                continue
+            self._normalized[normalized] = place
+            for word in set(normalized.split()):
+                self._by_word.setdefault(word, []).append(normalized)
+
+    def find(self, name: str | None) -> dict | None:
+        if not name:
+            return None
+        place = self._exact.get(name)
+        if place is not None:
+            return place
+        normalized = normalize_place_name(name)
+        place = self._normalized.get(normalized)
+        if place is not None:
+            return place
+
+        words = set(normalized.split())
+        candidates = {c for word in words for c in self._by_word.get(word, ())}
+        scored = []
+        for candidate in candidates:
+            candidate_words = set(candidate.split())
+            similarity = difflib.SequenceMatcher(None, normalized, candidate).ratio()
+            if words <= candidate_words or candidate_words <= words:
+                similarity = max(similarity, NAME_MATCH_MIN_SIMILARITY)
+            scored.append((similarity, candidate))
+        scored.sort(reverse=True)
+        if not scored or scored[0][0] < NAME_MATCH_MIN_SIMILARITY:
+            return None
+        if len(scored) > 1 and scored[1][0] == scored[0][0]:
+            return None
+        return self._normalized[scored[0][1]]
@@ -0,0 +1,275 @@
+# quiz.py
+
+import logging
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import random  # Change 1: Imported for random selection
+
+from firebase_admin import firestore
+from firebase_functions import scheduler_fn
+
+import instrumentation
+import structured_output
+from structured_output import StructuredOutputError
+
+PROJECT_ID = "aetherchat-sm72i"
+QUIZ_TIMEZONE = ZoneInfo("Pacific/Kiritimati")
+# Quizzes are generated this many days ahead in one run...
+QUIZ_BATCH_DAYS = int(os.environ.get("QUIZ_BATCH_DAYS", "7"))
+# ...whenever fewer than this many days (including today) are already staged.
+QUIZ_MIN_STAGED_DAYS = int(os.environ.get("QUIZ_MIN_STAGED_DAYS", "3"))
+# Quizzes requested per Gemini call; larger batches are split into concurrent calls.
+QUIZZES_PER_CALL = int(os.environ.get("QUIZZES_PER_CALL", "7"))
+# Normalized question hashes of every quiz written so far.
+QUIZ_HISTORY_DOC = "quizMeta/history"
+
+# Change 2: Defined a list of countries for the quiz
+COUNTRIES = [
+    "Japan", "Italy", "China", "Mexico", "India", "Thailand", "France", "Spain",
+    "Greece", "Vietnam", "Turkey", "South Korea", "United States", "Lebanon", "Brazil",
+    "Argentina", "Peru", "Morocco", "Egypt", "Ethiopia", "Indonesia",
+    "Malaysia", "Germany", "United Kingdom", "Russia", "Portugal", "Hungary",
+    "Canada", "Australia", "New Zealand", "South Africa", "Nigeria",
+    "Sweden", "Poland", "Philippines", "Pakistan", "Iran", "Israel",
+    "Jamaica", "Cuba"
+]
+
+QUIZ_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "question": {"type": "STRING"},
+        "options": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "correctOptionIndex": {"type": "INTEGER"},
+        "explanation": {"type": "STRING"},
+        "country": {"type": "STRING"},
+    },
+    "required": ["question", "options", "correctOptionIndex", "explanation", "country"],
+}
+QUIZ_BATCH_SCHEMA = {"type": "ARRAY", "items": QUIZ_SCHEMA}
+
+_STOPWORDS = {"a", "an", "the", "of", "in", "is", "which", "what", "this", "that", "from",
+              "for", "to", "and", "or", "its", "it", "s", "with", "known", "as", "dish"}
+
+_gemini_model = None
+
+
+def _get_model():
+    """vertexai is only initialized on runs that actually generate quizzes."""
+    global _gemini_model
+    if _gemini_model is None:
+        import vertexai
+        from vertexai.generative_models import GenerativeModel
+        vertexai.init(project=PROJECT_ID)
+        _gemini_model = GenerativeModel("gemini-2.5-flash")
+    return _gemini_model
+
+
+def question_hash(question: str) -> str:
+    """
+    Hash of the question's meaningful words, ignoring case, punctuation,
+    word order and filler words, so rephrasings of the same question collide.
+    """
+    words = re.findall(r"[a-z0-9]+", question.lower())
+    key = " ".join(sorted({w for w in words if w not in _STOPWORDS}))
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def validate_quiz(quiz, country: str) -> dict | None:
+    """Returns the quiz with only the schema's fields, or None if it doesn't match the schema."""
+    if not isinstance(quiz, dict):
+        return None
+    question = quiz.get("question")
+    options_list = quiz.get("options")
+    index = quiz.get("correctOptionIndex")
+    explanation = quiz.get("explanation")
+    if not isinstance(question, str) or not question.strip():
+        return None
+    if not isinstance(options_list, list) or len(options_list) != 4:
+        return None
+    if not all(isinstance(o, str) and o.strip() for o in options_list) or len(set(options_list)) != 4:
+        return None
+    if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index <= 3:
+        return None
+    if not isinstance(explanation, str) or not explanation.strip():
+        return None
+    return {
+        "question": question.strip(),
+        "options": [o.strip() for o in options_list],
+        "correctOptionIndex": index,
+        "explanation": explanation.strip(),
+        "country": country,
+    }
+
+
+def _build_prompt(countries: list) -> str:
+    numbered = "\n".join(f"{i}. {country}" for i, country in enumerate(countries, start=1))
+    return f"""
+        As an assistant, you will generate quizzes about the cuisine of specific countries.
+        Generate exactly one quiz for each of these countries, in this order:
+{numbered}
+
+        Each quiz is a thought-provoking multiple-choice question about that country's cuisine.
+        Mixing in names of dishes from that country or neighboring countries will make the quiz more interesting.
+        Every question must be different from the others.
+
+        The response MUST be a single, valid JSON array with one object per country, each following this strict format:
+        {{
+          "question": "string (The question text in English.)",
+          "options": "array of 4 strings (The multiple choice options in English.)",
+          "correctOptionIndex": "integer (0-3, the index of the correct answer in the options array.)",
+          "explanation": "string (A brief explanation in English of why the answer is correct.)",
+          "country": "string (The country from the list.)"
+        }}
+        Output ONLY the valid JSON array. DO NOT use markdown. DO NOT add any extra text before or after the JSON array.
+        """
+
+
+def _parse_quizzes(text: str) -> list:
+    """
+    Quiz objects from a batch response, repaired locally if needed. If the
+    array as a whole can't be parsed, each element is parsed on its own and
+    broken ones become None, so only those countries are generated again.
+    """
+    try:
+        items = structured_output.parse_json(text)
+    except StructuredOutputError as e:
+        logging.warning(f"Quiz batch was malformed ({e}). Salvaging the valid quizzes.")
+        items = []
+        for raw_item in structured_output.split_array(text):
+            try:
+                items.append(structured_output.parse_json(raw_item, expect=dict))
+            except StructuredOutputError:
+                items.append(None)
+        return items
+    if isinstance(items, dict):
+        return [items]
+    return items if isinstance(items, list) else []
+
+
+def _generate_batch(countries: list) -> list:
+    """
+    One Gemini call for several quizzes. Returns one entry per country:
+    the validated quiz, or None if it was missing or invalid.
+    """
+    prompt = _build_prompt(countries)
+    instrumentation.count("gemini.calls")
+    instrumentation.count("gemini.bytes_sent", len(prompt.encode("utf-8")))
+    try:
+        with instrumentation.span("gemini.generate_quizzes"):
+            response = structured_output.generate_json(_get_model(), prompt, QUIZ_BATCH_SCHEMA)
+        items = _parse_quizzes(response.text)
+    except Exception as e:
+        logging.error(f"Quiz batch for {len(countries)} countries failed: {e}")
+        return [None] * len(countries)
+
+    # Match by country when the model names it, otherwise by position.
+    by_country = {item.get("country"): item for item in items if isinstance(item, dict)}
+    results = []
+    for position, country in enumerate(countries):
+        item = by_country.get(country)
+        if item is None and position < len(items):
+            item = items[position]
+        results.append(validate_quiz(item, country))
+    return results
+
+
+def _generate_quizzes(countries: list) -> list:
+    """Splits the countries into QUIZZES_PER_CALL chunks and generates them concurrently."""
+    chunks = [countries[i:i + QUIZZES_PER_CALL] for i in range(0, len(countries), QUIZZES_PER_CALL)]
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        futures = [executor.submit(instrumentation.bind(_generate_batch), chunk) for chunk in chunks]
+        return [quiz for future in futures for quiz in future.result()]
+
+
+def _load_history(db) -> tuple[set, bool]:
+    """
+    Hashes of past questions, and whether the history doc exists. Without it,
+    the hashes are rebuilt once from the quizzes collection.
+    """
+    history_doc = db.document(QUIZ_HISTORY_DOC).get()
+    if history_doc.exists:
+        return set(history_doc.to_dict().get("hashes", [])), True
+    logging.info("Quiz history not found. Building it from past quizzes.")
+    return {question_hash(doc.get("question") or "") for doc in db.collection("quizzes").stream()}, False
+
+
+@scheduler_fn.on_schedule(schedule="every day 00:05", timezone="Pacific/Kiritimati")
+@instrumentation.instrumented()
+def generate_daily_quiz(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Makes sure today's food quiz and the next few days' are staged.
+
+    Usually a single read. When fewer than QUIZ_MIN_STAGED_DAYS days are
+    staged, the missing days up to QUIZ_BATCH_DAYS ahead are generated in
+    batched Gemini calls, checked against the schema and past questions, and
+    written in one batch.
+    """
+    logging.info("--- Function execution started. ---")
+
+    try:
+        db = firestore.client()
+        today = datetime.now(QUIZ_TIMEZONE).date()
+        dates = [(today + timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range(QUIZ_BATCH_DAYS)]
+        refs = {date: db.collection("quizzes").document(date) for date in dates}
+
+        with instrumentation.span("firestore.read_quizzes"):
+            staged = {doc.id for doc in db.get_all(list(refs.values())) if doc.exists}
+        staged_ahead = 0
+        for date in dates:
+            if date not in staged:
+                break
+            staged_ahead += 1
+        if staged_ahead >= QUIZ_MIN_STAGED_DAYS:
+            logging.info(f"Quizzes staged for the next {staged_ahead} day(s). Nothing to generate.")
+            return
+
+        missing = [date for date in dates if date not in staged]
+        logging.info(f"Generating quizzes for {len(missing)} day(s): {', '.join(missing)}")
+
+        history, history_exists = _load_history(db)
+        countries = random.sample(COUNTRIES, k=min(len(missing), len(COUNTRIES)))
+
+        accepted = {}
+        seen = set(history)
+        # One retry round for the days whose quiz was invalid or a duplicate.
+        for attempt in range(2):
+            pending = [(date, country) for date, country in zip(missing, countries) if date not in accepted]
+            if not pending:
+                break
+            if attempt:
+                logging.warning(f"Retrying {len(pending)} quiz(zes) that were invalid or duplicates.")
+            quizzes = _generate_quizzes([country for _, country in pending])
+            for (date, country), quiz in zip(pending, quizzes):
+                if quiz is None:
+                    instrumentation.count("quiz.invalid")
+                    continue
+                digest = question_hash(quiz["question"])
+                if digest in seen:
+                    instrumentation.count("quiz.duplicates")
+                    logging.info(f"Rejected a near-duplicate question for {country}.")
+                    continue
+                seen.add(digest)
+                accepted[date] = {**quiz, "questionHash": digest}
+
+        if not accepted:
+            logging.error("No valid quizzes were generated. Stopping execution.")
+            return
+
+        batch = db.batch()
+        for date, quiz in accepted.items():
+            batch.set(refs[date], {**quiz, "createdAt": firestore.SERVER_TIMESTAMP, "date": date})
+        new_hashes = [quiz["questionHash"] for quiz in accepted.values()]
+        batch.set(db.document(QUIZ_HISTORY_DOC), {
+            "hashes": firestore.ArrayUnion(new_hashes if history_exists else sorted(seen)),
+        }, merge=True)
+        with instrumentation.span("firestore.save_quizzes"):
+            batch.commit()
+        instrumentation.count("quiz.staged", len(accepted))
+        logging.info(f"--- SUCCESS: Staged {len(accepted)} quiz(zes) for {', '.join(sorted(accepted))}! ---")
+
+    except Exception as e:
+        logging.error(f"CRITICAL ERROR in try block: {e}", exc_info=True)
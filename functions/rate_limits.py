@@ -0,0 +1,128 @@
+# rate_limits.py
+
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import instrumentation
+
+# Per-instance request rates (requests/second). The project-wide ceiling is
+# roughly rate x instance count, so size these from the API quota divided by
+# the expected number of warm instances.
+DEFAULT_RATES = {
+    "gemini": float(os.environ.get("RATE_GEMINI_QPS", "2")),
+    "places_search": float(os.environ.get("RATE_PLACES_SEARCH_QPS", "10")),
+    "place_details": float(os.environ.get("RATE_PLACE_DETAILS_QPS", "20")),
+    "geocode": float(os.environ.get("RATE_GEOCODE_QPS", "10")),
+    "place_photo": float(os.environ.get("RATE_PLACE_PHOTO_QPS", "10")),
+}
+# How long a caller may wait for a token before the call is attempted anyway.
+MAX_WAIT_SEC = 30.0
+QUOTA_RETRIES = 4
+QUOTA_BACKOFF_BASE_SEC = 0.5
+QUOTA_BACKOFF_MAX_SEC = 8.0
+
+# Latest time.monotonic() by which calls in the current context must start; see deadline().
+_deadline = contextvars.ContextVar("rate_limit_deadline", default=None)
+
+
+class RateLimitTimeout(Exception):
+    """No token (or quota retry) was available before the caller's deadline."""
+
+
+@contextmanager
+def deadline(seconds: float):
+    """
+    Calls made in this block (and in functions bound from it with
+    instrumentation.bind) that can't start within `seconds` fail fast with
+    RateLimitTimeout instead of waiting.
+    """
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+class TokenBucket:
+    """Thread-safe token bucket. Burst capacity defaults to one second of rate."""
+
+    def __init__(self, rate_per_sec: float, burst: float | None = None):
+        self.rate = rate_per_sec
+        self.capacity = burst if burst is not None else max(rate_per_sec, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waited_sec = 0.0
+
+    def acquire(self, timeout: float = MAX_WAIT_SEC) -> bool:
+        """Blocks until a token is available. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.acquired += 1
+                    self.waited_sec += now - started
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+_buckets = {api: TokenBucket(rate) for api, rate in DEFAULT_RATES.items()}
+
+
+def is_quota_error(error: Exception) -> bool:
+    """True for 429 / RESOURCE_EXHAUSTED / OVER_QUERY_LIMIT style errors."""
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    message = str(error)
+    return any(marker in message for marker in ("OVER_QUERY_LIMIT", "RESOURCE_EXHAUSTED", "429"))
+
+
+def rate_limited(api: str, func):
+    """
+    Calls func() under the API's token bucket, retrying quota errors with
+    exponential backoff and full jitter. Inside a deadline() block, waits and
+    retries never go past the deadline.
+    """
+    bucket = _buckets[api]
+    deadline_at = _deadline.get()
+    for attempt in range(QUOTA_RETRIES + 1):
+        timeout = MAX_WAIT_SEC if deadline_at is None else min(MAX_WAIT_SEC, deadline_at - time.monotonic())
+        with instrumentation.span(f"ratelimit.{api}.wait"):
+            acquired = timeout > 0 and bucket.acquire(timeout)
+        if not acquired:
+            if deadline_at is not None:
+                instrumentation.count(f"ratelimit.{api}.deadline_exceeded")
+                raise RateLimitTimeout(f"No {api} token before the caller's deadline")
+            logging.warning(f"⏳ Waited over {MAX_WAIT_SEC}s for a {api} token. Calling anyway.")
+        try:
+            return func()
+        except Exception as e:
+            if attempt == QUOTA_RETRIES or not is_quota_error(e):
+                raise
+            instrumentation.count(f"ratelimit.{api}.quota_retries")
+            delay = random.uniform(0, min(QUOTA_BACKOFF_MAX_SEC, QUOTA_BACKOFF_BASE_SEC * 2 ** attempt))
+            if deadline_at is not None and time.monotonic() + delay >= deadline_at:
+                raise
+            logging.warning(f"⚠️ {api} quota error (attempt {attempt + 1}), retrying in {delay:.2f}s: {e}")
+            time.sleep(delay)
+
+
+def stats() -> dict:
+    return {
+        api: {"acquired": bucket.acquired, "waited_sec": round(bucket.waited_sec, 3)}
+        for api, bucket in _buckets.items()
+    }
@@ -0,0 +1,135 @@
+# route_optimizer.py
+
+import logging
+import os
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+# Straight-line distance times this factor approximates street distance.
+DETOUR_FACTOR = 1.3
+# Average door-to-door speed for city travel (walking + transit + taxi).
+AVERAGE_SPEED_KMH = float(os.environ.get("ROUTE_AVERAGE_SPEED_KMH", "20"))
+# Only reorder the AI's plan when the route gets at least this much shorter.
+MIN_IMPROVEMENT = 0.1
+
+
+def distance_matrix_km(points: np.ndarray) -> np.ndarray:
+    """Pairwise haversine distances for an (n, 2) array of [lat, lng] degrees."""
+    lat = np.radians(points[:, 0])
+    lng = np.radians(points[:, 1])
+    dlat = lat[:, None] - lat[None, :]
+    dlng = lng[:, None] - lng[None, :]
+    h = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def tour_length(tour: list, distances: np.ndarray) -> float:
+    """Length of a closed tour that returns to its first stop."""
+    return float(distances[tour, np.roll(tour, -1)].sum())
+
+
+def solve_tour(distances: np.ndarray) -> list:
+    """
+    Closed tour starting and ending at index 0: nearest neighbour, then 2-opt.
+    """
+    n = len(distances)
+    if n <= 3:
+        return list(range(n))
+
+    tour = [0]
+    unvisited = np.ones(n, dtype=bool)
+    unvisited[0] = False
+    while unvisited.any():
+        row = np.where(unvisited, distances[tour[-1]], np.inf)
+        nearest = int(row.argmin())
+        tour.append(nearest)
+        unvisited[nearest] = False
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            for j in range(i + 1, n):
+                a, b = tour[i - 1], tour[i]
+                c, d = tour[j], tour[(j + 1) % n]
+                delta = distances[a, c] + distances[b, d] - distances[a, b] - distances[c, d]
+                if delta < -1e-9:
+                    tour[i:j + 1] = reversed(tour[i:j + 1])
+                    improved = True
+    return tour
+
+
+def _leg(distance_km: float) -> dict:
+    road_km = float(distance_km) * DETOUR_FACTOR
+    return {
+        "leg_distance_km": round(road_km, 2),
+        "leg_minutes": int(round(road_km / AVERAGE_SPEED_KMH * 60)),
+    }
+
+
+def _reorder(plan: list, tour: list, retime) -> list | None:
+    """The plan in tour order, with moved timed steps rewritten by retime; None to keep the AI's order."""
+    times = [step.get("time") for step in plan]
+    moved = [position for position, index in enumerate(tour) if index != position]
+    if not any(times[tour[position]] for position in moved):
+        return [plan[i] for i in tour]
+    if retime is None:
+        return None
+    reordered = [{**plan[index], "time": times[position]} for position, index in enumerate(tour)]
+    rewritten = retime(reordered, moved)
+    if not rewritten or any(position not in rewritten for position in moved):
+        logging.warning("Could not re-time the reordered steps. Keeping the AI's order.")
+        return None
+    for position in moved:
+        reordered[position].update(rewritten[position])
+    return reordered
+
+
+def optimize_route(plan: list, retime=None) -> tuple[list, dict | None]:
+    """
+    Reorders plan steps into a short loop from the hotel (first step) and
+    back, and annotates every step with the estimated leg from the previous
+    stop.
+
+    The AI writes each description for its step's time, so when timed steps
+    move, the time slots stay in their original positions and
+    retime(plan, moved) rewrites the moved steps: it gets the reordered
+    plan (each step carrying its new slot's time) and the positions that
+    changed, and returns {position: {"time", "activity_description"}}, or
+    None to keep the AI's order. Without retime, timed plans keep their
+    order. Returns (plan, route_summary); plans with steps lacking geometry
+    are returned unchanged with no summary.
+    """
+    if len(plan) < 2:
+        return plan, None
+    try:
+        points = np.array([[step["geometry"]["lat"], step["geometry"]["lng"]] for step in plan], dtype=float)
+    except (KeyError, TypeError):
+        logging.warning("Some plan steps have no geometry. Skipping route optimization.")
+        return plan, None
+
+    distances = distance_matrix_km(points)
+    tour = list(range(len(plan)))
+    optimized = solve_tour(distances)
+    original_km = tour_length(tour, distances)
+    optimized_km = tour_length(optimized, distances)
+    if optimized_km <= original_km * (1 - MIN_IMPROVEMENT):
+        reordered = _reorder(plan, optimized, retime)
+        if reordered is not None:
+            logging.info(f"🧭 Reordered plan: {original_km:.1f}km -> {optimized_km:.1f}km loop.")
+            tour, plan = optimized, reordered
+
+    for position, step in enumerate(plan):
+        previous = tour[position - 1] if position else None
+        step.update(_leg(distances[previous, tour[position]]) if previous is not None else _leg(0.0))
+
+    return_leg = _leg(distances[tour[-1], tour[0]])
+    total_km = tour_length(tour, distances) * DETOUR_FACTOR
+    summary = {
+        "total_distance_km": round(total_km, 2),
+        "total_minutes": int(round(total_km / AVERAGE_SPEED_KMH * 60)),
+        "return_leg_distance_km": return_leg["leg_distance_km"],
+        "return_leg_minutes": return_leg["leg_minutes"],
+    }
+    return plan, summary
@@ -0,0 +1,96 @@
+# secret_store.py
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 0 keeps secrets for the lifetime of the instance. Otherwise they are re-fetched
+# this often, and main._initialize_clients rebuilds clients whose key changed.
+REFRESH_INTERVAL_SEC = float(os.environ.get("SECRET_REFRESH_INTERVAL_SEC", "0"))
+# Backoff after a failed fetch: doubles per consecutive failure, up to the max.
+FAILURE_BACKOFF_SEC = 5.0
+FAILURE_BACKOFF_MAX_SEC = 300.0
+
+_client = None
+_client_lock = threading.Lock()
+
+# secret_id -> {"value", "expires_at", "failures"}
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _get_client():
+    """Returns the shared SecretManagerServiceClient, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from google.cloud import secretmanager
+                _client = secretmanager.SecretManagerServiceClient()
+    return _client
+
+
+def _fetch(secret_id: str, project_id: str) -> str:
+    name = f"projects/{project_id}/secrets/{secret_id}/versions/latest"
+    response = _get_client().access_secret_version(request={"name": name})
+    return response.payload.data.decode("UTF-8")
+
+
+def _cached_value(secret_id: str, now: float):
+    """
+    Returns (hit, value) for a secret. A hit with value None means the secret
+    failed recently and is still inside its backoff window.
+    """
+    with _cache_lock:
+        entry = _cache.get(secret_id)
+    if entry is None or now >= entry["expires_at"]:
+        return False, None
+    return True, entry["value"]
+
+
+def get_secret(secret_id: str, project_id: str | None) -> str | None:
+    """
+    Returns a secret value, preferring an environment variable of the same
+    name (for local runs), then the instance cache, then Secret Manager.
+    """
+    override = os.environ.get(secret_id)
+    if override:
+        return override
+
+    now = time.time()
+    hit, value = _cached_value(secret_id, now)
+    if hit:
+        return value
+    if not project_id:
+        logging.error(f"Cannot fetch secret {secret_id}: no project ID and no environment override.")
+        return None
+
+    try:
+        value = _fetch(secret_id, project_id)
+    except Exception as e:
+        with _cache_lock:
+            previous = _cache.get(secret_id) or {}
+            failures = previous.get("failures", 0) + 1
+            backoff = min(FAILURE_BACKOFF_SEC * 2 ** (failures - 1), FAILURE_BACKOFF_MAX_SEC)
+            # Negative cache: callers get the last good value (if any) until the
+            # backoff expires instead of hitting Secret Manager again.
+            stale_value = previous.get("value")
+            _cache[secret_id] = {"value": stale_value, "expires_at": now + backoff, "failures": failures}
+        logging.error(f"Failed to access secret {secret_id} (attempt {failures}, retry in {backoff:.0f}s). Error: {e}")
+        return stale_value
+
+    expires_at = now + REFRESH_INTERVAL_SEC if REFRESH_INTERVAL_SEC > 0 else float("inf")
+    with _cache_lock:
+        _cache[secret_id] = {"value": value, "expires_at": expires_at, "failures": 0}
+    return value
+
+
+def get_secrets(secret_ids: list, project_id: str | None) -> dict:
+    """Fetches several secrets concurrently. Returns {secret_id: value or None}."""
+    if len(secret_ids) <= 1:
+        return {secret_id: get_secret(secret_id, project_id) for secret_id in secret_ids}
+    with ThreadPoolExecutor(max_workers=len(secret_ids)) as executor:
+        values = executor.map(lambda secret_id: get_secret(secret_id, project_id), secret_ids)
+        return dict(zip(secret_ids, values))
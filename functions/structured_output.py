@@ -0,0 +1,219 @@
+# structured_output.py
+
+import json
+import logging
+import re
+
+import instrumentation
+
+_FENCE = re.compile(r"```(?:json|JSON)?")
+# Non-JSON literals models sometimes emit.
+_LITERALS = {"True": "true", "False": "false", "None": "null", "NaN": "null", "undefined": "null"}
+_STRING_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+
+# Models that rejected response_schema, so later calls go straight to plain
+# JSON mode. Kept per model: plans (generativeai) and quizzes (vertexai) run
+# in the same process.
+_schema_rejected = set()
+
+
+class StructuredOutputError(ValueError):
+    """Model output that couldn't be turned into the expected JSON."""
+
+
+def _model_key(model) -> tuple:
+    return type(model).__module__, type(model).__qualname__, getattr(model, "model_name", None)
+
+
+def generate_json(model, prompt: str, schema: dict, **kwargs):
+    """
+    model.generate_content() constrained to JSON matching `schema` (an
+    OpenAPI-style dict, as accepted by generativeai and vertexai). If the
+    model rejects response schemas, plain JSON mode is used instead.
+    """
+    config = {"response_mime_type": "application/json"}
+    key = _model_key(model)
+    if key not in _schema_rejected:
+        try:
+            return model.generate_content(prompt, generation_config={**config, "response_schema": schema}, **kwargs)
+        except Exception as e:
+            if "schema" not in str(e).lower():
+                raise
+            logging.warning(f"Model rejected the response schema. Using plain JSON mode: {e}")
+            _schema_rejected.add(key)
+    return model.generate_content(prompt, generation_config=config, **kwargs)
+
+
+def _strip(text: str) -> str:
+    return _FENCE.sub("", text or "").strip().lstrip("\ufeff")
+
+
+def _drop_trailing_comma(out: list) -> None:
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+
+
+def repair_json(text: str) -> str:
+    """
+    Rewrites almost-JSON as JSON. Handles prose around the value, comments,
+    trailing commas, Python literals, raw newlines inside strings and
+    mismatched brackets. Truncated output is cut back to its last complete
+    element and closed.
+    """
+    text = _strip(text)
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        raise StructuredOutputError("No JSON object or array in the model output.")
+    src = text[min(starts):]
+
+    out = []
+    stack = []
+    # (len(out), open brackets) at the last point where the output was complete.
+    safe = (0, ())
+    i, n = 0, len(src)
+    while i < n:
+        c = src[i]
+        if c == '"':
+            j, chars, closed = i + 1, ['"'], False
+            while j < n:
+                if src[j] == "\\" and j + 1 < n:
+                    chars.append(src[j:j + 2])
+                    j += 2
+                    continue
+                if src[j] == '"':
+                    closed = True
+                    j += 1
+                    break
+                chars.append(_STRING_ESCAPES.get(src[j], src[j]))
+                j += 1
+            if not closed:
+                break  # Truncated inside a string.
+            chars.append('"')
+            out.append("".join(chars))
+            i = j
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+            out.append(c)
+            safe = (len(out), tuple(stack))
+            i += 1
+        elif c in "}]":
+            if not stack:
+                break
+            _drop_trailing_comma(out)
+            out.append(stack.pop())
+            i += 1
+            if not stack:
+                break  # Anything after the top-level value is prose.
+            safe = (len(out), tuple(stack))
+        elif c == ",":
+            _drop_trailing_comma(out)
+            safe = (len(out), tuple(stack))
+            out.append(",")
+            i += 1
+        elif src.startswith("//", i):
+            newline = src.find("\n", i)
+            i = n if newline == -1 else newline
+        elif src.startswith("/*", i):
+            end = src.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+        elif c.isalpha() or c == "_":
+            match = re.match(r"[A-Za-z_][A-Za-z0-9_]*", src[i:])
+            out.append(_LITERALS.get(match.group(), match.group()))
+            i += match.end()
+        else:
+            out.append(c)
+            i += 1
+
+    if stack:
+        length, open_brackets = safe
+        out = out[:length]
+        _drop_trailing_comma(out)
+        out.extend(reversed(open_brackets))
+    return "".join(out)
+
+
+def parse_json(text: str, expect: type | None = None):
+    """
+    Parses model output as JSON, repairing it locally if needed. Raises
+    StructuredOutputError if it can't be repaired or isn't of type `expect`.
+    """
+    cleaned = _strip(text)
+    try:
+        value = json.loads(cleaned)
+    except ValueError:
+        try:
+            value = json.loads(repair_json(cleaned))
+        except ValueError as e:
+            raise StructuredOutputError(f"Unparseable model output: {e}") from e
+        instrumentation.count("json.repaired")
+    if expect is not None and not isinstance(value, expect):
+        raise StructuredOutputError(f"Expected a JSON {expect.__name__}, got {type(value).__name__}.")
+    return value
+
+
+def split_array(text: str, key: str | None = None) -> list:
+    """
+    Raw text of each top-level element of a JSON array: the array under
+    `"key":` if given, otherwise the outermost one. Elements are split
+    without parsing, so one broken element doesn't take the others with it.
+    A truncated last element is returned as is.
+    """
+    text = _strip(text)
+    if key is not None and f'"{key}"' in text:
+        start = text.find("[", text.find(f'"{key}"'))
+    else:
+        first_object, start = text.find("{"), text.find("[")
+        if first_object != -1 and (start == -1 or first_object < start):
+            # Not an array; a single object counts as a one-element array.
+            return [text[first_object:]]
+    if start == -1:
+        return []
+
+    elements = []
+    depth = 0
+    in_string = escaped = False
+    element_start = start + 1
+    for pos in range(start + 1, len(text)):
+        c = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "{[":
+            depth += 1
+        elif c in "}]" and depth > 0:
+            depth -= 1
+        elif c in ",]" and depth == 0:
+            elements.append(text[element_start:pos])
+            element_start = pos + 1
+            if c == "]":
+                break
+    else:
+        elements.append(text[element_start:])
+    return [element.strip() for element in elements if element.strip()]
+
+
+def reask(generate, broken: str, schema: dict, what: str):
+    """
+    Asks the model to fix one malformed piece of its own output, sending only
+    that piece. `generate(prompt, schema)` returns the response text. Returns
+    the parsed value, or None if the answer is still unusable.
+    """
+    prompt = (
+        f"The following {what} is malformed or incomplete JSON:\n{broken}\n\n"
+        "Return it as a single valid JSON value that follows the response schema, "
+        "keeping its content. Output ONLY the JSON."
+    )
+    instrumentation.count("json.reasks")
+    try:
+        return parse_json(generate(prompt, schema))
+    except Exception as e:
+        logging.warning(f"Re-asking for a malformed {what} failed: {e}")
+        return None
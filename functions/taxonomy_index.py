@@ -0,0 +1,95 @@
+# taxonomy_index.py
+
+import logging
+import os
+import threading
+import time
+
+from firebase_admin import firestore
+
+TAXONOMY_COLLECTION = "taxonomies"
+TAXONOMY_DOCUMENT = "master_list"
+# Fallback refresh interval, used when the change listener is not running.
+TAXONOMY_TTL_SEC = float(os.environ.get("TAXONOMY_TTL_SEC", "600"))
+
+
+class TaxonomyIndex:
+    """
+    Process-wide inverted index of taxonomies/master_list: tag -> categories.
+
+    Built once per instance and kept fresh by a Firestore snapshot listener.
+    If the listener isn't running (or fails), the index is rebuilt with a
+    plain read once it is older than TAXONOMY_TTL_SEC.
+    """
+
+    def __init__(self, ttl_sec: float = TAXONOMY_TTL_SEC):
+        self.ttl_sec = ttl_sec
+        self._tag_to_categories = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._watch = None
+
+    def _build(self, taxonomies: dict) -> None:
+        index = {}
+        for category, valid_tags in taxonomies.items():
+            if isinstance(valid_tags, list):
+                for tag in valid_tags:
+                    index.setdefault(str(tag).lower(), set()).add(category)
+        with self._lock:
+            self._tag_to_categories = {tag: tuple(sorted(cats)) for tag, cats in index.items()}
+            self._loaded_at = time.time()
+        logging.info(f"Taxonomy index built with {len(index)} tags.")
+
+    def _on_snapshot(self, doc_snapshots, changes, read_time) -> None:
+        for doc in doc_snapshots:
+            if doc.exists:
+                self._build(doc.to_dict())
+
+    def _doc_ref(self):
+        return firestore.client().collection(TAXONOMY_COLLECTION).document(TAXONOMY_DOCUMENT)
+
+    def _start_listener(self) -> None:
+        if self._watch is not None:
+            if getattr(self._watch, "is_active", False):
+                return
+            try:
+                self._watch.unsubscribe()
+            except Exception:
+                pass
+            self._watch = None
+        try:
+            self._watch = self._doc_ref().on_snapshot(self._on_snapshot)
+        except Exception as e:
+            logging.warning(f"Could not start taxonomy listener, falling back to TTL refresh: {e}")
+
+    def _is_fresh(self) -> bool:
+        if self._tag_to_categories is None:
+            return False
+        # The listener keeps the index current; the TTL covers a dead listener.
+        listening = self._watch is not None and getattr(self._watch, "is_active", False)
+        return listening or time.time() - self._loaded_at < self.ttl_sec
+
+    def ensure_loaded(self) -> bool:
+        """Loads the index if missing or stale. Returns False if no taxonomy is available."""
+        if self._is_fresh():
+            return True
+        doc = self._doc_ref().get()
+        if not doc.exists:
+            logging.error("Taxonomy document 'master_list' not found. Cannot categorize tags.")
+            return self._tag_to_categories is not None
+        self._build(doc.to_dict())
+        self._start_listener()
+        return True
+
+    def categorize(self, tags: list) -> dict:
+        """Returns {category: [matched lowercase tags]} in O(len(tags))."""
+        with self._lock:
+            index = self._tag_to_categories or {}
+        matched = {}
+        for tag in {str(t).lower() for t in tags}:
+            for category in index.get(tag, ()):
+                matched.setdefault(category, []).append(tag)
+        return matched
+
+
+taxonomy_index = TaxonomyIndex()
@@ -0,0 +1,106 @@
+# tools/backfill_likes.py
+#
+# Migrates likedBy arrays to the likes subcollection (see likes.py).
+#
+# For every post with a non-empty likedBy array, each liker gets a
+# posts/{postId}/likes/{userId} document marked "backfilled" (onLikeCreated
+# ignores those, since their preference updates were applied when the like
+# happened), and the post's "backfill" counter shard is set to the number of
+# migrated likes. Users who already have a like document are left alone and
+# not counted again.
+#
+# Run it once clients write likes to the subcollection instead of likedBy.
+# Re-running is idempotent, but a like that was since removed through the
+# subcollection would come back while its user is still in likedBy.
+#
+# Usage (from the functions/ directory, with application default credentials):
+#   python -m tools.backfill_likes --dry-run
+#   python -m tools.backfill_likes --page-size 200
+#   python -m tools.backfill_likes --start-after <postId>   # resume
+
+import argparse
+import logging
+import sys
+
+import firebase_admin
+from firebase_admin import firestore
+
+import likes
+
+# Firestore's limit for writes in one batch.
+MAX_BATCH_WRITES = 500
+
+
+def _flush(db, writes: list, dry_run: bool) -> None:
+    if dry_run or not writes:
+        return
+    for start in range(0, len(writes), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for ref, data in writes[start:start + MAX_BATCH_WRITES]:
+            batch.set(ref, data, merge=True)
+        batch.commit()
+
+
+def backfill_post(db, post_doc, dry_run: bool = False) -> int:
+    """Backfills one post. Returns the number of like documents written."""
+    liked_by = list(dict.fromkeys((post_doc.to_dict() or {}).get("likedBy") or []))
+    if not liked_by:
+        return 0
+    post_ref = post_doc.reference
+    existing = {doc.id: doc.to_dict() for doc in post_ref.collection(likes.LIKES_SUBCOLLECTION).stream()}
+    # Likes written by the new path are already counted in the random shards.
+    live = {user_id for user_id, data in existing.items() if not (data or {}).get("backfilled")}
+    migrated = [user_id for user_id in liked_by if user_id not in live]
+
+    writes = [
+        (likes.like_ref(db, post_ref.id, user_id), {"backfilled": True, "createdAt": firestore.SERVER_TIMESTAMP})
+        for user_id in migrated if user_id not in existing
+    ]
+    writes.append((
+        post_ref.collection(likes.SHARDS_SUBCOLLECTION).document(likes.BACKFILL_SHARD),
+        {"count": len(migrated)},
+    ))
+    _flush(db, writes, dry_run)
+    return len(writes) - 1
+
+
+def run(page_size: int, start_after: str | None, dry_run: bool) -> None:
+    db = firestore.client()
+    posts = db.collection("posts")
+    last_id = start_after
+    scanned = migrated_posts = like_docs = 0
+    while True:
+        query = posts.order_by("__name__").select(["likedBy"]).limit(page_size)
+        if last_id:
+            query = query.start_after({"__name__": posts.document(last_id)})
+        page = list(query.stream())
+        if not page:
+            break
+        for post_doc in page:
+            written = backfill_post(db, post_doc, dry_run)
+            scanned += 1
+            if (post_doc.to_dict() or {}).get("likedBy"):
+                migrated_posts += 1
+                like_docs += written
+        last_id = page[-1].id
+        logging.info(f"Scanned {scanned} post(s), migrated {migrated_posts}, "
+                     f"wrote {like_docs} like doc(s). Resume with --start-after {last_id}")
+    action = "Would write" if dry_run else "Wrote"
+    print(f"{action} {like_docs} like document(s) across {migrated_posts} of {scanned} post(s).")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Migrate likedBy arrays to the likes subcollection.")
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--start-after", help="Post ID to resume after.")
+    parser.add_argument("--dry-run", action="store_true", help="Count the work without writing.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    firebase_admin.initialize_app()
+    run(args.page_size, args.start_after, args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
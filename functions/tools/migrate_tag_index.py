@@ -0,0 +1,78 @@
+# tools/migrate_tag_index.py
+#
+# Moves tag postings from the "posts" map of tagIndex/{tag} documents to
+# tagIndex/{tag}/posts/{postId} documents (see feed_engine.index_post), then
+# removes the map. Feeds only read the subcollections, so posts indexed
+# before the change are missing from them until this has run.
+#
+# Re-running is idempotent: migrated tag documents no longer have the map.
+#
+# Usage (from the functions/ directory, with application default credentials):
+#   python -m tools.migrate_tag_index --dry-run
+#   python -m tools.migrate_tag_index --page-size 100
+
+import argparse
+import logging
+import sys
+
+import firebase_admin
+from firebase_admin import firestore
+
+import feed_engine
+
+# Firestore's limit for writes in one batch.
+MAX_BATCH_WRITES = 500
+
+
+def migrate_tag(db, tag_doc, dry_run: bool = False) -> int:
+    """Migrates one tag document. Returns the number of postings written."""
+    posts = (tag_doc.to_dict() or {}).get("posts") or {}
+    if not posts or dry_run:
+        return len(posts)
+    postings = tag_doc.reference.collection(feed_engine.POSTINGS_SUBCOLLECTION)
+    items = list(posts.items())
+    for start in range(0, len(items), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for post_id, entry in items[start:start + MAX_BATCH_WRITES]:
+            batch.set(postings.document(post_id), entry)
+        batch.commit()
+    # Only after every posting is written, so an interrupted run is simply repeated.
+    tag_doc.reference.update({"posts": firestore.DELETE_FIELD})
+    return len(items)
+
+
+def run(page_size: int, dry_run: bool) -> None:
+    db = firestore.client()
+    tags = db.collection(feed_engine.TAG_INDEX_COLLECTION)
+    last_doc = None
+    scanned = migrated = 0
+    while True:
+        query = tags.order_by("__name__").limit(page_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        page = list(query.stream())
+        if not page:
+            break
+        for tag_doc in page:
+            migrated += migrate_tag(db, tag_doc, dry_run)
+            scanned += 1
+        last_doc = page[-1]
+        logging.info(f"Scanned {scanned} tag(s), {migrated} posting(s) so far.")
+    action = "Would write" if dry_run else "Wrote"
+    print(f"{action} {migrated} posting(s) across {scanned} tag(s).")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Move tagIndex posting maps to per-post documents.")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--dry-run", action="store_true", help="Count the work without writing.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    firebase_admin.initialize_app()
+    run(args.page_size, args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())